@@ -25,6 +25,17 @@ added read_fixed_size
 
 v1.3 - Oct 2022 - added sizing and blank check using code from Matt Callow https://github.com/mattcallow/psion_pak_reader
 
+v1.4 - Oct 2026 - added p patch write, writes PC data from a start address
+transfers time out after serial_timeout, then send XXError, s command replies XXSync so PC can resync
+a command reads up to max_ranges address ranges, seekAddress() continues from the current address if that needs fewer clocks
+than a reset, only within a command (e.g. from one range to the next), the first seek of each command resets the counters, as the pack may have been swapped since the last one
+f command sends the directory as binary entries, pack size is cached (sizePack) for r, t and n until a write, erase or a different pack
+(ID bytes or the bytes at the end of the record chain changed), d and f list the records, so they always walk them
+g command sends any page as binary for the PC to format, replaces the 0 to 3 page hex dumps (printPageContents)
+z command erases a range, e and z skip bytes that are already 0xFF, k command sends a CRC-16 for each page
+p writes seek from the current address (rampaks), so the PC can write only the data extents of an image, skipping 0xFF runs
+n command appends records at the end of pack, only the new record bytes are sent, a rampak gets a new end of pack byte
+
 */
 
 // datapak pin connections on Arduino
@@ -56,9 +67,22 @@ boolean paged_addr = true; // true for paged addressing, false for linear addres
 boolean datapak_mode = true; // true for datapaks, false for rampaks, mode can be changed by command option
 boolean program_low = false; // will be set true when PGM_N is low during datapak write, so page counter can be pulsed accordingly
 const boolean force_write_cycles = false; // set true to perform max write cycles, without break for confirmed write
-const boolean overwrite = false; // set true to add a longer overwite after confirmed write
+byte overprogram = 0; // 0 for no overwrite, else a longer overwrite after confirmed write, of overprogram * cycles * datapak_write_pulse (3 in EPROM datasheets)
 const byte max_datapak_write_cycles = 5; // max. no. of write cycle attempts before failure
-const byte datapak_write_pulse = 100; // datapak write pulse in us, 1000 us = 1 ms, 10us write can be read by Arduino, but not Psion!
+word datapak_write_pulse = 100; // datapak write pulse in us, 1000 us = 1 ms, 10us write can be read by Arduino, but not Psion!
+// datapak_write_pulse and overprogram can be changed by the PC with the u command, e.g. from the cycle counts of earlier writes
+#define min_write_pulse 10 // us, limits for the u command
+#define max_write_pulse 2000
+
+// write cycle counts, for the c command - cleared at the start of each write (w or p command)
+word cycle_hist[max_datapak_write_cycles + 1]; // no. of bytes written in each no. of cycles, [0] is failed bytes
+#define marginal_cycles 2 // bytes that need this many cycles or more are marginal
+#define max_marginal 16 // addresses of the first marginal bytes are kept
+#define max_ranges 16 // address ranges read by one a command, 4 bytes each fit the 64 byte serial buffer
+word marginal_total = 0; // no. of marginal bytes
+byte marginal_count = 0; // no. of addresses kept
+word marginal_addr[max_marginal];
+byte marginal_cycles_kept[max_marginal];
 
 // ensure Baud rate matches the python PC software
 //#define BaudRate 9600 // default
@@ -67,6 +91,7 @@ const byte datapak_write_pulse = 100; // datapak write pulse in us, 1000 us = 1
 #define BaudRate 115200 // faster
 
 word current_address = 0;
+boolean counters_valid = false; // current_address is where the pack counters are, false at the start of each command (pack may have been swapped)
 #define max_eprom_size 0x8000 // max eprom size - 32k - only used by Matt's code
 
 boolean read_fixed_size = false; // true for fixed size
@@ -76,6 +101,12 @@ word read_pack_size = 0x7e9b; // set a fixed pack size for read
 
 byte CLK_val = 0; // flag to indicate CLK state
 
+word dir_end = 0; // end of pack address from last read_dir(), saves walking the records again
+word dir_fingerprint = 0; // packFingerprint(dir_end) when dir_end was found, a different pack has different ID or end bytes
+boolean dir_valid = false; // false after any write, erase or mode change
+
+#define serial_timeout 100 // ms, max wait for the next byte from the PC during a transfer
+
 //------------------------------------------------------------------------------------------------------
 //------------------------------------------------------------------------------------------------------
 
@@ -91,6 +122,43 @@ void delayLong() { // 3 us delay
 
 //------------------------------------------------------------------------------------------------------
 
+bool waitSerial() { // wait for a byte from PC during a transfer, returns false if none within serial_timeout
+  unsigned long t = millis();
+  while (!(Serial.available() > 0)) { // if no data from PC, loop until there is, or timeout
+    if (millis()-t > serial_timeout) return false;
+  }
+  return true;
+}
+
+//------------------------------------------------------------------------------------------------------
+
+void drainSerial() { // discard bytes from PC until none arrive for serial_timeout
+  unsigned long t = millis();
+  while (millis()-t <= serial_timeout) {
+    if (Serial.available() > 0) {
+      Serial.read();
+      t = millis(); // restart timeout
+    }
+  }
+}
+
+//------------------------------------------------------------------------------------------------------
+
+void abortTransfer(const __FlashStringHelper *msg) { // failed transfer - print msg, return pack & serial link to a known state
+  Serial.println(msg);
+  if (program_low) { // datapak write
+    digitalWrite(PGM_N, HIGH); // take PGM_N high
+    program_low = false;
+  }
+  digitalWrite(VPP, LOW); // make sure VPP is off
+  packDeselectAndInput(); // deselect pack, then set pack data bus to input
+  ArdDataPinsToInput();
+  drainSerial(); // discard rest of transfer from PC, so it isn't taken as commands
+  Serial.println(F("XXError")); // tells PC the transfer has failed, PC can then send s to resync
+}
+
+//------------------------------------------------------------------------------------------------------
+
 void ArdDataPinsToInput() { // set Arduino data pins to input
   // rampaks have pull down resistors in the pack circuit
   // datapaks do not have these, so internal Arduino input PULLUP resistors are enabled
@@ -163,6 +231,7 @@ void resetAddrCounter() { // Resets pack counters
   delayShort();
   //delayLong();
   current_address = 0;
+  counters_valid = true;
 }
 
 //------------------------------------------------------------------------------------------------------
@@ -217,54 +286,54 @@ void setAddress(word addr) { // resets counter then toggles counters to reach ad
 
 //------------------------------------------------------------------------------------------------------
 
-void printPageContents(byte page) { // set address to start of page and print contents of page (256 bytes) to serial (formatted with addresses)
+void seekAddress(word addr) { // move counters to addr with the fewest clocks: continue from current_address, or reset with setAddress()
+  byte page = highByte(addr);
+  byte addr_low = lowByte(addr);
+  byte cur_page = highByte(current_address);
+  byte cur_low = lowByte(current_address);
+  word reset_cost; // no. of nextAddress() & nextPage() calls after a reset
+  word cont_cost = 0xFFFF; // no. of calls to continue from current_address, counters only count up
+  if (!counters_valid) { // 1st seek of a command, a different pack's counters are not where current_address says
+    setAddress(addr);
+    return;
+  }
+  if (paged_addr) {
+    reset_cost = page + addr_low;
+    if (addr >= current_address) {
+      if (addr_low >= cur_low) cont_cost = (page - cur_page) + (addr_low - cur_low); // nextPage to page, then nextAddress
+      else cont_cost = (page - cur_page - 1) + (0x100 - cur_low) + addr_low; // last page reached by nextAddress wrap around
+    }
+  }
+  else { // linear addressing
+    reset_cost = addr;
+    if (addr >= current_address) cont_cost = addr - current_address;
+  }
+  if (cont_cost > reset_cost) {
+    setAddress(addr);
+    return;
+  }
+  if (paged_addr) {
+    byte pages = page - cur_page;
+    if (addr_low < cur_low) pages--; // nextAddress() advances the last page when low byte wraps around
+    for (byte p = 0; p < pages; p++) {
+      nextPage();
+      current_address += 0x100;
+    }
+  }
+  while (current_address != addr) nextAddress(); // nextAddress() updates current_address
+}
+
+//------------------------------------------------------------------------------------------------------
+
+void sendPage(byte page) { // send the 256 bytes of page as binary, the PC formats them - much less serial data than a hex dump
 
   ArdDataPinsToInput(); // ensure Arduino data pins are set to input
   packOutputAndSelect(); // Enable pack data bus output, then select it
-  resetAddrCounter(); // reset address counter
-  
-  Serial.println(F("addr  00 01 02 03 04 05 06 07  08 09 0A 0B 0C 0D 0E 0F  -------TEXT-------"));
-  Serial.println(F("------------------------------------------------------  01234567  89ABCDEF")); // comment out to save memory
+  seekAddress((word)page << 8); // next page continues from the end of this one
 
-  for (byte p = 0; p < page; p++) { // page counter
-    if (paged_addr) { // paged addressing
-      nextPage(); // call nextPage(), until page reached      
-    }
-    else { // linear addressing
-      for (word a = 0; a <= 0xFF; a++) {
-        nextAddress(); // call nextAddress() for every address in page, including 0xFF - so will advance to 0x100
-      }
-    }
-  }
-  for (word base = 0; base <= 255; base += 16) { // loop through 0 to 255 in steps of 16, last step to 256
-    byte data;
-    char str[19] = ""; // fill with zeros, 16+2+1, +1 for char zero terminator
-    str[8] = 32; str[9] = 32; // gap in middle, 2 spaces
-    byte pos = 0;
-    char buf[6]; // buffer for sprintf: 5 chars + terminator
-    sprintf(buf, "%04x ", base + page * 0x100); // format page in hex
-    Serial.print(buf);
-    for (byte offset = 0; offset <= 15; offset += 1) { // loop through 0 to 15
-      if ((offset == 0) || (offset == 8)) Serial.print(" "); // at 0 or 7 print an extra spaces
-      data = readByte(); // read byte from pack
-      sprintf(buf, "%02x ", data); // format data byte in hex
-      Serial.print(buf);
-      if ((data > 31) && (data < 127)) { // if printable char, put in str        
-        str[pos] = data;
-      }
-      else str[pos] = '.'; // else use '.'
-      pos++;
-      if (pos == 8) pos += 2; // jump 2 spaces after 8th char in str
-      nextAddress();
-    }
-    Serial.print(" ");
-    Serial.println(str);
-    /*
-    char buf[80]; // buffer for sprintf - used too much memory
-    sprintf(buf, "%04x  %02x %02x %02x %02x %02x %02x %02x %02x  %02x %02x %02x %02x %02x %02x %02x %02x  %s",
-            base + page * 0x100, data[0], data[1], data[2], data[3], data[4], data[5], data[6], data[7],
-            data[8], data[9], data[10], data[11], data[12], data[13], data[14], data[15]);
-    Serial.println(buf);*/
+  for (word offset = 0; offset <= 0xFF; offset++) {
+    Serial.write(readByte()); // read byte from pack and send it
+    if (offset < 0xFF) nextAddress(); // counters stay on the last byte of the page
   }
   packDeselectAndInput(); // deselect pack, then set pack data bus to input
 }
@@ -295,7 +364,7 @@ byte readAddr(word addr, bool output) { // set address, read byte, print if outp
 word readAll(byte output) { // read all pack data, output if selected and return address of 1st free byte (with value 0xFF)
   // output: 0 - none, 1 - print address & byte value, 2 - send bytes
 
-  word endAddr = read_dir(); // size pack - max is 64k
+  word endAddr = sizePack(); // size pack - max is 64k, cached if the ID bytes and the end of the records are the same as when sized
   Serial.print("Size: 0x");
   Serial.println(endAddr, HEX);
 
@@ -322,18 +391,14 @@ word readAll(byte output) { // read all pack data, output if selected and return
     }
     if (output == 2) { // send to serial as bytes
       Serial.write(dat); // send byte only
-      unsigned long t = millis();
-      while (!(Serial.available() > 0)) { // wait for data echo back, if no data: loop until there is, or timeout
-        if (millis()-t > 1000) { // if timeout
-          Serial.println(F("(Ard) Timeout!"));
-          return false;
-        }
-      } // end of while loop delay for data echo back from PC
+      if (!waitSerial()) { // wait for data echo back, or timeout
+        abortTransfer(F("(Ard) Timeout!"));
+        return 0;
+      }
       byte datr = Serial.read(); // read byte value from serial
       if (datr != dat) { // if echo datr doesn't match dat sent
-        delay(600); // delay to force timeout on PC !!
-        Serial.println(F("(Ard) Read data not verified by PC!"));
-        return false;        
+        abortTransfer(F("(Ard) Read data not verified by PC!"));
+        return 0;
       }
     }
     if (addr_tot >= endAddr) quit = true;
@@ -351,6 +416,36 @@ word readAll(byte output) { // read all pack data, output if selected and return
 
 //------------------------------------------------------------------------------------------------------
 
+bool readRangeSerial(word startAddr, word numBytes) { // send pack data from startAddr to startAddr+numBytes to PC, each byte echoed
+
+  ArdDataPinsToInput(); // ensure Arduino data pins are set to input
+  packOutputAndSelect(); // Enable pack data bus output then select it
+  seekAddress(startAddr); // continue from current address if that's quicker than a reset
+
+  word i = 0;
+  while (true) {
+    byte dat = readByte(); // read pack byte at current address
+    Serial.write(dat); // send byte only
+    if (!waitSerial()) { // wait for data echo back, or timeout
+      abortTransfer(F("(Ard) Timeout!"));
+      return false;
+    }
+    byte datr = Serial.read(); // read byte value from serial
+    if (datr != dat) { // if echo datr doesn't match dat sent
+      abortTransfer(F("(Ard) Read data not verified by PC!"));
+      return false;
+    }
+    if (i == numBytes) break; // last byte sent, counters stay at last address for the next range
+    nextAddress();
+    i++;
+  }
+
+  packDeselectAndInput(); // deselect pack, then set pack data bus to input
+  return true;
+}
+
+//------------------------------------------------------------------------------------------------------
+
 bool writePakByteRampak(byte val) { // writes val to current address, returns true if written ok - no longer used
 
   packDeselectAndInput(); // deselect pack, then set pack data bus to input (OE_N = high)
@@ -376,10 +471,12 @@ bool writePakByteRampak(byte val) { // writes val to current address, returns tr
 
 //------------------------------------------------------------------------------------------------------
 
-bool writePakByte(byte val, bool output) { // writes val to current address, returns false if write failed
+byte writePakByte(byte val, bool output) { // writes val to current address, returns 0 (false) if write failed
 // returns no. of cycles if write ok
 // needs both PGM_N low and CE_N low for Eprom write
 
+  dir_valid = false; // pack changed, size it again
+
   byte write_cycles = 1;
   byte dat = 0;
   byte i = 1;
@@ -433,7 +530,7 @@ bool writePakByte(byte val, bool output) { // writes val to current address, ret
 
   packDeselectAndInput(); // deselect pack, then set pack data bus to input (CE_N high, OE_N high)
 
-  if ((overwrite) == true && (dat == val) && (datapak_mode)) { // for non-CMOS EPROM write again to make sure - overwrite
+  if ((overprogram > 0) && (dat == val) && (datapak_mode)) { // for non-CMOS EPROM write again to make sure - overwrite
     if (output) Serial.println(F("(Ard) Datapak write VPP on"));
     digitalWrite(VPP, HIGH); // turn on VPP, 5V VCC is on already
     delayLong();
@@ -441,7 +538,7 @@ bool writePakByte(byte val, bool output) { // writes val to current address, ret
     writeByte(val); // put value on Arduino data bus
     delayLong();  
     digitalWrite(SS_N, LOW); // take CE_N low - select
-    delayMicroseconds(datapak_write_pulse*3); // 3*delay for overwrite
+    for (word k = 0; k < (word)overprogram * i; k++) delayMicroseconds(datapak_write_pulse); // overprogram * cycles * delay for overwrite
     digitalWrite(SS_N, HIGH); // take CE_N high - deselect
     delayLong();  
     digitalWrite(VPP, LOW); // turn off VPP, 5V VCC goes off later
@@ -450,36 +547,80 @@ bool writePakByte(byte val, bool output) { // writes val to current address, ret
   }
   
   if (dat == val) return i; // return no. of cycles if value written ok
-  else return false; // false if write cannot be verified
+  else return 0; // 0 if write cannot be verified
+}
+
+//------------------------------------------------------------------------------------------------------
+
+void resetCycleStats() { // clear write cycle counts, at the start of each write
+  for (byte c = 0; c <= max_datapak_write_cycles; c++) cycle_hist[c] = 0;
+  marginal_total = 0;
+  marginal_count = 0;
+}
+
+void countCycles(word addr, byte cycles) { // add a written byte to the cycle counts, cycles is 0 if the write failed
+  if (cycles > max_datapak_write_cycles) cycles = max_datapak_write_cycles;
+  cycle_hist[cycles]++;
+  if ((cycles == 0) || (cycles >= marginal_cycles)) {
+    marginal_total++;
+    if (marginal_count < max_marginal) {
+      marginal_addr[marginal_count] = addr;
+      marginal_cycles_kept[marginal_count] = cycles;
+      marginal_count++;
+    }
+  }
+}
+
+void sendCycleStats() { // cycle counts of the last write as binary for the PC
+  Serial.println(F("XXCycles")); // tell PC to receive the counts
+  Serial.write(highByte(datapak_write_pulse));
+  Serial.write(lowByte(datapak_write_pulse));
+  Serial.write(overprogram);
+  Serial.write(max_datapak_write_cycles);
+  for (byte c = 0; c <= max_datapak_write_cycles; c++) { // high, low byte of count for 0 (failed) to max cycles
+    Serial.write(highByte(cycle_hist[c]));
+    Serial.write(lowByte(cycle_hist[c]));
+  }
+  Serial.write(highByte(marginal_total));
+  Serial.write(lowByte(marginal_total));
+  Serial.write(marginal_count);
+  for (byte m = 0; m < marginal_count; m++) { // address high, low byte and cycles of each marginal byte kept
+    Serial.write(highByte(marginal_addr[m]));
+    Serial.write(lowByte(marginal_addr[m]));
+    Serial.write(marginal_cycles_kept[m]);
+  }
+  Serial.println("");
+  Serial.println(F("(Ard) Cycles sent"));
 }
 
 //------------------------------------------------------------------------------------------------------
 
-bool writePakSerial(word numBytes) { // write PC serial data to pack
+bool writePakSerial(word startAddr, word numBytes) { // write PC serial data to pack, from startAddr to startAddr+numBytes
   
   bool done_w = false;
   word addr = 0;
 
+  resetCycleStats();
   if (datapak_mode) {
     digitalWrite(PGM_N, LOW); // take PGM_N low - select & program - need PGM_N low for CE_N low if OE_N high
     program_low = true;
   }
-  resetAddrCounter(); // reset address counters, after PGM_N low
+  if (datapak_mode) setAddress(startAddr); // reset address counters and move to startAddr, after PGM_N low (its -ve edge moves the page counter)
+  else seekAddress(startAddr); // the 1st seek of a command resets the counters, each extent of a sparse write is its own p command
   
   for (addr = 0; addr <= numBytes; addr++) {
-    unsigned long t = millis();
-    while (!(Serial.available() > 0)) { // if no data from PC, loop until there is, or timeout
-      if (millis()-t > 1000) { // if timeout
-        Serial.println("(Ard) Timeout!");
-        return false;
-      }
+    if (!waitSerial()) { // wait for data from PC, or timeout
+      abortTransfer(F("(Ard) Timeout!"));
+      return false;
     }
     byte datw = Serial.read(); // read byte value from serial
     Serial.write(datw); // write data back to PC to verify and control data flow
-    done_w = writePakByte(datw, /* output */ false); // write value to current memory address, no output because PC needs to verify data
+    byte cycles = writePakByte(datw, /* output */ false); // write value to current memory address, no output because PC needs to verify data
+    countCycles(startAddr + addr, cycles);
+    done_w = (cycles > 0);
     if (done_w == false) {
-      Serial.println(F("(Ard) Write byte failed!"));
-      break;
+      abortTransfer(F("(Ard) Write byte failed!")); // discards rest of data, so it isn't taken as commands
+      return false;
     }
     nextAddress();
     }
@@ -497,33 +638,72 @@ bool writePakSerial(word numBytes) { // write PC serial data to pack
 
 //------------------------------------------------------------------------------------------------------
 
-void eraseBytes(word addr, word numBytes) { // erase numBytes, starting at addr - ony for rampaks
-  setAddress(addr);
-  bool done_ok = false;
+word eraseBytes(word addr, word numBytes) { // erase numBytes+1 bytes, starting at addr - ony for rampaks
+  // bytes that are already 0xFF are skipped, returns no. of bytes written
+  seekAddress(addr);
+  bool erase_ok = true;
+  word written = 0;
   byte addr_low = addr & 0xFF; // low byte of addr
   Serial.print(F("(Ard) Erasing:"));
-  for (word i = 0; i <= numBytes; i++) { // loop through numBytes to write
-    done_ok = writePakByte(0xFF, false /* no output */); // write 0xFF
-    if (done_ok == false) {
-      Serial.println(F("(Ard) Erase failed!"));
-      break; // break out of for loop
+  word i = 0;
+  while (true) { // loop through numBytes to erase
+    ArdDataPinsToInput(); // ensure Arduino data pins are set to input
+    packOutputAndSelect(); // Enable pack data bus output, then select it
+    byte dat = readByte(); // reading is much quicker than writing
+    packDeselectAndInput(); // deselect pack, then set pack data bus to input
+    if (dat != 0xFF) {
+      if (writePakByte(0xFF, false /* no output */) == false) { // write 0xFF
+        Serial.println(F("(Ard) Erase failed!"));
+        erase_ok = false;
+        break; // break out of loop
+      }
+      written++;
     }
     if (addr_low == 0xFF) { // if end of page reached, go to next page, addr_low will wrap around to zero
       Serial.print("."); // "." printed for each end of page
     }
+    if (i == numBytes) break; // counters stay at last address
     nextAddress(); 
     addr_low++;  
+    i++;
   }
-  if (done_ok == true) {
+  if (erase_ok == true) {
   Serial.println("");
   Serial.println(F("(Ard) Erased ok"));
   }
+  return written;
+}
+
+//------------------------------------------------------------------------------------------------------
+
+word crc16Update(word crc, byte dat) { // CRC-16/CCITT (polynomial 0x1021), same as Python binascii.crc_hqx()
+  crc ^= (word)dat << 8;
+  for (byte b = 0; b < 8; b++) {
+    if (crc & 0x8000) crc = (crc << 1) ^ 0x1021;
+    else crc = crc << 1;
+  }
+  return crc;
+}
+
+//------------------------------------------------------------------------------------------------------
+
+word pageChecksum(byte page) { // CRC-16 of the 256 bytes of page, start value 0xFFFF
+  ArdDataPinsToInput(); // ensure Arduino data pins are set to input
+  packOutputAndSelect(); // Enable pack data bus output, then select it
+  seekAddress((word)page << 8); // next page continues from the end of this one
+  word crc = 0xFFFF;
+  for (word offset = 0; offset <= 0xFF; offset++) {
+    crc = crc16Update(crc, readByte());
+    if (offset < 0xFF) nextAddress(); // counters stay on the last byte of the page
+  }
+  packDeselectAndInput(); // deselect pack, then set pack data bus to input
+  return crc;
 }
 
 //------------------------------------------------------------------------------------------------------
 
 void WriteMainRec(bool output) { // write record to main
-  word endAddr = read_dir();
+  word endAddr = sizePack();
   Serial.print(F("Pack size (from dir) is: "));
   Serial.println(endAddr, HEX);
   if (datapak_mode) {
@@ -556,7 +736,12 @@ void WriteMainRec(bool output) { // write record to main
       digitalWrite(PGM_N, HIGH); // take PGM_N high
       program_low = false;
     }
-    if (done_ok == true) Serial.println(F("(Ard) add record done successfully"));
+    if (done_ok == true) { // new end of pack is after the record, ID bytes not changed
+      dir_end = endAddr;
+      dir_fingerprint = packFingerprint(endAddr);
+      dir_valid = true;
+      Serial.println(F("(Ard) add record done successfully"));
+    }
     else Serial.println(F("(Ard) add record failed!"));
   }
   else Serial.println(F("(Ard) no 0xFF byte to add record!"));
@@ -566,11 +751,11 @@ void printCommands() {
   Serial.println(F("(Ard) datapak_read_write_v1.3"));
   printPackMode();
   printAddrMode();
-  Serial.println(F("(Ard) Select a command:\ne - erase\nr - read pack\nw - write pack"));
-  Serial.println(F("0 - print page 0\n1 - print page 1\n2 - print page 2\n3 - print page 3"));
+  Serial.println(F("(Ard) Select a command:\ne - erase\nz - erase range (skips blank bytes)\nk - page checksums\nr - read pack\nw - write pack\np - patch write from address\na - read address ranges"));
+  Serial.println(F("g - get page (binary)\nc - write cycle counts (binary)\nu - set datapak write pulse\nn - append records at end of pack"));
   Serial.println(F("t - write TEST record to main\nm - rampak (or datapak) mode\nl - linear (or paged) addressing"));
-  Serial.println(F("i - print pack id byte flags\nd - directory and size pack\nb - check if pack is blank"));
-  Serial.println(F("? - list commands\nx - exit"));
+  Serial.println(F("i - print pack id byte flags\nd - directory and size pack\nf - directory (binary)\nb - check if pack is blank"));
+  Serial.println(F("s - sync\n? - list commands\nx - exit"));
 }
 
 void printPackMode() {
@@ -620,26 +805,41 @@ void print_pak_id() { // the first 2 bytes on a pack are the id and size bytes.
   Serial.print("Size: "); Serial.print(pack_size); Serial.println(" kB");
 }
 
-word read_dir() { // read filenames and size pack
+word read_dir(byte output) { // read filenames and size pack
+  // output: 0 - none, 1 - print directory table, 2 - send binary directory entries to PC
+  // binary entry: addr (high, low), length byte, type, size (high, low), first 9 bytes of short record (spaces if fewer)
+  // last entry is addr (high, low), 0xFF for end of pack
     ArdDataPinsToInput(); // ensure Arduino data pins are set to input
     packOutputAndSelect(); // Enable pack data bus output, then select it
     resetAddrCounter();
     uint8_t id = 0; // datafile id
-    Serial.println();
-    Serial.println(F("ADDR   TYPE         NAME      ID    Del? SIZE"));
+    bool end_found = false;
+    if (output == 1) {
+      Serial.println();
+      Serial.println(F("ADDR   TYPE         NAME      ID    Del? SIZE"));
+    }
     incr_addr(9); // move past header to 10th byte
     while(current_address < max_eprom_size) {
-      Serial.print("0x"); // print address (6 chars + space)
-      if (current_address+1<0x10) Serial.print("0");
-      if (current_address+1<0x100) Serial.print("0");
-      if (current_address+1<0x1000) Serial.print("0");
-      Serial.print(current_address+1, HEX);
-      Serial.print(" ");
+      word rec_addr = current_address+1;
+      if (output == 1) {
+        Serial.print("0x"); // print address (6 chars + space)
+        if (rec_addr<0x10) Serial.print("0");
+        if (rec_addr<0x100) Serial.print("0");
+        if (rec_addr<0x1000) Serial.print("0");
+        Serial.print(rec_addr, HEX);
+        Serial.print(" ");
+      }
       
       char short_record[10] = "         "; // 9 spaces + terminator
       uint8_t rec_len = read_next_byte();
+      if (output == 2) {
+        Serial.write(highByte(rec_addr));
+        Serial.write(lowByte(rec_addr));
+        Serial.write(rec_len);
+      }
       if (rec_len == 0xff) {
-        Serial.println(F("End of pack"));
+        if (output == 1) Serial.println(F("End of pack"));
+        end_found = true;
         break;
       }
       uint16_t jump = rec_len; // for jump, reduces when bytes read
@@ -647,8 +847,16 @@ word read_dir() { // read filenames and size pack
       uint8_t rec_type = read_next_byte();
       if (rec_type == 0x80) {
         jump = (read_next_byte()<<8) + read_next_byte();
-        Serial.print("Long record, length = 0x");
-        Serial.println(jump, HEX);
+        if (output == 1) {
+          Serial.print("Long record, length = 0x");
+          Serial.println(jump, HEX);
+        }
+        if (output == 2) {
+          Serial.write(rec_type);
+          Serial.write(highByte(jump));
+          Serial.write(lowByte(jump));
+          Serial.write((byte*)short_record, 9); // no name
+        }
       } 
       else {
         if (rec_len > 9) rec_len = 9; // read first 8 chars of short record for printing
@@ -656,6 +864,14 @@ word read_dir() { // read filenames and size pack
           short_record[i] = read_next_byte();
           jump--;
         }
+        if (output == 2) {
+          Serial.write(rec_type);
+          Serial.write(highByte(rec_size));
+          Serial.write(lowByte(rec_size));
+          Serial.write((byte*)short_record, 9);
+        }
+      }
+      if ((output == 1) && (rec_type != 0x80)) {
          
         Serial.print("0x"); // print rec type (4 chars)
         if (rec_type < 0x10) Serial.print("0"); // pad with zero, if required
@@ -711,10 +927,49 @@ word read_dir() { // read filenames and size pack
       }
       incr_addr(jump);
     }
+    if ((output == 2) && !end_found) { // reached max_eprom_size, send end entry so PC stops reading
+      Serial.write(highByte(current_address));
+      Serial.write(lowByte(current_address));
+      Serial.write(0xFF);
+    }
     packDeselectAndInput(); // deselect pack, then set pack data bus to input
-    return current_address;
+    word endAddr = current_address;
+    dir_fingerprint = packFingerprint(endAddr); // keep size for sizePack()
+    dir_end = endAddr;
+    dir_valid = true;
+    return endAddr;
+}
+
+//------------------------------------------------------------------------------------------------------
+
+word packFingerprint(word endAddr) { // hash of the 10 ID bytes and the bytes at endAddr-1 and endAddr, the end of the record chain
+  // a quick check that the pack is the one that was sized, a copy of a pack has the same ID bytes but most edits move the end
+  ArdDataPinsToInput(); // ensure Arduino data pins are set to input
+  packOutputAndSelect(); // Enable pack data bus output, then select it
+  resetAddrCounter();
+  word fp = 0;
+  for (byte i = 0; i < 10; i++) {
+    fp = ((fp << 3) | (fp >> 13)) ^ readByte(); // rotate and xor each byte
+    nextAddress();
+  }
+  seekAddress(endAddr - 1); // continues from address 10
+  for (byte i = 0; i < 2; i++) {
+    fp = ((fp << 3) | (fp >> 13)) ^ readByte(); // last byte of the records, then the end of pack byte
+    nextAddress();
+  }
+  packDeselectAndInput(); // deselect pack, then set pack data bus to input
+  return fp;
 }
 
+//------------------------------------------------------------------------------------------------------
+
+word sizePack() { // end of pack address, from the last read_dir() if the pack hasn't changed, else walks the records silently
+  if (dir_valid && (packFingerprint(dir_end) == dir_fingerprint)) return dir_end;
+  return read_dir(0);
+}
+
+
+
 bool blank_check() {
   ArdDataPinsToInput(); // ensure Arduino data pins are set to input
   packOutputAndSelect(); // Enable pack data bus output, then select it
@@ -813,6 +1068,7 @@ void loop() { // command loop
   
   if (Serial.available() > 0) {
     char key = Serial.read();
+    counters_valid = false; // pack may have been swapped since the last command
     //char buf[15];
     //sprintf(buf, "(Ard) In: 0x%02x", byte(key)); // print input character
     //Serial.println(buf);
@@ -827,6 +1083,49 @@ void loop() { // command loop
         break;
       }
       
+      case 'z' : { // erase range - rampaks only, bytes already 0xFF are skipped
+        Serial.println(F("(Ard) Erase range"));
+        char str[] = "XXErase"; // Check for "XXErase" from PC to indicate following bytes are the range
+        if (Serial.find(str,7) == true) { // waits for "XXErase", or until timeout
+          byte range[4] = {0}; // byte array to store start address and last offset
+          byte bytes_read = Serial.readBytes(range,4); // read 2 bytes for start address, 2 bytes for last offset (no. of bytes - 1)
+          if (bytes_read == 4) {
+            word startAddr = (range[0] << 8) + range[1]; // shift 1st byte 8 bits left for high byte and add 2nd byte as low byte
+            word numBytesTotal = (range[2] << 8) + range[3];
+            if (!datapak_mode) {
+              word written = eraseBytes(startAddr, numBytesTotal);
+              char buf[50];
+              sprintf(buf, "(Ard) Erase range: %04x to %04x, written: %04x", startAddr, startAddr + numBytesTotal, written);
+              Serial.println(buf);
+            }
+            else Serial.println(F("(Ard) Can't erase a Datapak! Use UV lamp, or a Rampak"));
+          }
+          else abortTransfer(F("(Ard) Wrong no. of range bytes sent!"));
+        }
+        else abortTransfer(F("(Ard) No XXErase to begin range"));
+        break;
+      }
+
+      case 'k' : { // page checksums - CRC-16 of each page from first to last page
+        Serial.println(F("(Ard) Page checksums"));
+        char str[] = "XXSum"; // Check for "XXSum" from PC, followed by first and last page no.
+        if (Serial.find(str,5) == true) { // waits for "XXSum", or until timeout
+          byte pages[2] = {0};
+          if (Serial.readBytes(pages,2) == 2) {
+            Serial.println(F("XXSum")); // tell PC to receive 2 bytes (high, low) for each page
+            for (word page = pages[0]; page <= pages[1]; page++) {
+              word crc = pageChecksum(page);
+              Serial.write(highByte(crc));
+              Serial.write(lowByte(crc));
+            }
+            Serial.println(F("(Ard) Sums sent"));
+          }
+          else abortTransfer(F("(Ard) Wrong no. of page bytes sent!"));
+        }
+        else abortTransfer(F("(Ard) No XXSum to begin pages"));
+        break;
+      }
+
       case 'w' : { // write pack from PC data
         bool write_ok = false;
         Serial.println("(Ard) Write Serial data to pack");
@@ -836,18 +1135,106 @@ void loop() { // command loop
           byte bytes_read = Serial.readBytes(numBytes,2); // read 2 bytes for pack size, will need to be 3 if pack > 64kB !
           if (bytes_read == 2) {
             word numBytesTotal = (numBytes[0] << 8) + numBytes[1]; // shift 1st byte 8 bits left for high byte and add 2nd byte as low byte
-            write_ok = writePakSerial(numBytesTotal); // write numBytes from file
+            write_ok = writePakSerial(0, numBytesTotal); // write numBytes from file, starting at address 0
             char buf[30];
             sprintf(buf, "(Ard) Pack size to write was: %04x bytes", numBytesTotal);
             Serial.println(buf); 
           }
-          else Serial.println(F("(Ard) Wrong no. of size bytes sent!"));    
+          else abortTransfer(F("(Ard) Wrong no. of size bytes sent!"));
         }
-        else Serial.println(F("(Ard) No XXWrite to begin data"));
+        else abortTransfer(F("(Ard) No XXWrite to begin data"));
         if (write_ok == false) Serial.println(F("(Ard) Write failed!"));        
         break;
       } 
       
+      case 'p' : { // patch - write PC data to pack from a start address
+        bool write_ok = false;
+        Serial.println("(Ard) Patch write Serial data to pack");
+        char str[] = "XXPatch"; // Check for "XXPatch" from PC to indicate following data is patch data
+        if (Serial.find(str,7) == true) { // waits for "XXPatch" to signal start of data, or until timeout
+          byte patch[4] = {0}; // byte array to store start address and last offset
+          byte bytes_read = Serial.readBytes(patch,4); // read 2 bytes for start address, 2 bytes for last offset (no. of bytes - 1)
+          if (bytes_read == 4) {
+            word startAddr = (patch[0] << 8) + patch[1]; // shift 1st byte 8 bits left for high byte and add 2nd byte as low byte
+            word numBytesTotal = (patch[2] << 8) + patch[3];
+            write_ok = writePakSerial(startAddr, numBytesTotal); // write numBytes from PC, starting at startAddr
+            char buf[40];
+            sprintf(buf, "(Ard) Patch written: %04x to %04x", startAddr, startAddr + numBytesTotal);
+            Serial.println(buf); 
+          }
+          else abortTransfer(F("(Ard) Wrong no. of patch bytes sent!"));
+        }
+        else abortTransfer(F("(Ard) No XXPatch to begin data"));
+        if (write_ok == false) Serial.println(F("(Ard) Patch write failed!"));        
+        break;
+      } 
+      
+      case 'n' : { // append - write PC records at the end of pack, the PC sends the end of pack address it expects
+        bool write_ok = false;
+        Serial.println(F("(Ard) Append records"));
+        char str[] = "XXAppend"; // Check for "XXAppend" from PC, followed by the append address and last offset
+        if (Serial.find(str,8) == true) { // waits for "XXAppend", or until timeout
+          byte append[4] = {0}; // byte array to store append address and last offset
+          byte bytes_read = Serial.readBytes(append,4); // read 2 bytes for append address, 2 bytes for last offset (no. of bytes - 1)
+          if (bytes_read == 4) {
+            word startAddr = (append[0] << 8) + append[1]; // shift 1st byte 8 bits left for high byte and add 2nd byte as low byte
+            word numBytesTotal = (append[2] << 8) + append[3];
+            word newEnd = startAddr + numBytesTotal + 1; // new end of pack address, after the records
+            if (sizePack() != startAddr) abortTransfer(F("(Ard) End of pack is not at the append address!")); // pack changed since the PC sized it
+            else if (newEnd <= startAddr) abortTransfer(F("(Ard) Records go past the end of 64k!"));
+            else if (readAddr(startAddr, false) != 0xFF) abortTransfer(F("(Ard) No 0xFF byte to append records!"));
+            else if (datapak_mode && (readAddr(newEnd, false) != 0xFF)) abortTransfer(F("(Ard) No 0xFF byte after the records!")); // can't be written on a datapak
+            else {
+              Serial.println(F("XXAppend")); // tell PC to send the records
+              write_ok = writePakSerial(startAddr, numBytesTotal); // write records over the old end of pack byte
+              if (write_ok && (readAddr(newEnd, false) != 0xFF)) { // rampak with old data after the records, readAddr leaves the counters at newEnd
+                write_ok = (writePakByte(0xFF, false) > 0); // new end of pack byte
+                if (write_ok == false) abortTransfer(F("(Ard) End of pack byte write failed!"));
+              }
+              if (write_ok) { // ID bytes not changed, so the new end of pack is kept for sizePack()
+                dir_end = newEnd;
+                dir_fingerprint = packFingerprint(newEnd);
+                dir_valid = true;
+                char buf[40];
+                sprintf(buf, "(Ard) Append written: %04x to %04x", startAddr, startAddr + numBytesTotal);
+                Serial.println(buf);
+              }
+            }
+          }
+          else abortTransfer(F("(Ard) Wrong no. of append bytes sent!"));
+        }
+        else abortTransfer(F("(Ard) No XXAppend to begin records"));
+        if (write_ok == false) Serial.println(F("(Ard) Append failed!"));
+        break;
+      }
+
+      case 'c' : { // write cycle counts of the last write, for the PC
+        sendCycleStats();
+        break;
+      }
+
+      case 'u' : { // set datapak write pulse and overprogram factor from the PC
+        Serial.println(F("(Ard) Set write pulse"));
+        char str[] = "XXPulse"; // Check for "XXPulse" from PC, followed by pulse high, low byte (us) and overprogram factor
+        if (Serial.find(str,7) == true) { // waits for "XXPulse", or until timeout
+          byte pulse[3] = {0};
+          if (Serial.readBytes(pulse,3) == 3) {
+            word pulse_us = (pulse[0] << 8) + pulse[1];
+            if ((pulse_us >= min_write_pulse) && (pulse_us <= max_write_pulse)) {
+              datapak_write_pulse = pulse_us;
+              overprogram = pulse[2];
+            }
+            else Serial.println(F("(Ard) Write pulse out of range!"));
+          }
+          else abortTransfer(F("(Ard) Wrong no. of pulse bytes sent!"));
+        }
+        else abortTransfer(F("(Ard) No XXPulse to begin pulse"));
+        char buf[50];
+        sprintf(buf, "(Ard) Write pulse: %u us, overprogram: %u", datapak_write_pulse, overprogram);
+        Serial.println(buf);
+        break;
+      }
+
       case 'r' : { // read pack and send to PC
         word endAddr = readAll(2); // 0 - no output, 1 - print data, 2 - dump data to serial
         char buf[30];
@@ -856,27 +1243,52 @@ void loop() { // command loop
         break;
       }
       
-      case '0': { // read page 0
-        Serial.println("(Ard) Page 0:");
-        printPageContents(0); // print zero page - first 256 bytes of datapak
-        break;
-      }
-      
-      case '1': { // read page 1
-        Serial.println("(Ard) Page 1:");
-        printPageContents(1); // print page 1 - second 256 bytes of datapak
-        break;
-      }
-  
-      case '2': { // read page 2
-        Serial.println("(Ard) Page 2:");
-        printPageContents(2); // print page 2 - third 256 bytes of datapak
+      case 'a' : { // read address ranges - send pack data from each start address to PC, up to max_ranges in one command
+        Serial.println(F("(Ard) Read range"));
+        char str[] = "XXRange"; // Check for "XXRange" from PC, followed by the no. of ranges and the ranges
+        if (Serial.find(str,7) == true) { // waits for "XXRange", or until timeout
+          byte count = 0;
+          Serial.readBytes(&count,1);
+          word startAddr[max_ranges]; // start address of each range
+          word numBytesTotal[max_ranges]; // last offset (no. of bytes - 1) of each range
+          byte r = 0;
+          for (r = 0; (r < count) && (count <= max_ranges); r++) {
+            byte range[4] = {0}; // byte array to store start address and last offset
+            if (Serial.readBytes(range,4) != 4) break; // read 2 bytes for start address, 2 bytes for last offset
+            startAddr[r] = (range[0] << 8) + range[1]; // shift 1st byte 8 bits left for high byte and add 2nd byte as low byte
+            numBytesTotal[r] = (range[2] << 8) + range[3];
+          }
+          if ((count > 0) && (r == count)) {
+            Serial.println(F("XXRange")); // tell PC to receive range data
+            bool read_ok = true;
+            for (r = 0; read_ok && (r < count); r++) { // the PC sends them in address order, so each seek can continue from the last range
+              read_ok = readRangeSerial(startAddr[r], numBytesTotal[r]);
+            }
+            if (read_ok) {
+              char buf[50];
+              sprintf(buf, "(Ard) Range read: %d ranges, %04x to %04x", count, startAddr[0], startAddr[count-1] + numBytesTotal[count-1]);
+              Serial.println(buf);
+            }
+          }
+          else abortTransfer(F("(Ard) Wrong no. of range bytes sent!"));
+        }
+        else abortTransfer(F("(Ard) No XXRange to begin range"));
         break;
       }
-      
-      case '3': { // read page 3
-        Serial.println("(Ard) Page 3:");
-        printPageContents(3); // print page 3 - fourth 256 bytes of datapak
+
+      case 'g': { // get page - send any page of the pack to PC as binary
+        Serial.println(F("(Ard) Get page"));
+        char str[] = "XXPage"; // Check for "XXPage" from PC, followed by the page no.
+        if (Serial.find(str,6) == true) { // waits for "XXPage", or until timeout
+          byte page[1] = {0};
+          if (Serial.readBytes(page,1) == 1) {
+            Serial.println(F("XXPage")); // tell PC to receive 256 bytes
+            sendPage(page[0]);
+            Serial.println(F("(Ard) Page sent"));
+          }
+          else abortTransfer(F("(Ard) No page no. sent!"));
+        }
+        else abortTransfer(F("(Ard) No XXPage to begin page"));
         break;
       }
       
@@ -888,12 +1300,15 @@ void loop() { // command loop
       
       case 'm': {// toggle between datapak and rampak modes
         datapak_mode = 1-datapak_mode; // toggle datapak mode
+        dir_valid = false;
         printPackMode();
         break;
       }
 
       case 'l': {// toggle between paged and linear addressing modes
         paged_addr = 1-paged_addr; // toggle addressing mode
+        resetAddrCounter(); // current_address is only valid in the mode it was counted in
+        dir_valid = false;
         printAddrMode();
         break;
       }
@@ -904,12 +1319,21 @@ void loop() { // command loop
       }
       
       case 'd': {// read dir and size pack
-        word pack_size = read_dir();
+        word pack_size = read_dir(1);
         Serial.print("pack size is: 0x");
         Serial.println(pack_size, HEX);
         break;
       }
 
+      case 'f': {// binary directory for PC
+        Serial.println(F("XXDir")); // tell PC to receive directory entries
+        word pack_size = read_dir(2);
+        Serial.println();
+        Serial.print(F("(Ard) Dir sent, pack size is: 0x"));
+        Serial.println(pack_size, HEX);
+        break;
+      }
+
       case 'b': {// check if pack is blank
         blank_check();
         break;
@@ -919,6 +1343,11 @@ void loop() { // command loop
         printCommands();
         break;
       }
+
+      case 's': {// sync - PC checks the link is back in the command loop, e.g. after a failed transfer
+        Serial.println(F("XXSync"));
+        break;
+      }
       
       case 'x': { // x to exit
         // exit - set all control lines to input - pack will set default line states
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Cluster OPK files - find packs that are variants of each other, e.g. edited copies of comms42.opk
+
+Created: Oct 2026
+
+@author: martin
+
+Each pack image is reduced to a set of shingles: a hash of each non-blank page and of each record (type + data),
+so packs with the same records in different places, or the same pages, share shingles.
+The MinHash signature of the set (num_perm hashes) estimates the share of shingles 2 packs have in common (Jaccard similarity).
+Signatures are worked out once per image and kept in signature_file, so only new or changed packs are read again.
+
+Packs are paired by locality sensitive hashing: the signature is split into bands, packs with the same band go in the same
+bucket, and only packs that share a bucket are compared, so the time is about linear in the no. of packs, not all pairs.
+Pairs at or above threshold are joined into clusters. In each cluster the most similar pairs make a family tree,
+rooted at the oldest pack, and for each pack the records and byte ranges that differ from its parent are listed.
+
+Packs can be OPK files (infiles) and packs in an OPK archive (archive_file, OPK_archive.py).
+"""
+
+import glob
+import hashlib
+import json
+import os
+import random
+import time
+
+import OPK_lib as opk
+
+infiles = sorted(glob.glob("*.opk"))
+archive_file = "" # e.g. "packs.opka" to include packs in an archive
+signature_file = "opk_signatures.json" # signatures saved here, "" to not save
+num_perm = 64 # hashes in each signature
+bands = 16 # LSH bands of num_perm // bands hashes, more bands finds less similar pairs, but more pairs to compare
+threshold = 0.5 # min estimated similarity for packs in the same cluster
+page_size = 0x100
+max_ranges = 8 # differing byte ranges listed for each pack
+max_bucket = 50 # LSH buckets with more packs are chained, not paired, to keep the no. of pairs down
+
+hash_prime = (1 << 61) - 1 # Mersenne prime for the MinHash permutations
+rnd = random.Random(1) # fixed seed, saved signatures must use the same permutations
+perms = [(rnd.randrange(1, hash_prime), rnd.randrange(hash_prime)) for i in range(num_perm)]
+
+def h64(dat): # 64 bit hash of bytes
+    return int.from_bytes(hashlib.blake2b(dat, digest_size=8).digest(), 'little')
+
+def shingles(dat): # set of hashes of the non-blank pages and the records of pack image dat
+    out = set()
+    blank = bytes([0xFF] * page_size)
+    for addr in range(0, len(dat), page_size):
+        page = bytes(dat[addr:addr+page_size])
+        if page != blank[0:len(page)]:
+            out.add(h64(b'P' + page))
+    n_rec = 0
+    try:
+        for rec in opk.walk_records(dat, limit=len(dat)):
+            if rec['kind'] in ('short','long'):
+                out.add(h64(b'R' + bytes([rec['type']]) + rec['body']))
+                n_rec += 1
+    except ValueError: # broken record chain, the records before it are kept
+        pass
+    return out, n_rec
+
+def minhash(hashes): # MinHash signature of a set of 64 bit hashes
+    if not hashes:
+        return [hash_prime] * num_perm
+    return [min((a * x + b) % hash_prime for x in hashes) for a, b in perms]
+
+def similarity(sig1, sig2): # estimated Jaccard similarity
+    return sum(1 for a, b in zip(sig1, sig2) if a == b) / num_perm
+
+class Pack(): # a pack image to cluster, from an OPK file or an archive
+    def __init__(self, key, stamp, age, loader):
+        self.key = key # name shown, also key in signature file
+        self.stamp = stamp # changes if the pack changes: file size & mtime or archive CRC
+        self.age = age # s since the epoch, for the root of a family tree, older first
+        self.loader = loader # returns pack image
+        self.sig = None
+        self.n_rec = 0
+
+def find_packs():
+    packs = []
+    for f in infiles:
+        st = os.stat(f)
+        packs.append(Pack(f, f'{st.st_size:d}:{st.st_mtime_ns:d}', st.st_mtime, lambda f=f: opk.read_opk(f)[1]))
+    if archive_file:
+        import OPK_archive
+        arc = OPK_archive.OpkArchive(archive_file)
+        for name in arc.names():
+            entry = arc.packs[name]
+            added = time.mktime(time.strptime(entry['added'], '%Y-%m-%d %H:%M:%S')) # local time, as OPK_archive.py writes it
+            packs.append(Pack(f'{archive_file:s}:{name:s}', f'{entry["crc"]:08x}', added,
+                              lambda name=name: arc.open(name).to_bytes()))
+    return packs
+
+def load_signatures(packs): # from signature_file if unchanged, else work out & save, returns no. worked out
+    saved = {}
+    if signature_file and os.path.exists(signature_file):
+        with open(signature_file) as f:
+            saved = json.load(f)
+        if saved.get('num_perm') != num_perm:
+            saved = {}
+    sigs = saved.get('packs', {})
+    new = 0
+    for p in packs:
+        s = sigs.get(p.key)
+        if s is None or s['stamp'] != p.stamp:
+            hashes, n_rec = shingles(p.loader())
+            s = {'stamp':p.stamp, 'sig':minhash(hashes), 'records':n_rec}
+            sigs[p.key] = s
+            new += 1
+        p.sig = s['sig']
+        p.n_rec = s['records']
+    if signature_file and new > 0:
+        with open(signature_file, 'w') as f:
+            json.dump({'num_perm':num_perm, 'packs':sigs}, f)
+    return new
+
+def candidate_pairs(packs): # pairs of pack indexes that share an LSH bucket
+    rows = num_perm // bands
+    pairs = set()
+    for band in range(bands):
+        buckets = {}
+        for i, p in enumerate(packs):
+            buckets.setdefault(tuple(p.sig[band*rows:(band+1)*rows]), []).append(i)
+        for members in buckets.values():
+            if len(members) > max_bucket: # e.g. many copies of one pack, a chain joins them without all the pairs
+                pairs.update(zip(members, members[1:]))
+                continue
+            for n, i in enumerate(members):
+                for j in members[n+1:]:
+                    pairs.add((i, j))
+    return pairs
+
+def find_root(parent, i): # union-find root, with path halving
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def clusters(packs, pairs): # returns list of (members, edges), edges are (similarity, i, j) of the family tree
+    edges = sorted(((similarity(packs[i].sig, packs[j].sig), i, j) for i, j in pairs), reverse=True)
+    edges = [e for e in edges if e[0] >= threshold]
+    parent = list(range(len(packs)))
+    tree = [] # maximum spanning forest, most similar pairs first (Kruskal)
+    for sim, i, j in edges:
+        ri, rj = find_root(parent, i), find_root(parent, j)
+        if ri != rj:
+            parent[ri] = rj
+            tree.append((sim, i, j))
+    groups = {}
+    for i in range(len(packs)):
+        groups.setdefault(find_root(parent, i), []).append(i)
+    out = []
+    for members in groups.values():
+        if len(members) > 1:
+            m = set(members)
+            out.append((members, [e for e in tree if e[1] in m]))
+    return sorted(out, key=lambda c: -len(c[0]))
+
+def record_keys(dat): # record (type, data) : address, for the records of pack image dat
+    keys = {}
+    try:
+        for rec in opk.walk_records(dat, limit=len(dat)):
+            if rec['kind'] in ('short','long'):
+                keys.setdefault((rec['type'], rec['body']), rec['addr'])
+    except ValueError:
+        pass
+    return keys
+
+def differences(old, new): # records only in old, records only in new, byte ranges that differ
+    k_old, k_new = record_keys(old), record_keys(new)
+    removed = sorted((a, k) for k, a in k_old.items() if k not in k_new)
+    added = sorted((a, k) for k, a in k_new.items() if k not in k_old)
+    ranges = [(a, len(d)) for a, d in opk.sparse_diff(opk.SparseImage.from_bytes(old), opk.SparseImage.from_bytes(new))]
+    return removed, added, ranges
+
+def record_text(addr, key):
+    rec_type, body = key
+    text = body[0:16].decode('latin-1')
+    text = ''.join(c if 32 <= ord(c) < 127 else '.' for c in text)
+    return f'0x{addr:04x} {opk.r_types.get(rec_type | 0x80, f"0x{rec_type:02x}"):s} {text:s}'
+
+def print_tree(packs, members, tree): # family tree from the oldest pack, with differences from the parent
+    links = {i:[] for i in members}
+    for sim, i, j in tree:
+        links[i].append((j, sim))
+        links[j].append((i, sim))
+    root = min(members, key=lambda i: (packs[i].age, packs[i].key))
+    print(f'{packs[root].key:s} ({packs[root].n_rec:d} records)')
+    stack = [(root, 1)]
+    seen = {root}
+    images = {root:packs[root].loader()}
+    while stack:
+        i, depth = stack.pop()
+        for j, sim in sorted(links[i], key=lambda l: l[1]):
+            if j in seen:
+                continue
+            seen.add(j)
+            images[j] = packs[j].loader()
+            removed, added, ranges = differences(images[i], images[j])
+            pad = '    ' * depth
+            print(f'{pad:s}{packs[j].key:s} ({packs[j].n_rec:d} records) similarity: {sim:.2f}')
+            for a, k in removed:
+                print(f'{pad:s}  - {record_text(a, k):s}')
+            for a, k in added:
+                print(f'{pad:s}  + {record_text(a, k):s}')
+            text = ', '.join(f'0x{a:04x}+{n:d}' for a, n in ranges[0:max_ranges])
+            more = f' and {len(ranges) - max_ranges:d} more' if len(ranges) > max_ranges else ''
+            print(f'{pad:s}  bytes differ: {text:s}{more:s}' if ranges else f'{pad:s}  same image')
+            stack.append((j, depth + 1))
+    for i in members: # images only needed while printing
+        images.pop(i, None)
+
+if __name__ == '__main__':
+    packs = find_packs()
+    new = load_signatures(packs)
+    print(f'Packs: {len(packs):d}, signatures worked out: {new:d}, saved: {len(packs) - new:d}')
+    pairs = candidate_pairs(packs)
+    print(f'Candidate pairs: {len(pairs):d} of {len(packs) * (len(packs) - 1) // 2:d}')
+    found = clusters(packs, pairs)
+    print(f'Clusters: {len(found):d}\n')
+    for n, (members, tree) in enumerate(found):
+        print(f'Cluster {n:d}: {len(members):d} packs')
+        print_tree(packs, members, tree)
+        print('')
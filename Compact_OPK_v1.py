@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Compact OPK file - removes deleted and bad records from a pack image
+
+Created: Oct 2026
+
+@author: martin
+
+Rampaks collect deleted records and bad short records until the pack looks full,
+this rewrites the pack image without them, keeping file IDs and record order.
+
+The write plan is the part of the pack that has to be rewritten: from the first changed byte
+to the new end of pack, plus 0xFF bytes over the old records (blank_tail).
+Use the p command of PC_Psion2_datapak_read_write to write only the plan to a Rampak.
+Datapaks can't be compacted, as the EPROM bits can't be set back to 1 without UV erasing.
+"""
+
+import OPK_lib as opk
+
+infile = "testpak.opk"
+outfile = "testpak_compact.opk"
+
+blank_tail = True # write 0xFF over the old records after the new end of pack
+
+BaudRate = 115200 # used to estimate the write time
+
+print(f'File {infile:s}:')
+size, dat = opk.read_opk(infile)
+print(f'OPK size: 0x{size:06x} {size:d}')
+
+new, removed = opk.compact_records(dat)
+new_end = len(new) - 1 # address of end of pack byte
+old_end = opk.pack_end(dat)
+
+print(f'deleted records removed: {removed["deleted"]:d}')
+print(f'long records removed: {removed["long"]:d}')
+print(f'bad short records removed: {removed["bad"]:d}')
+print(f'bytes freed: 0x{removed["bytes"]:04x} {removed["bytes"]:d}')
+print(f'pack size was: 0x{old_end:04x} {old_end:d}, now is: 0x{new_end:04x} {new_end:d}')
+
+opk.write_opk(outfile, new + bytes([0xFF]), new_end) # 2 0xFF bytes at end of image, same as OPK files from the Developer software
+print(f'Compacted pack written to: {outfile:s}')
+
+plan = opk.write_plan(dat, new, blank_tail)
+if plan is None:
+    print('Nothing to write, pack has no deleted or bad records')
+else:
+    start, plan_dat = plan
+    # each byte is sent to the Arduino and echoed back: 2 bytes of 10 bits (8 data bits, start & stop bits)
+    t_plan = len(plan_dat) * 20 / BaudRate
+    full_end = old_end if blank_tail else new_end # a full write also needs to blank the old records
+    t_full = (full_end + 1) * 20 / BaudRate
+    print(f'Write plan: 0x{len(plan_dat):04x} bytes from address 0x{start:04x} to 0x{start+len(plan_dat)-1:04x}')
+    print(f'Full write: 0x{full_end+1:04x} bytes')
+    print(f'Minimum serial time: plan {t_plan:.2f} s, full write {t_full:.2f} s')
@@ -5,45 +5,34 @@ Compare OPK files
 Created: Nov 2022
 
 @author: martin
+
+Only the populated extents of the 2 images are compared (OPK_lib.SparseImage and sparse_diff), the 0xFF runs are skipped,
+so a pack with a short data region compares in a few hundred bytes, not the whole pack.
 """
 
 import os
 # import sys
 
+import OPK_lib as opk
+
 file1 = "comms42.opk"
 # file2 = "comms42_test_7e9b.opk"
 file2 = "comms_linear_test.opk"
 
 files = [file1,file2]
 
-dat = [] # wil be a list of file data in sub-lists
+dat = [] # file data of each file, as bytes
 dat_size = []
 
 # read file data
 
 for i,f in enumerate(files): # i is index, f is file - read all files in list
     print(f'File {i:d}: {files[i]}')
-    dat.append([]) # add new blank list for each file
-    # fs = os.path.getsize(f)
-    # print(f'File size is: {fs:d} bytes')
-    # fid = open(f,'rb')
+    fs = os.path.getsize(f)
+    print(f'File size: {fs:d}')
     with open(f,'rb') as fid:
-        fid.seek(0,2)      # go to the file end, 2-rel. to end
-        fs = fid.tell()   # get the end of file location
-        fid.seek(0,0)      # go back to file beginning, 0-abs
-        print(f'File size: {fs:d}')        
-        eof = False
-        addr = 0
-        # fs = 5
-        while not eof:
-            b = fid.read(1)
-            # print(addr, b)
-            dat[i].append(b) # fill list with bytes read from file
-            addr += 1
-            if addr == fs:
-                eof = True
-    d = dat[i]
-    ds = len(d)
+        dat.append(fid.read())
+    ds = len(dat[i])
     print(f'bytes read: {ds:d} 0x{ds:06X}\n')
     dat_size.append(ds)
     
@@ -55,31 +44,30 @@ dat_sz_min = min(dat_size)
 # add = []
 dd = [0,0] # blank list for numeric data of 2 files
 dc = [0,0] # blank list for character data of 2 files
-start = 6 # start address for comparison
-for addr in range(start,dat_sz_min): # for each address
-    for i in range(2): # for each file
-        d = dat[i][addr]
-        dd[i] = ord(d) # convert bytes type to number type
-        dc[i] = dd[i] # holds byte to be used as a printable character
-        if 127 < dd[i] or dd[i] < 32:
-            dc[i] = 46 # '.' make char a dot, if not printable
-        dc[i] = chr(dc[i]) # convert to char
-    
-    if dd[0] != dd[1]: # print address of differences
-        print(f'files differ at addr:0x{addr:04x} File0:0x{dd[0]:02x} {dc[0]:s} File1:0x{dd[1]:02x} {dc[1]:s}')
-        # add.append(addr)
+start = 6 # start address for comparison, after the OPK header
+images = [opk.SparseImage.from_bytes(d[start:dat_sz_min]) for d in dat] # extents of each image, up to the shorter file
+for ext_addr, new in opk.sparse_diff(images[0], images[1]): # only the ranges that differ
+    for addr in range(start + ext_addr, start + ext_addr + len(new)): # for each address in the range
+        for i in range(2): # for each file
+            dd[i] = dat[i][addr]
+            dc[i] = dd[i] # holds byte to be used as a printable character
+            if 127 < dd[i] or dd[i] < 32:
+                dc[i] = 46 # '.' make char a dot, if not printable
+            dc[i] = chr(dc[i]) # convert to char
+        
+        if dd[0] != dd[1]: # print address of differences
+            print(f'files differ at addr:0x{addr:04x} File0:0x{dd[0]:02x} {dc[0]:s} File1:0x{dd[1]:02x} {dc[1]:s}')
+            # add.append(addr)
 
 # sys.exit() # stop program here
 
 f_num = 0 # choose file for hex dump, 0 or 1
-data = dat[f_num][start::]
+data = bytearray(dat[f_num][start::])
 check_blank = False
 
 print(f'\nFile: {files[f_num]}')
 
-header = [] 
-for i in range(6):
-    header.append(ord(data[i]))
+header = list(dat[f_num][0:6]) # OPK header
 
 print('OPK Header:',header)
 size_hh = header[3]
@@ -100,9 +88,9 @@ file_len = 256
 
 
 l = (file_len-1) // 16 # div (no. of complete 16's in file_len)
-n = 15 - (file_len % 16) # fill in rest of 16 with zero's - just for printing
-for i in range(n):
-    data.append(0)
+n = (l + 1) * 16 - len(data) # fill in rest of the lines with zero's - just for printing
+if n > 0:
+    data += bytes(n)
     
 addr = 0
 ext = False # exit flag
@@ -110,7 +98,7 @@ for j in range(l+1): # no. of sets 16 bytes
     out = '' # init blank text string to be output with hex dump
     dat2 = []
     for k in range(16):
-        c = ord(data[addr])
+        c = data[addr]
         if check_blank == True and c != 0xFF:
             print(f'Non 0xFF byte: {c:02x} found at {addr:04x}')
             ext = True
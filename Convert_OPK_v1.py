@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Convert OPK files to structured data (CSV, JSON or SQLite) and back again
+
+Created: Oct 2026
+
+@author: martin
+
+Export writes a directory for each OPK file:
+    manifest.jsonl - pack ID bytes on the first line, then one line per record in pack order
+    data/NAME_ID.csv or .jsonl - one row per datafile record, tab separated fields split into columns
+    blocks/TYPE_NAME_ADDR.bin - long records of block files (OPL procedures, diary, notes etc.) as blobs
+    pack.sqlite - records and fields tables, if fmt is 'sqlite' (instead of the data files)
+
+The records are streamed one at a time from the OPK file, so memory use doesn't depend on the pack size,
+and export_files converts a list of OPK files in parallel processes.
+Import rebuilds the OPK file from manifest.jsonl and the blobs.
+
+Text is decoded as latin-1, so every byte value is kept.
+"""
+
+import csv
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import OPK_lib as opk
+
+def safe_name(name): # filename safe version of a pack file name
+    return ''.join(c if c.isalnum() or c in '$%_-' else '_' for c in name.strip()) or 'noname'
+
+def export_opk(infile, out_dir, fmt='csv'): # stream records of infile to out_dir, fmt is 'csv', 'json' or 'sqlite'
+    if fmt not in ('csv','json','sqlite'):
+        raise ValueError(f'Unknown export format: {fmt}')
+    os.makedirs(os.path.join(out_dir,'blocks'), exist_ok=True)
+    if fmt != 'sqlite':
+        os.makedirs(os.path.join(out_dir,'data'), exist_ok=True)
+    df_name = {} # datafile ID: name
+    data_out = {} # datafile ID: (file, csv writer or None for json lines)
+    block_name = 'noname' # name of last block file header, for its long record
+    counts = {'records':0, 'data':0, 'blocks':0}
+    db = None
+    if fmt == 'sqlite':
+        db_file = os.path.join(out_dir,'pack.sqlite')
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        db = sqlite3.connect(db_file)
+        db.execute('CREATE TABLE records (addr INTEGER PRIMARY KEY, kind TEXT, type INTEGER, deleted INTEGER, file TEXT, body BLOB)')
+        db.execute('CREATE TABLE fields (addr INTEGER, file TEXT, field INTEGER, value TEXT)')
+    try:
+        with open(infile,'rb') as fid, open(os.path.join(out_dir,'manifest.jsonl'),'w') as man:
+            header = fid.read(opk.OPK_header_len + opk.rec_start)
+            if header[0:3] != b'OPK':
+                raise ValueError(f'{infile:s} is not an OPK file!')
+            man.write(json.dumps({'pack':os.path.basename(infile), 'id_bytes':header[opk.OPK_header_len:].hex()}) + '\n')
+            for rec in opk.read_records(fid):
+                line = {'addr':rec['addr'], 'kind':rec['kind']}
+                if rec['kind'] == 'end':
+                    man.write(json.dumps(line) + '\n')
+                    break
+                counts['records'] += 1
+                line['type'] = rec['type']
+                line['deleted'] = rec['deleted']
+                file_s = ''
+                if rec['kind'] == 'bad':
+                    line['len_byte'] = rec['len_byte']
+                elif rec['kind'] == 'long':
+                    blob = f'{block_name:s}_{rec["addr"]:04x}.bin'
+                    with open(os.path.join(out_dir,'blocks',blob),'wb') as f_blob:
+                        f_blob.write(rec['body'])
+                    line['blob'] = 'blocks/' + blob
+                    file_s = block_name
+                    counts['blocks'] += 1
+                else: # short record
+                    r_type = rec['type'] | 0x80 # could be deleted
+                    text = rec['body'].decode('latin-1')
+                    if r_type == 0x81 and rec['len'] >= 9: # datafile name and ID
+                        df_name[rec['body'][8]] = text[0:8].strip()
+                        file_s = text[0:8].strip()
+                    elif 0x82 <= r_type <= 0x8F: # block file header, long record follows
+                        block_name = opk.r_types.get(r_type,f'{r_type:02x}') + '_' + safe_name(text[0:8])
+                        file_s = text[0:8].strip()
+                    elif r_type >= 0x90: # datafile record, tab separated fields
+                        fields = text.split('\t')
+                        line['fields'] = fields
+                        file_s = df_name.get(r_type,'')
+                        counts['data'] += 1
+                        if db is not None:
+                            db.executemany('INSERT INTO fields VALUES (?,?,?,?)',
+                                           [(rec['addr'], file_s, n, f) for n, f in enumerate(fields)])
+                        else:
+                            if r_type not in data_out: # open output for each datafile when 1st record arrives
+                                name = f'{safe_name(file_s):s}_{r_type:02x}'
+                                if fmt == 'csv':
+                                    f_data = open(os.path.join(out_dir,'data',name+'.csv'),'w',newline='',encoding='latin-1')
+                                    data_out[r_type] = (f_data, csv.writer(f_data))
+                                else:
+                                    f_data = open(os.path.join(out_dir,'data',name+'.jsonl'),'w')
+                                    data_out[r_type] = (f_data, None)
+                            f_data, writer = data_out[r_type]
+                            if writer is not None:
+                                writer.writerow(['y' if rec['deleted'] else 'n'] + fields) # 1st column is deleted?
+                            else:
+                                f_data.write(json.dumps({'addr':rec['addr'], 'deleted':rec['deleted'], 'fields':fields}) + '\n')
+                    if 'fields' not in line:
+                        line['text'] = text
+                if file_s:
+                    line['file'] = file_s
+                if db is not None:
+                    db.execute('INSERT INTO records VALUES (?,?,?,?,?,?)',
+                               (rec['addr'], rec['kind'], rec['type'], rec['deleted'], file_s, rec['body']))
+                man.write(json.dumps(line) + '\n')
+    finally:
+        for f_data, writer in data_out.values():
+            f_data.close()
+        if db is not None:
+            db.commit()
+            db.close()
+    return counts
+
+def _export_one(args): # for ProcessPoolExecutor, returns (infile, counts or error string)
+    infile, out_dir, fmt = args
+    try:
+        return infile, export_opk(infile, out_dir, fmt)
+    except (OSError, ValueError) as err:
+        return infile, str(err)
+
+def export_files(infiles, out_root, fmt='csv', workers=None): # export a list of OPK files in parallel, to out_root/<file name>
+    jobs = [(f, os.path.join(out_root, os.path.splitext(os.path.basename(f))[0]), fmt) for f in infiles]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for infile, result in ex.map(_export_one, jobs):
+            yield infile, result
+
+def import_opk(in_dir, outfile): # rebuild an OPK file from an export directory, one record at a time
+    with open(os.path.join(in_dir,'manifest.jsonl')) as man, opk.OpkWriter(outfile) as f_out: # outfile only written if complete
+        pack = json.loads(man.readline())
+        f_out.write(bytes.fromhex(pack['id_bytes']))
+        addr = opk.rec_start
+        for line in man:
+            rec = json.loads(line)
+            if rec['kind'] == 'end':
+                break
+            if rec['kind'] == 'bad':
+                out = bytes([rec['len_byte'], 0xFF])
+            elif rec['kind'] == 'long':
+                with open(os.path.join(in_dir, rec['blob']),'rb') as f_blob:
+                    body = f_blob.read()
+                out = bytes([0x02, rec['type'], (len(body) & 0xFF00) >> 8, len(body) & 0xFF]) + body
+            else: # short record
+                if 'fields' in rec:
+                    body = '\t'.join(rec['fields']).encode('latin-1')
+                else:
+                    body = rec['text'].encode('latin-1')
+                if len(body) > 0xFE:
+                    raise ValueError(f'Record at 0x{addr:04x} is too long for a short record!')
+                out = bytes([len(body), rec['type']]) + body
+            f_out.write(out)
+            addr += len(out)
+        f_out.write(bytes([0xFF, 0xFF])) # end of pack, 2 0xFF bytes same as the Developer software
+        f_out.close(addr) # size is address of end of pack byte
+    return addr
+
+if __name__ == '__main__':
+    infiles = ["comms42.opk","rampak_colours.opk","testpak.opk"]
+    out_root = "export"
+    fmt = 'csv' # 'csv', 'json' or 'sqlite'
+
+    for infile, result in export_files(infiles, out_root, fmt):
+        if isinstance(result, str):
+            print(f'{infile:s}: Error! {result:s}')
+        else:
+            print(f'{infile:s}: records: {result["records"]:d}, datafile records: {result["data"]:d}, blocks: {result["blocks"]:d}')
+
+    # check round trip
+    for infile in infiles:
+        in_dir = os.path.join(out_root, os.path.splitext(os.path.basename(infile))[0])
+        test_file = os.path.join(in_dir, 'import_test.opk')
+        size = import_opk(in_dir, test_file)
+        orig_size, orig = opk.read_opk(infile)
+        new_size, new = opk.read_opk(test_file)
+        same = orig[0:orig_size+1] == new[0:new_size+1]
+        print(f'{infile:s}: imported size: 0x{size:04x}, {"matches" if same else "differs from"} original')
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Image a stack of packs - read each pack over the serial link, while the packs already read are checked and stored
+
+Created: Oct 2026
+
+@author: martin
+
+The read is the slow part, so it runs on its own and the rest is a pipeline of worker threads, one for each stage,
+joined by queues of at most queue_size packs. While pack N+1 is being read, pack N goes through:
+    verify - OPK file read back from disk, page CRCs checked against the .crc file written during the read, SHA-1
+    header - ID bytes: flags, size byte and the checksum of bytes 0 to 7 (as Read_OPK_v4.py), if set
+    parse - record walk (OPK_lib.walk_records): files, records, end of pack, the salvage scan if the record chain breaks
+    catalogue - one JSON line per pack in catalogue_file
+    archive - pack added to archive_file (OPK_archive.py), the index is written after each pack
+    report - one line for each pack, with any problems found
+If a stage falls queue_size packs behind, the next read waits for it, so memory use stays bounded.
+
+After each read the operator is asked to insert the next pack and press Enter (q and Enter to finish).
+The PC's directory cache is cleared for each new pack (the r command always sizes the pack again), and if a pack has the
+same ID bytes as the last one the operator is asked to confirm the read, in case the pack wasn't changed.
+The Arduino is set to the addressing mode of each pack from its ID byte (auto_addr, Link.auto_addr_mode()), so a stack
+can mix paged and linear packs. The link to the Arduino stays in the command loop between packs. With emulate = True the packs in emulated_packs
+are put in the emulator one after another, with no prompts, to try it without the hardware.
+At the end the time each stage was busy is printed, the read time should be most of the total.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+import OPK_lib as opk
+import Psion2_link
+import Psion2_transport
+from OPK_archive import OpkArchive
+
+SerialPort = 'COM3' # Windows type port name, could be COM4 etc.
+# SerialPort = '/dev/ttyUSB0' # Linux type port name, could be ttyUSB1 etc.
+BaudRate = 115200 # must match Arduino value
+emulate = True # True to read emulated_packs from the emulator instead of SerialPort
+emulated_packs = sorted(glob.glob("*.opk"))
+
+out_dir = "images" # OPK file of each pack read, with its .crc file
+name_format = "pack_{:03d}.opk" # file name of each pack, from the pack no.
+archive_file = "packs.opka" # "" to not archive
+catalogue_file = "catalogue.jsonl" # "" for no catalogue
+queue_size = 2 # packs waiting for each stage
+auto_addr = True # set paged or linear addressing from the ID byte of each pack, and check its first 2 pages before the read
+page_size = 0x100
+pack_sizes = (1, 2, 4, 8, 16) # valid size bytes, 8 kB each
+
+class Stage(threading.Thread): # worker thread, takes packs from inq, runs func on each one, puts them on outq
+    def __init__(self, name, func, inq, outq=None):
+        super().__init__(daemon=True)
+        self.name = name
+        self.func = func
+        self.inq = inq
+        self.outq = outq
+        self.busy = 0.0 # s spent in func
+
+    def run(self):
+        while True:
+            job = self.inq.get()
+            if job is None: # no more packs, pass it on
+                if self.outq is not None:
+                    self.outq.put(None)
+                return
+            t_start = time.time()
+            if 'dat' in job or self.name == 'verify': # later stages need the image
+                try:
+                    self.func(job)
+                except Exception as err: # recorded for the report, the pack carries on down the pipeline
+                    job['problems'].append(f'{self.name:s}: {type(err).__name__}: {err}')
+            self.busy += time.time() - t_start
+            if self.outq is not None:
+                self.outq.put(job)
+
+def stage_verify(job):
+    size, dat = opk.read_opk(job['file'])
+    crc_file = job['file'] + '.crc'
+    if os.path.exists(crc_file):
+        bad = opk.check_crcs(dat, opk.read_crc_file(crc_file), page_size)
+        if bad:
+            job['problems'].append('page CRCs differ at ' + ', '.join(f'0x{a:04x}' for a in bad))
+    job['size'] = size
+    job['sha1'] = hashlib.sha1(dat).hexdigest()
+    job['dat'] = dat
+
+def stage_header(job):
+    dat = job['dat']
+    if len(dat) < opk.rec_start:
+        job['problems'].append('no ID bytes')
+        return
+    id_b = dat[0]
+    job['id'] = {'id_byte':f'0x{id_b:02x}', 'size_kb':dat[1] * 8, 'rampak':not id_b & 0x02, 'paged':bool(id_b & 0x04),
+                 'write_protected':not id_b & 0x08, 'bootable':not id_b & 0x10}
+    if id_b & 0x01:
+        job['problems'].append('ID byte: not a valid MK II pack')
+    if dat[1] not in pack_sizes:
+        job['problems'].append(f'size byte 0x{dat[1]:02x} is not a pack size')
+    chk = sum((dat[i] << 8) + dat[i+1] for i in range(0, 8, 2)) & 0xFFFF
+    stored = (dat[8] << 8) + dat[9]
+    job['id']['checksum'] = 'not set' if stored == 0xFFFF else 'ok' if stored == chk else 'bad'
+    if job['id']['checksum'] == 'bad': # 0xFFFF is left by a write without update_checksum
+        job['problems'].append(f'ID checksum 0x{stored:04x}, worked out 0x{chk:04x}')
+
+def stage_parse(job):
+    dat = job['dat']
+    files = {0x90:{'name':'MAIN', 'records':0}} # datafile ID: name & no. of records
+    blocks = [] # block file names
+    counts = {'short':0, 'long':0, 'bad':0, 'deleted':0}
+    try:
+        recs = list(opk.walk_records(dat, limit=len(dat)))
+    except ValueError as err: # broken chain, count what the salvage scan finds
+        job['problems'].append(str(err))
+        recs = [rec for rec in opk.salvage_records(dat) if rec['kind'] != 'break']
+    for rec in recs:
+        if rec['kind'] == 'end':
+            job['end'] = rec['addr']
+            break
+        counts[rec['kind']] += 1
+        counts['deleted'] += rec['kind'] != 'bad' and rec['deleted']
+        r_type = rec['type'] | 0x80
+        if rec['kind'] == 'short' and r_type == 0x81 and rec['len'] >= 9:
+            files[rec['body'][8]] = {'name':rec['body'][0:8].decode('latin-1').strip(), 'records':0}
+        elif rec['kind'] == 'short' and 0x82 <= r_type <= 0x8F and rec['len'] >= 8:
+            blocks.append(f'{rec["body"][0:8].decode("latin-1").strip()}.{opk.r_types.get(r_type, f"0x{r_type:02x}")}')
+        elif rec['kind'] == 'short' and r_type in files:
+            files[r_type]['records'] += 1
+    job['records'] = counts
+    job['files'] = {f'0x{k:02x}':v for k, v in files.items()}
+    job['blocks'] = blocks
+    if job.get('end') != job['size']:
+        job['problems'].append(f'end of pack 0x{job.get("end", 0):04x}, OPK size 0x{job["size"]:04x}')
+
+def stage_catalogue(job):
+    if not catalogue_file:
+        return
+    entry = {k:job.get(k) for k in ('pack','file','read_time','size','sha1','id','records','files','blocks','problems')}
+    with open(catalogue_file, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def stage_archive(job):
+    if archive is None:
+        return
+    archive.add(os.path.basename(job['file']), job['dat'], job['size'])
+    archive.write_index() # so the packs so far are kept if the session is stopped
+
+def report(job):
+    job.pop('dat', None) # done with the image
+    recs = job.get('records', {})
+    line = (f'(PC) Pack {job["pack"]:d} {os.path.basename(job["file"]):s}: size 0x{job.get("size", 0):04x}, '
+            f'records: {recs.get("short", 0) + recs.get("long", 0):d}, files: {len(job.get("files", {})) + len(job.get("blocks", [])):d}')
+    print(line + (', problems: ' + '; '.join(job['problems']) if job['problems'] else ', ok'))
+
+def read_pack(link, outfile): # r command, returns pack size or None
+    try:
+        link.command('r', 'XXRead')
+    except Psion2_link.LinkError as err:
+        link.fail(err)
+        return None
+    size = link.read_pak(outfile, crc_sidecar=True)
+    if size is not None:
+        link.expect('(Ard) Size of pack')
+    return size
+
+if __name__ == '__main__':
+    os.makedirs(out_dir, exist_ok=True)
+    archive = OpkArchive(archive_file, 'a') if archive_file else None
+    funcs = [('verify', stage_verify), ('header', stage_header), ('parse', stage_parse),
+             ('catalogue', stage_catalogue), ('archive', stage_archive), ('report', report)]
+    queues = [queue.Queue(queue_size) for f in funcs]
+    stages = [Stage(name, func, queues[n], queues[n+1] if n + 1 < len(funcs) else None) for n, (name, func) in enumerate(funcs)]
+    for stage in stages:
+        stage.start()
+
+    if emulate:
+        import Psion2_emulator
+        emu, ser = Psion2_emulator.open_emulator(b'', datapak_mode=False, addr_faults=True)
+    else:
+        emu, ser = None, Psion2_transport.open_port(SerialPort, BaudRate)
+    link = Psion2_link.Link(ser, verbose=False)
+    t_all = time.time()
+    t_read = 0.0
+    n = 0
+    n_emu = 0 # next of emulated_packs
+    ids_last = None
+    while True:
+        if emu is not None:
+            if n_emu >= len(emulated_packs):
+                break
+            emu.insert_pack(opk.read_opk(emulated_packs[n_emu])[1])
+            n_emu += 1
+        elif input(f'(PC) Insert pack {n:d} and press Enter, or q and Enter to finish: ').strip().lower() == 'q':
+            break
+        link.invalidate() # new pack, even if the ID bytes are the same
+        ids = link.read_range(0, 10)
+        if ids is not None and ids == ids_last:
+            print('(PC) Same ID bytes as the last pack, was the pack changed?')
+            if emu is None and input('(PC) Read it anyway, y and Enter: ').strip().lower() != 'y':
+                continue
+        ids_last = ids
+        if auto_addr and not link.auto_addr_mode():
+            print(f'(PC) Pack {n:d} not read, try again')
+            continue
+        outfile = os.path.join(out_dir, name_format.format(n))
+        t_start = time.time()
+        size = read_pack(link, outfile)
+        t_read += time.time() - t_start
+        if size is None:
+            print(f'(PC) Read of pack {n:d} failed, try again')
+            continue
+        print(f'(PC) Pack {n:d} read to {outfile:s}, 0x{size:04x} bytes, {time.time() - t_start:.1f} s')
+        queues[0].put({'pack':n, 'file':outfile, 'read_time':round(time.time() - t_start, 3), 'problems':[]}) # waits if the pipeline is full
+        n += 1
+    queues[0].put(None)
+    for stage in stages:
+        stage.join()
+    t_all = time.time() - t_all
+    if archive is not None:
+        archive.close()
+    if emu is not None:
+        emu.stop()
+    ser.close()
+    print(f'\n(PC) {n:d} packs in {t_all:.2f} s, reading: {t_read:.2f} s')
+    for stage in stages:
+        print(f'(PC) {stage.name:9s} busy: {stage.busy:.3f} s')
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+OPK archive - many pack images in one file, compressed a block at a time, with a central index
+
+Created: Oct 2026
+
+@author: martin
+
+Archive file format:
+    "OPKA" + version byte
+    compressed blocks of each pack image (block_size bytes of image, last block can be shorter)
+    index - zlib compressed JSON, one entry per pack: name, OPK size, image length, block size, method,
+            file offset, compressed length & CRC-32 of each block (null for a block that is all 0xFF, nothing stored)
+    footer - "OPKI" + index offset (8 bytes), index length & index CRC-32 (4 bytes each), little endian
+
+Any byte range of any pack is read by decompressing only the blocks it covers, with the same read API as
+OPK_lib.OpkImage for a loose OPK file (read, [], to_bytes, records, hex_dump).
+
+Writes are append only: new blocks are written after the end of the file, then a new index and footer.
+If a write is interrupted the last good footer is found by searching back from the end of the file.
+A pack added with the name of an existing pack replaces it in the index (the old blocks stay in the file).
+"""
+
+import glob
+import json
+import lzma
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+
+import OPK_lib as opk
+
+magic = b'OPKA\x01'
+footer_magic = b'OPKI'
+footer_format = '<4sQII' # magic, index offset, index length, index crc
+footer_len = struct.calcsize(footer_format)
+block_size = 0x1000 # 16 pages of 256 bytes, bigger blocks compress better, smaller blocks are quicker to read
+cache_blocks = 16 # decompressed blocks kept for each open image
+
+lzma_filters = [{'id':lzma.FILTER_LZMA2, 'preset':6}]
+
+def compress(dat, method): # raw streams, no headers, as the index has the lengths & CRCs
+    if method == 'zlib':
+        c = zlib.compressobj(9, zlib.DEFLATED, -15)
+        return c.compress(dat) + c.flush()
+    if method == 'lzma':
+        return lzma.compress(dat, format=lzma.FORMAT_RAW, filters=lzma_filters)
+    if method == 'none':
+        return bytes(dat)
+    raise ValueError(f'Unknown compression method: {method}')
+
+def decompress(dat, method):
+    if method == 'zlib':
+        return zlib.decompress(dat, -15)
+    if method == 'lzma':
+        return lzma.decompress(dat, format=lzma.FORMAT_RAW, filters=lzma_filters)
+    return dat
+
+class ArchiveImage(opk.OpkImage): # one pack in an archive, same read API as OpkImage
+    def __init__(self, archive, entry):
+        self.archive = archive
+        self.entry = entry
+        self.name = entry['name']
+        self.size = entry['size']
+        self.length = entry['length']
+        self.cache = OrderedDict() # block no.: decompressed block, least recently used first
+
+    def block(self, n): # decompressed block n
+        if n in self.cache:
+            self.cache.move_to_end(n)
+            return self.cache[n]
+        b_size = self.entry['block_size']
+        b_len = min(b_size, self.length - n * b_size)
+        loc = self.entry['blocks'][n]
+        if loc is None: # blank block, not stored
+            dat = bytes([0xFF] * b_len)
+        else:
+            offset, c_len, crc = loc
+            dat = decompress(self.archive.read_at(offset, c_len), self.entry['method'])
+            if len(dat) != b_len or zlib.crc32(dat) != crc:
+                raise ValueError(f'{self.name:s}: block {n:d} is damaged!')
+        self.cache[n] = dat
+        if len(self.cache) > cache_blocks:
+            self.cache.popitem(last=False)
+        return dat
+
+    def read(self, addr, length): # bytes from addr, fewer if past the end of the image
+        length = max(0, min(length, self.length - addr))
+        b_size = self.entry['block_size']
+        out = bytearray()
+        while len(out) < length:
+            n, offset = divmod(addr + len(out), b_size)
+            out += self.block(n)[offset:offset + length - len(out)]
+        return bytes(out)
+
+    def close(self):
+        self.cache.clear()
+
+class OpkArchive(): # archive of pack images, mode 'r' to read, 'a' to read & append (file created if needed)
+    def __init__(self, filename, mode='r'):
+        if mode not in ('r','a'):
+            raise ValueError(f'Unknown archive mode: {mode}')
+        self.filename = filename
+        self.mode = mode
+        self.packs = {} # name: index entry
+        self.changed = False
+        if mode == 'a' and not os.path.exists(filename):
+            with open(filename,'wb') as f_new:
+                f_new.write(magic)
+        self.fid = open(filename,'rb' if mode == 'r' else 'r+b')
+        if self.fid.read(len(magic)) != magic:
+            self.fid.close()
+            raise ValueError(f'{filename:s} is not an OPK archive!')
+        self.read_index()
+
+    def read_at(self, offset, length):
+        self.fid.seek(offset)
+        return self.fid.read(length)
+
+    def read_index(self): # index from the last good footer
+        self.fid.seek(0, os.SEEK_END)
+        end = self.fid.tell()
+        if end == len(magic): # new archive
+            return
+        if self.load_index(self.read_at(end - footer_len, footer_len), end - footer_len):
+            return
+        dat = self.read_at(0, end) # interrupted write, search back from end of file for last good footer
+        pos = dat.rfind(footer_magic, len(magic))
+        while pos >= 0:
+            if self.load_index(dat[pos:pos+footer_len], pos):
+                return
+            pos = dat.rfind(footer_magic, len(magic), pos + len(footer_magic) - 1)
+        raise ValueError(f'{self.filename:s}: no index found, archive is damaged!')
+
+    def load_index(self, footer, pos): # read index if footer at pos is good, returns True if loaded
+        if len(footer) != footer_len or footer[0:4] != footer_magic:
+            return False
+        marker, offset, length, crc = struct.unpack(footer_format, footer)
+        if offset + length != pos:
+            return False
+        index = self.read_at(offset, length)
+        if zlib.crc32(index) != crc:
+            return False
+        for entry in json.loads(zlib.decompress(index))['packs']:
+            self.packs[entry['name']] = entry
+        return True
+
+    def names(self):
+        return list(self.packs)
+
+    def __contains__(self, name):
+        return name in self.packs
+
+    def __len__(self):
+        return len(self.packs)
+
+    def open(self, name): # pack image with OpkImage read API
+        return ArchiveImage(self, self.packs[name])
+
+    def add(self, name, dat, size, method='zlib', b_size=block_size): # append pack image dat, size from OPK header
+        if self.mode != 'a':
+            raise ValueError('Archive not opened for append!')
+        self.fid.seek(0, os.SEEK_END)
+        blocks = []
+        for addr in range(0, len(dat), b_size):
+            block = bytes(dat[addr:addr+b_size])
+            if block.count(0xFF) == len(block): # blank, nothing stored
+                blocks.append(None)
+                continue
+            c_dat = compress(block, method)
+            blocks.append([self.fid.tell(), len(c_dat), zlib.crc32(block)])
+            self.fid.write(c_dat)
+        self.packs[name] = {'name':name, 'size':size, 'length':len(dat), 'block_size':b_size, 'method':method,
+                            'blocks':blocks, 'crc':zlib.crc32(bytes(dat)), 'added':time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.changed = True
+
+    def add_file(self, filename, name=None, method='zlib'): # append an OPK file, name defaults to the file name
+        size, dat = opk.read_opk(filename)
+        self.add(name or os.path.basename(filename), dat, size, method)
+
+    def extract(self, name, filename): # write a pack to an OPK file
+        image = self.open(name)
+        opk.write_opk(filename, image.to_bytes(), image.size)
+
+    def write_index(self): # new index & footer at end of file, the previous index is left in place
+        index = zlib.compress(json.dumps({'packs':list(self.packs.values())}).encode())
+        self.fid.seek(0, os.SEEK_END)
+        offset = self.fid.tell()
+        self.fid.write(index)
+        self.fid.write(struct.pack(footer_format, footer_magic, offset, len(index), zlib.crc32(index)))
+        self.fid.flush()
+        os.fsync(self.fid.fileno())
+        self.changed = False
+
+    def close(self):
+        if self.changed:
+            self.write_index()
+        self.fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    archive_file = "packs.opka"
+    infiles = sorted(glob.glob("*.opk"))
+    method = 'zlib' # 'zlib', 'lzma' or 'none'
+
+    with OpkArchive(archive_file,'a') as arc:
+        for infile in infiles:
+            arc.add_file(infile, method=method)
+    loose = sum(os.path.getsize(f) for f in infiles)
+    print(f'{len(infiles):d} OPK files, {loose:d} bytes, archive: {os.path.getsize(archive_file):d} bytes')
+
+    with OpkArchive(archive_file) as arc:
+        for name in arc.names():
+            image = arc.open(name)
+            try:
+                recs = list(image.records())
+                print(f'{name:s}: OPK size: 0x{image.size:04x}, records: {len(recs)-1:d}, end of pack: 0x{recs[-1]["addr"]:04x}')
+            except ValueError as err:
+                print(f'{name:s}: OPK size: 0x{image.size:04x}, {err}')
+            with opk.OpkImage(name) as f_image: # same image as loose file
+                if f_image.to_bytes() != image.to_bytes():
+                    print(f'{name:s}: differs from {name:s}!')
+        image = arc.open(infiles[0])
+        print(f'{infiles[0]:s} ID bytes: {image[0:10].hex()}')
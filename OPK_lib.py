@@ -0,0 +1,677 @@
+# -*- coding: utf-8 -*-
+"""
+OPK library - functions shared by the OPK file tools
+
+Created: Oct 2026
+
+@author: martin
+
+OPK file format: "OPK" + 3 size bytes (high, middle, low) + pack image
+the size is the address of the end of pack 0xFF byte, found by sizing the pack
+the pack image starts with 10 ID bytes, then the records from address 0x0A
+
+record format:
+short record - length byte, type byte, then length bytes of data
+long record - 0x02, 0x80, then 2 bytes of length (high, low) followed by the data
+bad short record - length byte, type byte 0xFF
+end of pack - length byte 0xFF
+
+OpkWriter writes an OPK file a page at a time to a temporary file, renamed to the OPK file only when complete,
+so a failed or interrupted read never leaves a short OPK file that looks like a small pack.
+The optional .crc sidecar file has a CRC-32 for each page: "address crc" in hex, one line per page.
+The .vote sidecar file of a recovery read lists the bytes that weren't the same in every read of their page:
+"address confidence voted values read", one line per byte, empty if every byte read the same each time.
+
+OpkImage reads a pack image from an OPK file a range at a time, OPK_archive.py has the same read API for packs in an archive.
+
+file_header(), data_record() and long_record() build the bytes of new records, e.g. to append to a pack.
+
+SparseImage holds a pack image as extents of data, the 0xFF runs between them (min_run bytes or longer) are not stored,
+so a 32k pack with a short data region is a few hundred bytes, and writes, dumps and diffs only touch the extents.
+"""
+
+import os
+import re
+import zlib
+
+OPK_header_len = 6 # "OPK" + 3 size bytes
+rec_start = 0x0A # records start after ID bytes at address 10
+max_pack_size = 0x10000 # 64k max, larger packs use segmented addressing
+
+r_types = {0x80:'long',0x81:'data',0x82:'diary',0x83:'OPL',0x84:'comms',0x85:'sheet',0x86:'pager',0x87:'notes'}
+
+def opk_header(size): # returns 6 byte OPK header for pack size
+    return b'OPK' + bytes([(size & 0xFF0000) >> 16, (size & 0xFF00) >> 8, size & 0xFF])
+
+def read_opk(filename): # read OPK file, returns pack size from OPK header and pack image (without OPK header) as a bytearray
+    with open(filename,'rb') as fid:
+        header = fid.read(OPK_header_len)
+        if header[0:3] != b'OPK':
+            raise ValueError(f'{filename:s} is not an OPK file!')
+        size = (header[3] << 16) + (header[4] << 8) + header[5] # shift size_hh left 16 bits, size_h left 8 bits
+        dat = bytearray(fid.read())
+    return size, dat
+
+def write_opk(filename, dat, size): # write OPK header for size, then pack image dat
+    with open(filename,'wb') as f_out:
+        f_out.write(opk_header(size))
+        f_out.write(dat)
+
+def page_crcs(dat, page_size=0x100): # CRC-32 of each page of pack image dat, returns list of (address, crc)
+    return [(addr, zlib.crc32(dat[addr:addr+page_size])) for addr in range(0, len(dat), page_size)]
+
+def read_crc_file(filename): # read .crc sidecar file, returns list of (address, crc)
+    with open(filename) as fid:
+        return [tuple(int(v, 16) for v in line.split()) for line in fid if line.strip()]
+
+def check_crcs(dat, crcs, page_size=0x100): # returns list of page addresses of dat that don't match the sidecar crcs
+    return [addr for addr, crc in crcs if zlib.crc32(dat[addr:addr+page_size]) != crc]
+
+def vote_reads(reads): # bit by bit majority vote of several reads of the same bytes, returns voted bytes and unstable list
+    # unstable is a list of (offset, confidence, voted value, values read) for the bytes that weren't the same in every read,
+    # confidence is the share of reads that agree with the vote for the least sure bit. A tie votes 0, as a weak EPROM bit
+    # reads 1 when it loses charge, but a blank bit never reads 0
+    out = bytearray(reads[0])
+    unstable = []
+    if all(r == reads[0] for r in reads[1:]):
+        return out, unstable
+    n = len(reads)
+    for i, values in enumerate(zip(*reads)):
+        if values.count(values[0]) == n:
+            continue
+        voted = 0
+        agree = n
+        for bit in range(8):
+            ones = sum((v >> bit) & 1 for v in values)
+            if ones * 2 > n:
+                voted |= 1 << bit
+            agree = min(agree, max(ones, n - ones))
+        out[i] = voted
+        unstable.append((i, agree / n, voted, values))
+    return out, unstable
+
+def write_vote_file(filename, unstable): # .vote sidecar file: address, confidence, voted value & values read of each unstable byte
+    with open(filename, 'w') as fid:
+        for addr, conf, voted, values in unstable:
+            fid.write(f'{addr:04x} {conf:.2f} {voted:02x} ' + ' '.join(f'{v:02x}' for v in values) + '\n')
+
+def read_vote_file(filename): # read .vote sidecar file, returns list of (address, confidence, voted value, values read)
+    out = []
+    with open(filename) as fid:
+        for line in fid:
+            if line.strip():
+                v = line.split()
+                out.append((int(v[0], 16), float(v[1]), int(v[2], 16), tuple(int(x, 16) for x in v[3:])))
+    return out
+
+class OpkWriter(): # buffered OPK file writer, a page at a time to filename.part, renamed to filename by close()
+    # size in the OPK header is updated after each page, so the .part file is a valid OPK of the pages written so far
+    def __init__(self, filename, page_size=0x100, fsync=False, crc_sidecar=False):
+        self.filename = filename
+        self.part_file = filename + '.part'
+        self.page_size = page_size
+        self.fsync = fsync # flush each page to disk, slower but survives a power failure
+        self.crc_sidecar = crc_sidecar # write filename.crc with a CRC-32 for each page
+        self.buf = bytearray() # bytes of the current page
+        self.written = 0 # bytes written to file, always whole pages until close()
+        self.crcs = []
+        self.fid = open(self.part_file,'wb')
+        self.fid.write(opk_header(0))
+
+    def write(self, dat): # add pack image bytes, full pages are written to the file
+        self.buf += dat
+        if len(self.buf) >= self.page_size:
+            n = len(self.buf) - len(self.buf) % self.page_size
+            self._write_pages(self.buf[0:n])
+            del self.buf[0:n]
+
+    def _write_pages(self, dat):
+        for addr in range(0, len(dat), self.page_size):
+            self.crcs.append((self.written + addr, zlib.crc32(dat[addr:addr+self.page_size])))
+        self.fid.write(dat)
+        self.written += len(dat)
+        self.fid.seek(3)
+        self.fid.write(opk_header(self.written - 1)[3:]) # size is address of last byte written
+        self.fid.seek(0, os.SEEK_END)
+        if self.fsync:
+            self.fid.flush()
+            os.fsync(self.fid.fileno())
+
+    def close(self, size=None, filename=None): # write rest of image, set size (default address of last byte) and rename to filename
+        # filename, if given, replaces the filename the writer was opened with, e.g. for a partial image
+        if filename is not None:
+            self.filename = filename
+        if not self.written and not self.buf: # no image, size would be -1
+            self.abort()
+            raise ValueError(f'Nothing written to {self.filename:s}, file not saved')
+        if self.buf:
+            self._write_pages(self.buf)
+            self.buf = bytearray()
+        if size is None:
+            size = self.written - 1
+        self.fid.seek(3)
+        self.fid.write(opk_header(size)[3:])
+        self.fid.flush()
+        if self.fsync:
+            os.fsync(self.fid.fileno())
+        self.fid.close()
+        os.replace(self.part_file, self.filename) # atomic, filename is either the old file or the complete new one
+        if self.crc_sidecar:
+            crc_file = self.filename + '.crc'
+            with open(crc_file + '.part','w') as fid:
+                fid.writelines(f'{addr:04x} {crc:08x}\n' for addr, crc in self.crcs)
+            os.replace(crc_file + '.part', crc_file)
+        return size
+
+    def abort(self): # discard the image, filename is left unchanged
+        self.fid.close()
+        os.remove(self.part_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb): # abort if not closed, e.g. exception during the read
+        if not self.fid.closed:
+            self.abort()
+
+class OpkImage(): # read access to the pack image of an OPK file, only the bytes asked for are read from the file
+    def __init__(self, filename):
+        self.name = filename
+        self.fid = open(filename,'rb')
+        header = self.fid.read(OPK_header_len)
+        if header[0:3] != b'OPK':
+            self.fid.close()
+            raise ValueError(f'{filename:s} is not an OPK file!')
+        self.size = (header[3] << 16) + (header[4] << 8) + header[5] # from OPK header, address of end of pack byte
+        self.fid.seek(0, os.SEEK_END)
+        self.length = self.fid.tell() - OPK_header_len # bytes of pack image in file
+
+    def __len__(self):
+        return self.length
+
+    def read(self, addr, length): # bytes from addr, fewer if past the end of the image
+        length = max(0, min(length, self.length - addr))
+        self.fid.seek(OPK_header_len + addr)
+        return self.fid.read(length)
+
+    def __getitem__(self, key): # image[addr] or image[start:stop]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            return self.read(start, stop - start)[::step]
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('address outside image')
+        return self.read(key, 1)[0]
+
+    def to_bytes(self): # whole image as a bytearray, same as read_opk()
+        return bytearray(self.read(0, self.length))
+
+    def records(self): # walk_records() of the image
+        return walk_records(self.to_bytes())
+
+    def hex_dump(self, start=0, size=0x100): # hex dump lines, reads only start to start+size
+        return hex_dump(self.read(start, size), base=start)
+
+    def close(self):
+        self.fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SparseImage(): # pack image as a list of (address, bytes) extents, everything else up to size is 0xFF
+    def __init__(self, extents=(), size=0):
+        self.extents = sorted((addr, bytes(dat)) for addr, dat in extents if dat)
+        self.size = max([size] + [addr + len(dat) for addr, dat in self.extents]) # image length in bytes
+
+    @classmethod
+    def from_bytes(cls, dat, min_run=32): # split image dat at 0xFF runs of min_run bytes or more
+        extents = []
+        start = 0
+        for run in re.finditer(b'\xff{%d,}' % min_run, dat):
+            if run.start() > start:
+                extents.append((start, dat[start:run.start()]))
+            start = run.end()
+        if start < len(dat):
+            extents.append((start, dat[start:]))
+        return cls(extents, len(dat))
+
+    def __len__(self):
+        return self.size
+
+    def populated(self): # no. of bytes in extents
+        return sum(len(dat) for addr, dat in self.extents)
+
+    def runs(self): # 0xFF runs between extents, list of (address, length)
+        out = []
+        addr = 0
+        for start, dat in self.extents + [(self.size, b'')]:
+            if start > addr:
+                out.append((addr, start - addr))
+            addr = start + len(dat)
+        return out
+
+    def to_bytes(self): # full image
+        out = bytearray([0xFF] * self.size)
+        for addr, dat in self.extents:
+            out[addr:addr+len(dat)] = dat
+        return out
+
+    def hex_dump(self): # hex dump lines of the extents, one line for each 0xFF run
+        parts = [(addr, dat, len(dat)) for addr, dat in self.extents] + [(addr, None, n) for addr, n in self.runs()]
+        for addr, dat, n in sorted(parts, key=lambda part: part[0]):
+            if dat is None: # run
+                yield f'{addr:04x} - {addr+n-1:04x}   0xFF x {n:d}'
+            else:
+                for line in hex_dump(dat, base=addr):
+                    if not line.startswith(('addr','---')):
+                        yield line
+
+def sparse_diff(old, new): # ranges where SparseImages old and new differ, yields (address, bytes of new)
+    # only the extents of either image are compared, runs are 0xFF in both
+    size = max(len(old), len(new))
+    edges = sorted(set([0, size] + [e for img in (old, new) for a, d in img.extents for e in (a, a + len(d))]))
+    def piece(img, start, end): # bytes of img from start to end, inside one edge interval
+        for a, d in img.extents:
+            if a <= start and end <= a + len(d):
+                return d[start-a:end-a]
+        return bytes([0xFF] * (end - start))
+    pending = None
+    for start, end in zip(edges, edges[1:]):
+        a, b = piece(old, start, end), piece(new, start, end)
+        if a == b:
+            continue
+        first = next(i for i in range(len(a)) if a[i] != b[i])
+        last = next(i for i in range(len(a) - 1, -1, -1) if a[i] != b[i])
+        lo, hi = start + first, start + last + 1
+        if pending is not None and pending[0] + len(pending[1]) == lo:
+            pending = (pending[0], pending[1] + b[first:last+1])
+        else:
+            if pending is not None:
+                yield pending
+            pending = (lo, b[first:last+1])
+    if pending is not None:
+        yield pending
+
+def walk_records(dat, start=rec_start, limit=max_pack_size): # walk the record chain of pack image dat, yields a dict for each record
+    # kind is 'short', 'long', 'bad' (bad short record) or 'end' (end of pack, always the last record yielded)
+    # for short & long records len is the data length, body is the data and deleted is True if bit 7 of type is clear
+    # bad short records keep their length byte in len_byte
+    i = start
+    while True:
+        if i >= len(dat) or i >= limit: # no end of pack byte in data
+            yield {'addr':i, 'kind':'end', 'skip':0}
+            return
+        rec_len = dat[i] # 1st byte is record length
+        if rec_len == 0xFF: # end of pack
+            yield {'addr':i, 'kind':'end', 'skip':0}
+            return
+        if i+1 >= len(dat):
+            raise ValueError(f'Record at 0x{i:04x} runs past end of pack data!')
+        rec_type = dat[i+1] # 2nd byte is record type
+        if rec_type == 0xFF: # bad short record - ignore length if bad, skip past length and type bytes
+            rec = {'addr':i, 'kind':'bad', 'type':rec_type, 'len':0, 'skip':2, 'deleted':False, 'body':b'', 'len_byte':rec_len}
+        elif (rec_type & 0x7F) == 0: # long record, 0x80 or 0x00 if deleted - preceding short record has: deleted?, type, filename
+            if i+3 >= len(dat):
+                raise ValueError(f'Long record at 0x{i:04x} runs past end of pack data!')
+            long_len = (dat[i+2] << 8) + dat[i+3] # high byte, low byte of long rec length
+            rec = {'addr':i, 'kind':'long', 'type':rec_type, 'len':long_len, 'skip':long_len+4,
+                   'deleted':rec_type < 0x80, 'body':bytes(dat[i+4:i+4+long_len])}
+        else: # short record
+            rec = {'addr':i, 'kind':'short', 'type':rec_type, 'len':rec_len, 'skip':rec_len+2,
+                   'deleted':rec_type < 0x80, 'body':bytes(dat[i+2:i+2+rec_len])}
+        if i + rec['skip'] > len(dat):
+            raise ValueError(f'Record at 0x{i:04x} runs past end of pack data!')
+        yield rec
+        i += rec['skip']
+
+def read_records(fid, start=rec_start): # streaming record walk of an OPK file, fid at start of OPK file - reads one record at a time
+    # yields the same dicts as walk_records, so memory use is one record whatever the pack size
+    fid.seek(OPK_header_len + start)
+    i = start
+    while True:
+        hdr = fid.read(2)
+        if len(hdr) == 0 or hdr[0] == 0xFF or i >= max_pack_size: # end of pack, or no end of pack byte in file
+            yield {'addr':i, 'kind':'end', 'skip':0}
+            return
+        if len(hdr) < 2:
+            raise ValueError(f'Record at 0x{i:04x} runs past end of pack data!')
+        rec_len, rec_type = hdr[0], hdr[1]
+        if rec_type == 0xFF: # bad short record
+            rec = {'addr':i, 'kind':'bad', 'type':rec_type, 'len':0, 'skip':2, 'deleted':False, 'body':b'', 'len_byte':rec_len}
+        elif (rec_type & 0x7F) == 0: # long record
+            len_b = fid.read(2)
+            if len(len_b) < 2:
+                raise ValueError(f'Long record at 0x{i:04x} runs past end of pack data!')
+            long_len = (len_b[0] << 8) + len_b[1]
+            rec = {'addr':i, 'kind':'long', 'type':rec_type, 'len':long_len, 'skip':long_len+4,
+                   'deleted':rec_type < 0x80, 'body':fid.read(long_len)}
+        else: # short record
+            rec = {'addr':i, 'kind':'short', 'type':rec_type, 'len':rec_len, 'skip':rec_len+2,
+                   'deleted':rec_type < 0x80, 'body':fid.read(rec_len)}
+        if len(rec['body']) < rec['len']:
+            raise ValueError(f'Record at 0x{i:04x} runs past end of pack data!')
+        yield rec
+        i += rec['skip']
+
+class RecordParser(): # incremental record walk, bytes are fed in as they arrive, e.g. during a serial read
+    # feed() returns the records completed so far, same dicts as walk_records, end is set when the end of pack byte arrives
+    def __init__(self, start=rec_start):
+        self.dat = bytearray()
+        self.pos = start # address of next record
+        self.end = None # address of end of pack byte, once it has arrived
+        self.records = []
+
+    def feed(self, data): # add bytes, returns list of records completed by them
+        self.dat += data
+        out = []
+        while self.end is None:
+            rec = self.next_record()
+            if rec is None: # rest of record not arrived yet
+                break
+            out.append(rec)
+            if rec['kind'] == 'end':
+                self.end = rec['addr']
+            else:
+                self.pos += rec['skip']
+        self.records += out
+        return out
+
+    def next_record(self): # record at pos, or None if it hasn't all arrived
+        i, dat = self.pos, self.dat
+        if i >= max_pack_size: # no end of pack byte
+            return {'addr':i, 'kind':'end', 'skip':0}
+        if i >= len(dat):
+            return None
+        if dat[i] == 0xFF: # end of pack
+            return {'addr':i, 'kind':'end', 'skip':0}
+        if i+1 >= len(dat):
+            return None
+        rec_len, rec_type = dat[i], dat[i+1]
+        if rec_type == 0xFF: # bad short record
+            return {'addr':i, 'kind':'bad', 'type':rec_type, 'len':0, 'skip':2, 'deleted':False, 'body':b'', 'len_byte':rec_len}
+        if (rec_type & 0x7F) == 0: # long record
+            if i+3 >= len(dat):
+                return None
+            long_len = (dat[i+2] << 8) + dat[i+3]
+            if i+4+long_len > len(dat):
+                return None
+            return {'addr':i, 'kind':'long', 'type':rec_type, 'len':long_len, 'skip':long_len+4,
+                    'deleted':rec_type < 0x80, 'body':bytes(dat[i+4:i+4+long_len])}
+        if i+2+rec_len > len(dat): # short record
+            return None
+        return {'addr':i, 'kind':'short', 'type':rec_type, 'len':rec_len, 'skip':rec_len+2,
+                'deleted':rec_type < 0x80, 'body':bytes(dat[i+2:i+2+rec_len])}
+
+def pack_end(dat): # size the pack - returns address of end of pack byte
+    for rec in walk_records(dat):
+        pass
+    return rec['addr']
+
+def compact_records(dat): # rewrite pack image dat without deleted and bad records
+    # returns compacted image (ID bytes, records and end of pack byte) and a dict of removed record counts
+    # file IDs and record order are kept, a deleted block file (diary, OPL etc.) header also removes its long record
+    # a deleted datafile header is kept if records with its file ID have not been deleted
+    recs = list(walk_records(dat))
+    live_ids = set(rec['type'] for rec in recs if rec['kind'] == 'short' and not rec['deleted'] and rec['type'] >= 0x90)
+    removed = {'deleted':0, 'bad':0, 'long':0, 'bytes':0}
+    out = bytearray(dat[0:rec_start]) # ID bytes are unchanged
+    drop_long = False # set when a deleted block file header is dropped, as its long record follows
+    for rec in recs:
+        if rec['kind'] == 'end':
+            break
+        drop = False
+        if rec['kind'] == 'bad':
+            drop = True
+            removed['bad'] += 1
+        elif rec['kind'] == 'long':
+            if drop_long or rec['deleted']:
+                drop = True
+                removed['long'] += 1
+            drop_long = False
+        else: # short record
+            drop_long = False
+            if rec['deleted']:
+                r_type = rec['type'] | 0x80
+                if r_type == 0x81 and rec['len'] >= 9 and rec['body'][8] in live_ids: # datafile still has records
+                    pass
+                else:
+                    drop = True
+                    removed['deleted'] += 1
+                    drop_long = 0x82 <= r_type <= 0x8F # block file, so drop following long record
+        if drop:
+            removed['bytes'] += rec['skip']
+        else:
+            out += dat[rec['addr']:rec['addr']+rec['skip']]
+    out.append(0xFF) # end of pack
+    return out, removed
+
+salvage_min = 0.3 # records in the chain below this confidence are a chain break
+salvage_sure = 0.8 # records at or above this confidence are not scanned again after a break
+salvage_confirm = 2 # records after a record found by a scan that must also be likely, before the scan stops there
+name_first = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz')
+name_chars = name_first | frozenset(b'0123456789$% ')
+text_chars = bytes([0x09]) + bytes(range(0x20, 0x7F)) # tab separates the fields of a datafile record
+salvage_patterns = {} # file IDs: compiled regex of likely record headers
+
+def salvage_record(dat, i): # record dict at i of pack image dat as walk_records, None if it runs past the end of dat
+    # the body of a long record is left empty, so checking a long record found by a scan takes the same time whatever its length
+    if i >= len(dat) or dat[i] == 0xFF:
+        return {'addr':i, 'kind':'end', 'skip':0}
+    if i+1 >= len(dat):
+        return None
+    rec_len, rec_type = dat[i], dat[i+1]
+    if rec_type == 0xFF:
+        return {'addr':i, 'kind':'bad', 'type':rec_type, 'len':0, 'skip':2, 'deleted':False, 'body':b'', 'len_byte':rec_len}
+    if (rec_type & 0x7F) == 0:
+        if i+3 >= len(dat):
+            return None
+        long_len = (dat[i+2] << 8) + dat[i+3]
+        rec = {'addr':i, 'kind':'long', 'type':rec_type, 'len':long_len, 'skip':long_len+4, 'deleted':rec_type < 0x80, 'body':b''}
+    else:
+        rec = {'addr':i, 'kind':'short', 'type':rec_type, 'len':rec_len, 'skip':rec_len+2,
+               'deleted':rec_type < 0x80, 'body':bytes(dat[i+2:i+2+rec_len])}
+    if i + rec['skip'] > len(dat):
+        return None
+    return rec
+
+def record_confidence(dat, rec, prev, ids): # 0 to 1, how likely rec of pack image dat is a real record
+    # prev is the record before it (None after a break), ids are the file IDs of the datafile headers found so far
+    if rec['kind'] == 'bad':
+        return 0.4
+    if rec['kind'] == 'long': # length byte 2, follows a block file header (diary, OPL etc.)
+        if dat[rec['addr']] != 0x02:
+            return 0.1
+        if prev is not None and prev['kind'] == 'short' and 0x82 <= (prev['type'] | 0x80) <= 0x8F:
+            return 1.0
+        return 0.7 if prev is not None else 0.35 # e.g. boot code after the MAIN header, or a long record found by a scan
+    r_type = rec['type'] | 0x80
+    body = rec['body']
+    if r_type <= 0x8F: # file header: 8 character name, then file ID (datafile) or 0
+        if rec['len'] != 9 or body[0] not in name_first or any(c not in name_chars for c in body[1:8]):
+            return 0.2
+        if r_type == 0x81 and not 0x90 <= body[8] <= 0xFE:
+            return 0.2
+        return 1.0 if r_type in r_types else 0.6
+    conf = 1.0 if r_type in ids else 0.3 # no datafile header found with its ID
+    if rec['len'] == 0:
+        return conf * 0.5
+    text = rec['len'] - len(body.translate(None, text_chars)) # no. of text bytes
+    return conf * (0.5 + 0.5 * text / rec['len'])
+
+def salvage_pattern(ids): # regex for a likely record header: named file header, long record or text record of a known file ID
+    key = frozenset(ids)
+    if key not in salvage_patterns:
+        id_class = b''.join(b'\\x%02x\\x%02x' % (t, t & 0x7F) for t in sorted(key)) # deleted records have bit 7 clear
+        salvage_patterns[key] = re.compile(rb'\x09[\x01-\x0f\x81-\x8f][A-Za-z][A-Za-z0-9$% ]{7}|\x02[\x00\x80]|'
+                                           rb'[\x01-\xfe][' + id_class + rb'][\x09\x20-\x7e]', re.DOTALL)
+    return salvage_patterns[key]
+
+def salvage_confirmed(dat, i, ids, data_end): # True if the record at i and the salvage_confirm records after it are likely
+    # or the end of pack, an end of pack byte is only the end if there are no data bytes after it (data_end, after the last non 0xFF byte)
+    ids = set(ids)
+    prev = None
+    for n in range(salvage_confirm + 1):
+        rec = salvage_record(dat, i)
+        if rec is None:
+            return False
+        if rec['kind'] == 'end':
+            return n > 0 and i >= data_end
+        if record_confidence(dat, rec, prev, ids) < salvage_min:
+            return False
+        if rec['kind'] == 'short' and (rec['type'] | 0x80) == 0x81:
+            ids.add(rec['body'][8])
+        prev = rec
+        i += rec['skip']
+    return True
+
+def salvage_scan(dat, pos, ids, data_end, accept=None): # address of the next likely record from pos, None if there isn't one
+    # accept(addr), if given, must also be True for the record found
+    pattern = salvage_pattern(ids)
+    while True:
+        m = pattern.search(dat, pos)
+        if m is None:
+            return None
+        if salvage_confirmed(dat, m.start(), ids, data_end) and (accept is None or accept(m.start())):
+            return m.start()
+        pos = m.start() + 1
+
+def salvage_records(dat, start=rec_start): # fault tolerant record walk of a damaged or truncated pack image dat
+    # yields the walk_records dicts of the records found, with confidence (0 to 1) and resync (True for the 1st record after a break),
+    # a 'break' dict where the record chain breaks (reason, resync: address of the next record found, None if none)
+    # and an 'end' dict last (found: False if there is no end of pack byte)
+    # a break is a record that runs past the end of dat, a record below salvage_min or an end of pack byte with data after it.
+    # After a break the scan starts after the header of the last sure record (salvage_sure), as its length byte may be the damaged one,
+    # less likely records after it are dropped if the scan finds records in their place, and the scan only stops at a record with
+    # salvage_confirm likely records after it. A record found inside the held records is only taken if its chain gets past the
+    # break, or to the end of pack, else it's the held chain again (or a worse one) and the scan carries on.
+    # The scan never goes back over bytes already scanned, and each chain is walked once (stops, a memo of where the chain from
+    # each record stops), so the time is linear in len(dat).
+    ids = {0x90} # MAIN
+    data_end = len(dat.rstrip(b'\xff')) # after the last data byte
+    held = [] # records from the last sure record on, yielded once the next sure record or the end is found
+    resync = False
+    scanned = start # the scan starts at or after here
+    stops = {} # record address: address where the chain from it stops
+    i = start
+
+    def chain_stop(a): # address where the chain of likely records from a stops: a break, or the end of pack
+        path = []
+        while a not in stops:
+            rec = salvage_record(dat, a)
+            if rec is None or rec['kind'] == 'end' or record_confidence(dat, rec, None, ids) < salvage_min:
+                stops[a] = a
+                break
+            path.append(a)
+            a += rec['skip']
+        for p in path:
+            stops[p] = stops[a]
+        return stops[a]
+
+    def better_chain(a): # True if the record at a starts a chain that gets past the break at i, or to the end of pack
+        if a > i:
+            return True
+        stop = chain_stop(a)
+        return stop > i or stop >= data_end
+    while True:
+        rec = salvage_record(dat, i)
+        if rec is None:
+            reason = 'record runs past end of data'
+        elif rec['kind'] == 'end':
+            if i >= data_end: # only 0xFF after it
+                yield from held
+                yield {'addr':i, 'kind':'end', 'skip':0, 'found':i < len(dat)}
+                return
+            reason = 'end of pack byte with data after it'
+        else:
+            conf = record_confidence(dat, rec, held[-1] if held else None, ids)
+            if conf >= salvage_min:
+                rec['confidence'] = round(conf * 0.9 if resync else conf, 2) # a little less sure of the 1st record after a scan
+                rec['resync'] = resync
+                resync = False
+                if rec['kind'] == 'long':
+                    rec['body'] = bytes(dat[i+4:i+rec['skip']])
+                if rec['kind'] == 'short' and (rec['type'] | 0x80) == 0x81:
+                    ids.add(rec['body'][8])
+                if rec['confidence'] >= salvage_sure:
+                    yield from held
+                    held = []
+                held.append(rec)
+                i += rec['skip']
+                continue
+            reason = f'unlikely record, confidence {conf:.2f}'
+        found = salvage_scan(dat, max(scanned, held[0]['addr'] + 2 if held else i + 1), ids, data_end, better_chain)
+        for rec in held:
+            if found is not None and rec['addr'] >= found: # the chain from found covers it
+                break
+            if found is not None and found < rec['addr'] + rec['skip']: # record found inside it, so its length is wrong
+                rec['confidence'] = round(rec['confidence'] * 0.5, 2)
+            yield rec
+        held = []
+        yield {'addr':i, 'kind':'break', 'skip':0, 'reason':reason, 'resync':found}
+        if found is None: # the 1st 0xFF after the last data byte is the most likely end of pack
+            yield {'addr':data_end, 'kind':'end', 'skip':0, 'found':data_end < len(dat)}
+            return
+        scanned = found + 1
+        resync = True
+        i = found
+
+def file_header(name, r_type=0x81, file_id=0): # file header record: type, 8 character name padded with spaces, then file ID
+    # r_type 0x81 for a datafile with file_id 0x90 to 0xFE, 0x82 to 0x8F for a block file (diary, OPL etc.) with file_id 0
+    name_b = name.encode('latin-1')
+    if not 1 <= len(name_b) <= 8 or name_b[0] not in name_first or any(c not in name_chars for c in name_b):
+        raise ValueError(f'Bad file name: {name}')
+    if r_type == 0x81 and not 0x90 <= file_id <= 0xFE:
+        raise ValueError(f'Bad file ID: 0x{file_id:02x}')
+    return bytes([9, r_type]) + name_b.ljust(8) + bytes([file_id])
+
+def data_record(file_id, fields): # short record of datafile file_id (0x90 for MAIN), fields are strings joined by tabs
+    body = '\t'.join(fields).encode('latin-1')
+    if not 0x90 <= file_id <= 0xFE:
+        raise ValueError(f'Bad file ID: 0x{file_id:02x}')
+    if len(body) > 0xFE:
+        raise ValueError(f'Record is {len(body):d} bytes, max is 254')
+    return bytes([len(body), file_id]) + body
+
+def long_record(body): # long record, the data of the block file whose header is before it
+    if len(body) > 0xFFFF:
+        raise ValueError(f'Long record is {len(body):d} bytes, max is 65535')
+    return bytes([0x02, 0x80, (len(body) & 0xFF00) >> 8, len(body) & 0xFF]) + bytes(body)
+
+def new_file_id(used): # lowest datafile ID not in used, None if all are used
+    for file_id in range(0x91, 0xFF):
+        if file_id not in used:
+            return file_id
+    return None
+
+def write_plan(old, new, blank_tail=True): # minimal write to change pack image old into new
+    # returns (start address, bytes to write from start) or None if nothing to write
+    # writes from the first changed byte to the end of pack byte of new, blank_tail adds 0xFF bytes up to the end of old
+    old_end = pack_end(old)
+    new_end = pack_end(new)
+    start = None
+    for addr in range(min(old_end, new_end)+1): # first difference, up to and including end of pack byte
+        if addr >= len(old) or addr >= len(new) or old[addr] != new[addr]: # no end of pack byte counts as a difference
+            start = addr
+            break
+    if start is None: # images are the same up to and including both end of pack bytes
+        return None
+    plan = bytes(new[start:new_end+1])
+    if blank_tail and old_end > new_end:
+        plan += bytes([0xFF] * (old_end - new_end)) # blank old records, up to and including old end of pack
+    return start, plan
+
+def hex_dump(dat, start=0, size=None, base=0): # hex dump lines of dat from start for size bytes, addresses shown from base + start
+    if size is None:
+        size = len(dat) - start
+    end = min(start + size, len(dat))
+    yield 'addr   00 01 02 03 04 05 06 07   08 09 0A 0B 0C 0D 0E 0F   TEXT'
+    yield '---------------------------------------------------------------'
+    for addr in range(start, end, 16): # no. of sets 16 bytes
+        row = dat[addr:min(addr+16, end)]
+        hex_s = [f'{c:02x}' for c in row] + ['  '] * (16 - len(row)) # pad rest of 16 with spaces
+        out = ''.join(chr(c) if 31 < c < 127 else '.' for c in row) # '.' if not printable
+        yield f'{base+addr:04x}   {" ".join(hex_s[0:8])}   {" ".join(hex_s[8:16])}   {out[0:8]:s}  {out[8:16]:s}'
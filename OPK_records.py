@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+OPK records - the data file records of many packs as columns, for fast queries, e.g. an address book across an archive
+
+Created: Oct 2026
+
+@author: martin
+
+Data file records are short records of type 0x90 to 0xFE (the file ID, 0x90 is MAIN), with fields separated by tabs.
+A RecordStore loads the records of any number of pack images (OPK files or packs in an OPK archive) into a Table for
+each data file name, so MAIN on every pack is one table. Each table is a set of columns (array module, not lists of objects):
+    pack - index of the pack in RecordStore.packs
+    addr - address of the record in its pack image, so it can be found, read back or patched
+    deleted - 1 for a deleted record (bit 7 of the type clear)
+    fields[k] - field k of each record, as an ID in the string table, 0 for an empty or missing field
+Every distinct string is stored once (interned), so a name on a thousand records is one string and a thousand ints.
+
+Queries work on the IDs: a test on a field is run once for each distinct string, not once for each record,
+and the rows are then picked out with C loops (map, itertools.compress), so a query over hundreds of thousands of records
+is mostly integer work. Rows are arrays of row numbers, the result of one query can be the rows of the next:
+    rows = main.where(1, lambda s: s.startswith('01'))
+    rows = main.sort(0, rows)
+    main.count_by(0, rows), main.numbers(2, rows), main.row(r)
+Deleted records are left out unless include_deleted is True, or their rows are given.
+"""
+
+import array
+import glob
+import itertools
+import math
+import time
+from collections import Counter
+
+import OPK_lib as opk
+
+infiles = sorted(glob.glob("*.opk"))
+archive_file = "" # e.g. "packs.opka" to include the packs in an archive
+show_rows = 10 # rows printed for each example query
+search_text = "fox" # example query: records with this text in any field, "" for none
+
+class Table(): # records of one data file name, from all packs, as columns
+    def __init__(self, name, strings):
+        self.name = name
+        self.strings = strings # string table of the RecordStore, shared by all tables
+        self.pack = array.array('I')
+        self.addr = array.array('I')
+        self.deleted = array.array('B')
+        self.fields = [] # array of string IDs for each field
+
+    def __len__(self):
+        return len(self.addr)
+
+    def add(self, pack, addr, deleted, ids): # add a record, ids are the string IDs of its fields
+        n = len(self.addr)
+        while len(self.fields) < len(ids): # new field, empty for the records before
+            self.fields.append(array.array('I', [0]) * n)
+        for k, col in enumerate(self.fields):
+            col.append(ids[k] if k < len(ids) else 0)
+        self.pack.append(pack)
+        self.addr.append(addr)
+        self.deleted.append(deleted)
+
+    def rows(self, include_deleted=False): # row numbers of all records, or of the records that aren't deleted
+        if include_deleted or not self.deleted.count(1):
+            return array.array('I', range(len(self.addr)))
+        return array.array('I', itertools.compress(range(len(self.addr)), map((0).__eq__, self.deleted)))
+
+    def column(self, field): # string IDs of field, all 0 if no record has that many fields
+        if field < len(self.fields):
+            return self.fields[field]
+        return array.array('I', [0]) * len(self.addr)
+
+    def where(self, field, test, rows=None): # rows where test(string of field) is True, test is run once per distinct string
+        col = self.column(field)
+        if rows is None:
+            rows = self.rows()
+        ids = set(map(col.__getitem__, rows))
+        keep = {i for i in ids if test(self.strings[i])}
+        return array.array('I', itertools.compress(rows, map(keep.__contains__, map(col.__getitem__, rows))))
+
+    def where_in(self, field, values, rows=None): # rows where field is one of values
+        values = set(values)
+        return self.where(field, values.__contains__, rows)
+
+    def where_any(self, test, rows=None): # rows where test is True for any field
+        if rows is None:
+            rows = self.rows()
+        found = set()
+        for field in range(len(self.fields)):
+            found.update(self.where(field, test, rows))
+        return array.array('I', sorted(found))
+
+    def sort(self, field, rows=None, key=None, reverse=False): # rows sorted by field, key(string) is run once per distinct string
+        col = self.column(field)
+        if rows is None:
+            rows = self.rows()
+        ids = sorted(set(map(col.__getitem__, rows)), key=lambda i: self.strings[i] if key is None else key(self.strings[i]))
+        rank = dict(zip(ids, range(len(ids))))
+        row_rank = dict(zip(rows, map(rank.__getitem__, map(col.__getitem__, rows))))
+        return array.array('I', sorted(rows, key=row_rank.__getitem__, reverse=reverse)) # stable, so sorts can be chained
+
+    def count_by(self, field, rows=None): # list of (string, no. of rows), most common first
+        col = self.column(field)
+        if rows is None:
+            rows = self.rows()
+        return [(self.strings[i], n) for i, n in Counter(map(col.__getitem__, rows)).most_common()]
+
+    def numbers(self, field, rows=None): # field of rows as numbers, nan if not a number, each distinct string is converted once
+        col = self.column(field)
+        if rows is None:
+            rows = self.rows()
+        values = {i:to_number(self.strings[i]) for i in set(map(col.__getitem__, rows))}
+        return array.array('d', map(values.__getitem__, map(col.__getitem__, rows)))
+
+    def row(self, r): # record r as a list of strings, without the empty fields at the end
+        values = [self.strings[col[r]] for col in self.fields]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+def to_number(s): # float of a field, nan if it isn't a number
+    try:
+        return float(s)
+    except ValueError:
+        return math.nan
+
+def stats(values): # no. of numbers, sum, min, max and mean of an array from Table.numbers(), nan ignored
+    nums = [v for v in values if v == v] # nan != nan
+    if not nums:
+        return {'n':0, 'sum':0.0, 'min':math.nan, 'max':math.nan, 'mean':math.nan}
+    return {'n':len(nums), 'sum':math.fsum(nums), 'min':min(nums), 'max':max(nums), 'mean':math.fsum(nums) / len(nums)}
+
+class RecordStore(): # data file records of many packs, a Table for each data file name
+    def __init__(self):
+        self.strings = [''] # ID 0 is the empty string
+        self.string_ids = {'':0}
+        self.packs = [] # pack names, pack column of each table is an index into this
+        self.tables = {} # data file name: Table
+
+    def intern(self, s): # ID of string s, added to the string table if it's new
+        i = self.string_ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.string_ids[s] = i
+            self.strings.append(s)
+        return i
+
+    def table(self, name): # Table for data file name, created if new
+        if name not in self.tables:
+            self.tables[name] = Table(name, self.strings)
+        return self.tables[name]
+
+    def add_image(self, name, dat): # add the data file records of pack image dat, returns no. of records added
+        pack = len(self.packs)
+        self.packs.append(name)
+        names = {0x90:'MAIN'} # file ID: data file name, from the data file headers of this pack
+        intern = self.intern
+        n = 0
+        try:
+            for rec in opk.walk_records(dat, limit=len(dat)):
+                if rec['kind'] != 'short':
+                    continue
+                r_type = rec['type'] | 0x80
+                if r_type == 0x81 and rec['len'] >= 9: # data file header: name & file ID
+                    names[rec['body'][8]] = rec['body'][0:8].decode('latin-1').strip()
+                elif r_type >= 0x90:
+                    table = self.table(names.get(r_type, f'0x{r_type:02x}'))
+                    table.add(pack, rec['addr'], rec['deleted'], list(map(intern, rec['body'].decode('latin-1').split('\t'))))
+                    n += 1
+        except ValueError as err: # broken record chain, the records before it are kept
+            print(f'{name:s}: {err}')
+        return n
+
+    def add_file(self, filename): # add an OPK file
+        return self.add_image(filename, opk.read_opk(filename)[1])
+
+    def add_archive(self, archive, prefix=''): # add every pack of an OpkArchive, names are prefix + pack name
+        n = 0
+        for name in archive.names():
+            n += self.add_image(prefix + name, archive.open(name).to_bytes())
+        return n
+
+    def where_pack(self, table, pack_name, rows=None): # rows of table from the pack called pack_name
+        if rows is None:
+            rows = table.rows()
+        packs = {i for i, p in enumerate(self.packs) if p == pack_name}
+        return array.array('I', itertools.compress(rows, map(packs.__contains__, map(table.pack.__getitem__, rows))))
+
+if __name__ == '__main__':
+    t_start = time.time()
+    store = RecordStore()
+    n = sum(store.add_file(f) for f in infiles)
+    if archive_file:
+        import OPK_archive
+        with OPK_archive.OpkArchive(archive_file) as arc:
+            n += store.add_archive(arc, archive_file + ':')
+    print(f'{len(store.packs):d} packs, {n:d} records, {len(store.strings):d} distinct strings, {time.time() - t_start:.3f} s\n')
+    for name, table in sorted(store.tables.items()):
+        live = table.rows()
+        print(f'{name:s}: {len(table):d} records ({len(table) - len(live):d} deleted), {len(table.fields):d} fields')
+        t_start = time.time()
+        rows = table.sort(0, live)
+        for r in rows[0:show_rows]:
+            print(f'  {store.packs[table.pack[r]]:s} 0x{table.addr[r]:04x}: ' + ' | '.join(table.row(r)))
+        if len(rows) > show_rows:
+            print(f'  ... {len(rows) - show_rows:d} more')
+        print('  Most common 1st field: ' + ', '.join(f'{s!r} x{c:d}' for s, c in table.count_by(0, live)[0:5]))
+        if search_text:
+            found = table.where_any(lambda s: search_text.lower() in s.lower(), live)
+            print(f'  Records with "{search_text:s}": {len(found):d}')
+        print(f'  Queries: {time.time() - t_start:.3f} s\n')
@@ -28,13 +28,33 @@ v1.3 - Nov 2022 - added sizing and blank check using code from Matt Callow https
 
 v1.3.1 - Jan 2023 - bug fix for bootable pack types
 
+v1.4 - Oct 2026 - added patch write, writes only the changed part of a pack, e.g. after Compact_OPK_v1.py
+read, write & patch write moved to Psion2_link.py, so they can be used by other programs
+transfers use short timeouts and resync with the Arduino (s command) after an error, instead of waiting for timeouts
+0 to 3 and g get pages as binary and print them here as hex dumps, g shows the next page, for any page of the pack
+d prints the directory from the binary f command, cached until the pack is written or erased
+z erases only the used, non-blank pages of a rampak, then verifies with page checksums (k command)
+write_sparse = True makes w send only the data of infile, skipping 0xFF runs, for a blank pack
+read parses records as they arrive, prints them (read_live_dir) and stops after the end of pack byte, or after read_until_file
+a reads address ranges (range_list) without a full read, e.g. the ID bytes or one record
+c prints the datapak write cycle counts of the last write and adds them to cycle_log, u sets write_pulse & write_overprogram
+write_adaptive = True makes w write a blank datapak in chunks, tuning the write pulse as it goes and warning of a marginal chip
+capture_file logs every byte to and from the Arduino with its time, replay_file plays a capture back (Psion2_transport.py)
+read writes outfile only when complete (via outfile.part), with optional fsync and a .crc file of page CRCs
+n appends append_list records at the end of pack, sending only the new bytes, read back if append_verify
+read_auto_addr = True sets the Arduino addressing mode from the ID byte before r, and checks the first 2 pages first, a mode change is printed
+read_vote = True makes r a recovery read for a marginal datapak: pages that differ from their checksum are read vote_passes times
+and voted bit by bit, the unstable bytes are listed in outfile.vote
+
 
 """
 
 import keyboard as kb
-import serial # uses pyserial
 import time
 import os
+import OPK_lib as opk
+import Psion2_link
+import Psion2_transport # uses pyserial
 
 # set SerialPort and BaudRate values that work for your PC !! 
 
@@ -46,6 +66,10 @@ SerialPort = 'COM3' # Windows type port name, could be COM4 etc.
 #BaudRate = 57600
 BaudRate = 115200 # must match Arduino value
 
+capture_file = '' # e.g. 'session.p2cap' - log all bytes to and from the Arduino, list with Psion2_transport.py
+replay_file = '' # e.g. 'session.p2cap' - play back a capture instead of using SerialPort, press the same keys
+replay_speed = 1.0 # 1 for the original speed, 10 for 10 times faster, 0 for no waits
+
 # numFFchk = 3 # must be same as Arduino program, to check for end of pack during read, if set_fixed_size = False
 
 set_Rampak_ID = False # if false, leaves ID byte as it is in OPK file
@@ -60,8 +84,18 @@ update_checksum = False # if False uses checksum from OPK file
 
 read_fixed_size = False
 # read_fixed_size = True
-# read_pack_size = 0x7e9b
+read_pack_size = 0x7e9b # only used if read_fixed_size = True
 # read_pack_size = 0x0100
+read_stop_at_end = True # stop the read read_end_margin bytes after the end of pack byte, e.g. a fixed size read bigger than the pack
+read_end_margin = 1 # 0xFF bytes kept after end of pack, 1 for 2 0xFF bytes at end like the Developer software
+read_live_dir = True # print each record as it arrives
+read_until_file = '' # e.g. 'PROCNAME' - stop the read when the long record of this block file (OPL, notes etc.) has arrived, saved as outfile + '.partial'
+read_fsync = False # True to flush each page to disk during read
+read_crc_sidecar = False # True to also write outfile.crc with a CRC-32 for each page
+read_auto_addr = True # set paged or linear addressing from the ID byte before a read, and check the first 2 pages, False to use the mode set with l
+read_vote = False # True for a recovery read of a marginal datapak, page by page with voting, instead of one pass
+vote_passes = 5 # reads of each page that doesn't match its checksum
+vote_use_sums = True # check each page against its checksum (k command), False to read each page twice instead
 
 set_pack_size = False # if false, don't change pack size written to pack
 # set_pack_size = True
@@ -84,197 +118,114 @@ outfile = "test.opk"
 print("Output filename:",outfile)
 f_out_open = False
 
+write_sparse = False # True to skip 0xFF runs of infile, only for a blank pack (new datapak or erased rampak)
+write_adaptive = False # True to write a blank datapak in chunks, tuning the write pulse from the write cycle counts
+cycle_log = "write_cycles.json" # write cycle counts of each datapak (by ID bytes) are added here, "" for no log
+write_pulse = 100 # us, datapak write pulse set by u
+write_overprogram = 0 # overprogram factor set by u, 0 for none, 3 as EPROM datasheets
+# patch write: writes the difference between patch_base (the image on the pack, e.g. from a read) and patchfile
+patch_base = "testpak.opk"
+patchfile = "testpak_compact.opk"
+patch_blank_tail = True # write 0xFF over old records after the new end of pack
+# append: records added at the end of pack by n, built with opk.file_header(), opk.data_record() and opk.long_record()
+append_list = [opk.data_record(0x90, ['The quick brown fox', 'jumps over the lazy dog'])] # MAIN record, fields are tab separated
+# append_list = [opk.file_header('PHONES', 0x81, 0x91), opk.data_record(0x91, ['Martin', '01234 567890'])] # new datafile & record
+append_verify = True # read the records back after writing
+# range read: list of (address, length), read in address order and printed as hex dumps
+range_list = [(0x0000, 0x0a)] # ID bytes
+browse_page = 0 # next page shown by g, 0 to 3 keys start from that page
+# range_list = [(0x0000, 0x0a), (0x000a, 0x40), (0x0100, 0x100)]
+
 def WritePak():
-    print("(PC) Write")
-    read_file = False
-    f_in = open(infile,'rb')
-    data = f_in.read(3) # Should be "OPK"
-    header = data.decode()
-    print(f'(PC) OPK header: "{header:s}"')
-    if header != "OPK":
-        print("Error! Not an OPK file!")
-        return
-    size_hh = ord(f_in.read(1))
-    size_h = ord(f_in.read(1))
-    size_l = ord(f_in.read(1))
-    
-    f_in_size = (size_hh << 16) + (size_h << 8) + size_l # shift size_h left 16 bits, size_h left 8 bits
-    print(f'(PC) Pack image size: size_hh: 0x{size_hh:02x}, size_h: 0x{size_h:02x}, size_l: 0x{size_l:02x}, size: 0x{f_in_size:06x}')
-        
-    if f_in_size > 0xFFFF:
-        print("(PC) File too big to write!")
-        return
-        
-    size_h = (f_in_size & 0xFF00) >> 8 # high byte, shift right 8 bits, top byte (size_hh) removed, so max size is 64k!!
-    size_l = f_in_size & 0xFF # lowest 8 bits, AND with 0xFF
-    
-    time.sleep(0.2) # 0.2 second delay for Arduino to send messages
-    while ser.inWaiting(): # read & print lines from Arduino until none left
-        line_in = ser.readline() 
-        print("(PC) Empty buffer:", line_in.decode(), end='') # decode from bytes
-    
-    ser.write("XXWrite".encode()) # encode to bytes - tells Arduino that following bytes are for write to datapak
-    ser.write(bytes([size_h])) # send high byte
-    ser.write(bytes([size_l])) # send low byte
-    
-    print(f'(PC) size_h: 0x{size_h:02x}, size_l: 0x{size_l:02x}')
-    
-    read_file = True
-    addr = 0
-    data = []
-    
-    while read_file: # read file data to write to datapak
-        dat_out = f_in.read(1) # read from file - initially must be first byte after header
-        n = ord(dat_out)
-        
-        if addr <= 9: # first 10 bytes (0-9) stored for checksum
-            
-            # bytes to be modified:
-            if addr == 0:
-                if set_Rampak_ID == True:            
-                    n = n & 0b11111101 # clear bit 1 - rampak
-                if set_paged == True:
-                    n = n | 0b100 # set bit 2 - Paged
-                if set_write_protect == True:
-                    n = n & 0b11110111 # clear bit 3 - write_protect
-                print(f'0: ID byte: {n:02x}')
-            if addr == 1:
-                if set_pack_size == True:
-                    print(f'1: Pack size was: {n*8:d} kB, now is: {pack_size_out*8:d} kB')
-                    n = pack_size_out
-                else:
-                    print(f'1: Pack size is: {n*8:d} kB')
-     
-            # non-modified bytes: - now includes both types of header - untested !!
-            
-            if addr >= 2 and addr <= 7:
-                if (data[0] & 0x10) != 0x10: # bootable pack
-                    bootable_header = {2:{'txt':'code type',0:'software',1:'hardware'},
-                                       3:{'txt':'id',0xc0:'RS232',0xbf:'bar code reader',0xbe:'swipe card reader',0x0a:'concise oxford spelling checker'},
-                                       4:{'txt':'version (binary coded decimal: 0xnm for version n.m'},
-                                       5:{'txt':'priority (can be same as id)'},
-                                       6:{'txt':'boot code pack address (high)'},
-                                       7:{'txt':'boot code pack address (low)'}}
-                    if addr >= 2 and addr <= 3:
-                        try:
-                            print(f'{addr:d}: {bootable_header[addr]["txt"]}: {bootable_header[addr][n]}')
-                        except:
-                            print(f'{addr:d}: {bootable_header[addr]["txt"]}: unknown')
-                    if addr >= 4:
-                        print(f'{addr:d}: {bootable_header[addr]["txt"]}: 0x{n:02x}')
-                    if addr == 7:
-                        print(f'boot code pack address: 0x{data[6]:02x}{n:02x}')
-                                   
-                else: # standard pack
-                    standard_header = {2:['Year at time of sizing was {:d}','n+1900'],
-                                       3:['Month at time of sizing was {:d}','n+1'],
-                                       4:['Day at time of sizing was {:d}','n+1'],
-                                       5:['Hour at time of sizing was {:d}','n'],
-                                       6:['Free Running Counter (High) at time of sizing was 0x{:02x}','n'],
-                                       7:['Free Running Counter (Low) at time of sizing was 0x{:02x}','n']}
-    
-                    print(f'{addr:d}:',standard_header[addr][0].format(eval(standard_header[addr][1])))
-                    
-                    if addr == 6: FRH = n
-                    if addr == 7:
-                        FRL = n
-                        FRCT = (FRH<<8) + FRL
-                        print(f"Free Running Counter (Total) at time of sizing was {FRCT:d} 0x{FRCT:04x}")
-                
-            data.append(n) # store bytes for checksum, must include modified bytes
-                  
-            # checksum bytes: 
-            if update_checksum == True: # update checksum if True
-                if addr == 8:
-                    print(f'Checksum:')
-                    CHKSUM = (data[0]<<8) + data[1] + (data[2]<<8) + data[3] + (data[4]<<8) + data[5] + (data[6]<<8) + data[7]
-                    chk_h = (CHKSUM & 0xFF00) >> 8 # mask for high byte
-                    chk_l = CHKSUM & 0xFF # mask for low byte            
-                    print(f'8: chk_h = 0x{chk_h:02x}')
-                    print(f'9: chk_l = 0x{chk_l:02x}')
-                    CHKSUM = CHKSUM & 0xFFFF # mask for 16 bits
-                    print(f'Checksum (calculated) is: {CHKSUM:d} 0x{CHKSUM:04x}')
-                    n = chk_h
-                if addr == 9:
-                    n = chk_l
-            
-        dat_out = bytes([n])
-        ser.write(dat_out)
-        t = time.time()
-        while not (ser.inWaiting() > 0): # If no data, wait and check for timeout
-            if time.time()-t > 1: # 1 s timeout
-                read_file = False
-                print("(PC) Timeout!")
-        dat_in = ser.read(1) # read check byte back from Arduino
-        n = ord(dat_in) # convert to number
-        if 31 < n < 127: # if printable character
-            n2 = n
-        else: # else replace non-printable character
-            n2 = 46 # character "."
-        if addr >= 8:
-            print(f'{addr:04x} {n:02x} {chr(n2):s}  ', end='')
-        if dat_in != dat_out:
-            print("(PC) Write data not verified by Arduino!")
-            read_file = False
-        addr += 1
-        if addr >8 and addr % 0x08 == 0: # if remainder of addr div 8 is zero, newline
-            print("") # newline
-        if addr > f_in_size:
-            read_file = False
-            print("") # newline at end of file
-    f_in.close()
-    
+    link.write_pak(infile, set_Rampak_ID, set_paged, set_write_protect, update_checksum, set_pack_size, pack_size_out)
+
+def WriteSparse():
+    link.write_sparse(infile, set_Rampak_ID, set_paged, set_write_protect, update_checksum, set_pack_size, pack_size_out)
+
+def WriteAdaptive():
+    link.write_adaptive(infile, set_Rampak_ID, set_paged, set_write_protect, update_checksum, set_pack_size, pack_size_out,
+                        logfile=cycle_log)
+
+def ShowCycles(): # write cycle counts of the last write, added to cycle_log
+    stats = link.write_cycles()
+    if stats is not None:
+        print(f'(PC) Write pulse: {stats["pulse"]:d} us, overprogram: {stats["overprogram"]:d}')
+        for cycles, n in enumerate(stats['hist']):
+            print(f'(PC) {"failed" if cycles == 0 else f"{cycles:d} cycles":>9}: {n:5d} bytes')
+        print(f'(PC) Marginal bytes: {stats["marginal_total"]:d} ' + ' '.join(f'0x{a:04x}:{c:d}' for a, c in stats['marginal']))
+        tuner = Psion2_link.PulseTuner(stats['pulse'], stats['overprogram'])
+        warning = tuner.update(stats)
+        if warning is not None:
+            print(f'(PC) {warning:s}')
+        print(f'(PC) Suggested write pulse: {tuner.pulse:d} us, overprogram: {tuner.overprogram:d}')
+        ids = link.read_range(0, 10)
+        if cycle_log and ids is not None and sum(stats['hist']) > 0:
+            Psion2_link.log_cycles(cycle_log, ids, stats)
+
+def WritePatch():
+    link.write_patch(patch_base, patchfile, patch_blank_tail)
+
+def AppendRecords():
+    link.append_records(append_list, append_verify)
+
+def ReadRange():
+    ranges = link.read_ranges(range_list)
+    if ranges is not None:
+        for (addr, length), data in zip(range_list, ranges):
+            print(f'(PC) Range 0x{addr:04x} to 0x{addr+length-1:04x}:')
+            for line in opk.hex_dump(data, base=addr):
+                print(line)
+
+def ShowPage(page): # get page from Arduino and print as hex dump
+    global browse_page
+    data = link.get_page(page)
+    if data is not None:
+        print(f'(PC) Page {page:d}:')
+        for line in opk.hex_dump(data, base=page * 0x100):
+            print(line)
+    browse_page = (page + 1) & 0xFF
+
+def ShowDir(): # directory from cache, or from Arduino if pack changed
+    entries = link.directory()
+    if entries is not None:
+        for line in Psion2_link.format_dir(entries):
+            print(line)
+        print(f'(PC) Pack size is: 0x{entries[-1]["addr"]:04x}')
+
+until_found = False # set when read_until_file header arrives
+
+def LiveRecord(rec): # called by read for each record as it arrives, returns False to stop the read
+    global until_found
+    if read_live_dir:
+        nl = '\n' if link.verbose else '' # on a new line after the byte listing
+        if rec['kind'] == 'end':
+            print(f'{nl}(PC) 0x{rec["addr"]:04x} end of pack')
+        else:
+            print(f'{nl}(PC) 0x{rec["addr"]:04x} {rec["kind"]:5s} type: 0x{rec["type"]:02x} len: 0x{rec["len"]:04x} {rec["body"][0:8]}')
+    if read_until_file:
+        if rec['kind'] == 'short' and 0x82 <= (rec['type'] | 0x80) <= 0x8F: # block file header
+            until_found = rec['body'][0:8].decode('latin-1').strip() == read_until_file
+        elif rec['kind'] == 'long' and until_found:
+            print(f'(PC) {read_until_file:s} has arrived, stopping read')
+            return False
+    return True
+
 def ReadPak():
-    with open(outfile,'wb') as f_out: # open file for output
-        f_out.write("OPK".encode())
-        f_out.write(bytes(3)) # write 3 zero bytes for size, written later
-        # write_file = True
-        addr = 0
-        read_size = [0,0,0];
-        for i in range(3):
-            n = ser.read(1) # read 3 bytes for pack size
-            read_size[i] = ord(n) 
-            # print(n, read_size)
-        rd_size = (read_size[0]<<16) + (read_size[1]<<8) + (read_size[2])
-        print(f'Read size: {rd_size:06x}')
-        # while write_file == True:
-        while True:
-            # if ser.inWaiting():
-            dat = ser.read(1) # read 1 value
-            if dat == bytes(): # no byte from read!
-                print('\n(PC) Timeout! No byte from Arduino')
-                break
-            ser.write(dat) # echo back to Arduino for verify
-            # ser.write(bytes([0xFF])) // write a single byte of value 0xFF
-            n = ord(dat) # convert char or b'\xff' hex byte to value
-            if 31 < n < 127:
-                n2 = n
-            else:
-                n2 = 46 # character "." for non-printable character
-            print(f'{addr:04x} {n:02x} {chr(n2):s}  ', end='')
-            f_out.write(dat) # write it to file
-            if read_fixed_size == True:
-                if addr >= read_pack_size or addr >= rd_size: # read_pack_size can't be bigger than pack
-                    break
-            elif addr >= rd_size:
-                    break
-            addr += 1
-            if addr % 8 == 0: # if remainder of addr div 8 is zero, newline
-                print("") # newline        
-        f_out.seek(3) # move back to size bytes in PC outfile, byte 3: 0, 1, 2, 3
-        addr_hh = (addr & 0xFF0000) >> 16 # high byte, mask & shift right 16 bits
-        addr_h = (addr & 0xFF00) >> 8 # middle byte, mask & shift right 8 bits
-        addr_l = addr & 0xFF # low byte
-        f_out.write(bytes([addr_hh,addr_h,addr_l])) # write size, includes 0xFF bytes at end
-        print("\n(PC) Datapak read to file has ended")
-        
+    global until_found
+    until_found = False
+    link.read_pak(outfile, read_fixed_size, read_pack_size, read_fsync, read_crc_sidecar,
+                  read_stop_at_end, read_end_margin, LiveRecord)
+
+def ReadVoted():
+    link.read_voted(outfile, vote_passes, vote_use_sums, read_end_margin, read_crc_sidecar)
 
-keys = ['e','r','w','0','1','2','3','t','m','l','i','d','b','?','x'] # allowed key list
+keys = ['e','z','r','w','p','n','a','0','1','2','3','g','c','u','t','m','l','i','d','b','s','?','x'] # allowed key list
 loop = True
 inp = ''
 # try: # error trapping
-with serial.Serial(SerialPort, BaudRate, timeout=0.5) as ser:
+with Psion2_transport.open_port(SerialPort, BaudRate, 0.5, capture_file, replay_file, replay_speed) as ser:
     print("Reading:",ser.name)
+    link = Psion2_link.Link(ser)
     while loop:
         time.sleep(0.001) # 1 ms delay to slow loop down
     
@@ -300,9 +251,40 @@ with serial.Serial(SerialPort, BaudRate, timeout=0.5) as ser:
                     while kb.is_pressed(inp): # wait until key not pressed any more
                         pass # do nothing
 #                        print(f'(PC) Key pressed: {inp:s} as bytes:',inp.encode()) # print keypress
-                    ser.write(inp.encode()) # write inp key to serial
-                    if inp == 'w':
-                        WritePak()
+                    if inp == 'a':
+                        ReadRange() # sends the a command itself
+                    elif inp in '0123':
+                        ShowPage(int(inp)) # sends the g command
+                    elif inp == 'g':
+                        ShowPage(browse_page)
+                    elif inp == 'w' and write_sparse:
+                        WriteSparse() # sends p & k commands
+                    elif inp == 'w' and write_adaptive:
+                        WriteAdaptive() # sends c, p & u commands
+                    elif inp == 'c':
+                        ShowCycles() # sends the c command, then a to log by ID bytes
+                    elif inp == 'u':
+                        link.set_pulse(write_pulse, write_overprogram)
+                    elif inp == 'z':
+                        link.erase_used() # sends f, a, k & z commands
+                    elif inp == 'd':
+                        ShowDir() # sends the a & f commands when needed
+                    elif inp == 'n':
+                        AppendRecords() # sends the a, f & n commands, then a to verify
+                    elif inp == 'r' and read_auto_addr and not link.auto_addr_mode(): # sends a, l & g commands
+                        print('(PC) Read not started, set read_auto_addr = False to read anyway')
+                    elif inp == 'r' and read_vote:
+                        ReadVoted() # sends g & k commands
+                    else:
+                        ser.write(inp.encode()) # write inp key to serial
+                        if inp in ('e','t'): # pack changed
+                            link.invalidate()
+                        if inp == 'l':
+                            link.paged_addr = None # changed by hand
+                        if inp == 'w':
+                            WritePak()
+                        if inp == 'p':
+                            WritePatch()
                     inp = ''
 # except:
     # print("\nError! Most likely a serial Error? Maybe Arduino not connected to serial port?")
@@ -0,0 +1,689 @@
+# -*- coding: utf-8 -*-
+"""
+Device emulator for the Datapak/Rampak Reader/Writer
+
+Created: Oct 2026
+
+@author: martin
+
+Emulates the Arduino program and a pack on a pseudo terminal (pty, Linux or macOS),
+so the PC programs can be run and timed without the hardware.
+The pack memory is 64k bytes, loaded from an OPK file or pack image, the rest is 0xFF (blank).
+
+The link is modelled as a serial line at baud with a turnaround delay for each reply,
+plus a time for each pack byte read or written (datapak writes are slow).
+Datapak bytes need chip_need_us of write pulse to program, a little more or less for each byte, and weak_bytes of them
+(a fraction) need 3 times as long, so the write cycle counts (c command) depend on the write pulse set by the u command.
+flaky_bytes (a fraction) of the bytes have a weak bit, a programmed 0 that reads as 1 flaky_rate of the time, like an old datapak,
+for the recovery read (Link.read_voted()).
+With addr_faults = True a pack read in the other addressing mode gives the wrong bytes, as on the hardware: a paged pack read
+in linear mode has no page clock, so every page reads as page 0, and a linear pack read in paged mode gets page clocks it
+ignores, so a seek (a, g and k commands) to a later page reads page 0. A sequential read (r) of a linear pack still works.
+The pack is paged if bit 2 of its ID byte is set, or pack_paged (True or False) for a pack with the wrong ID byte.
+
+usage:
+    emu, ser = open_emulator("testpak.opk", datapak_mode=False)
+    ser.write(b'r') ...
+    emu.stop()
+"""
+
+import binascii
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+import OPK_lib as opk
+from Psion2_transport import PtySerial
+
+max_eprom_size = 0x8000 # same as Arduino program, used for sizing and blank check
+serial_timeout = 0.1 # same as Arduino program, max wait for the next byte from the PC during a transfer
+max_datapak_write_cycles = 5 # same as Arduino program
+marginal_cycles = 2
+max_marginal = 16
+max_ranges = 16 # same as Arduino program, ranges read by one a command
+
+class PakEmulator(threading.Thread): # Arduino program & pack, running on the master side of a pty
+    def __init__(self, image=b'', datapak_mode=True, paged_addr=True, baud=115200, turnaround=0.0, wait_enter=True,
+                 chip_need_us=60, weak_bytes=0.0, flaky_bytes=0.0, flaky_rate=0.3,
+                 addr_faults=False, pack_paged=None):
+        super().__init__(daemon=True)
+        self.mem = bytearray([0xFF] * 0x10000) # pack memory, blank
+        self.mem[0:len(image)] = image[0:0x10000]
+        self.datapak_mode = datapak_mode
+        self.paged_addr = paged_addr
+        self.byte_time = 10 / baud # 8 data bits, start & stop bits
+        self.turnaround = turnaround # delay before each reply, e.g. USB latency
+        self.wait_enter = wait_enter
+        self.read_time = 20e-6 # time to read a pack byte and advance the address
+        self.write_time = {True:150e-6, False:30e-6} # time to write a pack byte, datapak (VPP, without the pulse) or rampak
+        self.write_pulse = 100 # datapak_write_pulse, us
+        self.overprogram = 0
+        rnd = random.Random(1) # pulse each byte of the chip needs to program, us
+        self.need_us = [chip_need_us * (0.7 + 0.6 * rnd.random()) * (3 if rnd.random() < weak_bytes else 1) for i in range(0x10000)]
+        self.flaky = {addr:1 << rnd.randrange(8) for addr in range(0x10000) if flaky_bytes and rnd.random() < flaky_bytes} # address: weak bit
+        self.flaky_rate = flaky_rate
+        self.addr_faults = addr_faults
+        self.pack_paged = pack_paged
+        self.read_rnd = random.Random(2)
+        self.reset_cycle_stats()
+        self.clock_time = 5e-6 # time for each nextAddress() or nextPage() when seeking
+        self.current_address = 0 # address counters, only used for seek times
+        self.counters_valid = False # counters_valid - current_address is where the counters are, False at the start of each command
+        self.dir_end = 0 # sizePack() cache
+        self.dir_fingerprint = None
+        self.dir_valid = False
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.in_buf = bytearray()
+        self.t_link = time.time()
+        self.running = True
+        self.exited = False
+
+    # ---------------- link ----------------
+
+    def _advance(self, cost): # advance link clock by cost seconds and sleep until it's reached
+        now = time.time()
+        if now - self.t_link > 0.01: # link has been idle
+            self.t_link = now
+        self.t_link += cost
+        if self.t_link - now > 0.0005:
+            time.sleep(self.t_link - now)
+
+    def _fill(self, timeout): # wait for bytes from PC, returns False if none before timeout
+        deadline = time.time() + timeout
+        while self.running:
+            r, w, x = select.select([self.master], [], [], min(0.05, max(0, deadline - time.time())))
+            if r:
+                try:
+                    self.in_buf += os.read(self.master, 4096)
+                except OSError: # PC side closed
+                    return False
+                return True
+            if time.time() >= deadline:
+                return False
+        return False
+
+    def read_byte(self, timeout=1.0): # Serial.read() with wait, returns None if timeout
+        if not self.in_buf and not self._fill(timeout):
+            return None
+        b = self.in_buf.pop(0)
+        self._advance(self.byte_time)
+        return b
+
+    def available(self): # Serial.available()
+        if not self.in_buf:
+            r, w, x = select.select([self.master], [], [], 0)
+            if r:
+                self._fill(0)
+        return len(self.in_buf)
+
+    def read_bytes(self, n, timeout=1.0): # Serial.readBytes()
+        out = bytearray()
+        while len(out) < n:
+            b = self.read_byte(timeout)
+            if b is None:
+                break
+            out.append(b)
+        return bytes(out)
+
+    def find(self, marker, timeout=1.0): # Serial.find(), reads until marker found or timeout
+        marker = marker.encode()
+        got = bytearray()
+        while True:
+            b = self.read_byte(timeout)
+            if b is None:
+                return False
+            got.append(b)
+            if got.endswith(marker):
+                return True
+
+    def drain(self): # drainSerial() - discard bytes from PC until none arrive for serial_timeout
+        self.in_buf.clear()
+        while self._fill(serial_timeout):
+            self.in_buf.clear()
+
+    def abort_transfer(self, msg): # abortTransfer() - failed transfer, discard rest of transfer, then send error marker
+        self.println(msg)
+        self.drain()
+        self.println('XXError')
+
+    def write(self, data): # Serial.write()
+        self._advance(self.turnaround + len(data) * self.byte_time)
+        try:
+            os.write(self.master, bytes(data))
+        except OSError:
+            pass
+
+    def println(self, text=''): # Serial.println()
+        self.write((text + '\r\n').encode())
+
+    # ---------------- pack ----------------
+
+    def insert_pack(self, image): # take the pack out and put another in, image is pack image bytes, the rest is blank
+        # only the pack changes, the firmware can't tell, so its address counters and sizePack() cache are left as they were
+        self.mem[:] = bytes([0xFF] * 0x10000)
+        image = image[0:0x10000]
+        self.mem[0:len(image)] = image
+
+    def read_pak(self, addr, length=1, seek=True): # bytes from addr, the weak bits of flaky bytes read as 1 flaky_rate of the time
+        # seek is False for a sequential read from address 0
+        if self.addr_faults:
+            paged = (self.mem[0] & 0x04) != 0 if self.pack_paged is None else self.pack_paged
+            if (paged and not self.paged_addr) or (not paged and self.paged_addr and seek): # pack in the other mode
+                return bytearray(self.mem[a & 0xFF] for a in range(addr, addr + length))
+        dat = bytearray(self.mem[addr:addr+length])
+        if self.flaky:
+            for a in range(addr, addr + length):
+                if a in self.flaky and self.read_rnd.random() < self.flaky_rate:
+                    dat[a - addr] |= self.flaky[a]
+        return dat
+
+    def write_pak_byte(self, addr, val): # returns no. of write cycles, 0 if write failed
+        self.dir_valid = False
+        if not self.datapak_mode:
+            self._advance(self.write_time[False])
+            self.mem[addr] = val
+            return 1 if self.mem[addr] == val else 0
+        need = self.need_us[addr] if (self.mem[addr] & val) != self.mem[addr] else 0 # no bits to program, verifies 1st time
+        cycles = 0
+        while cycles < max_datapak_write_cycles: # writePakByte() cycles, until the byte verifies
+            cycles += 1
+            self._advance(self.write_time[True] + self.write_pulse * 1e-6)
+            if cycles * self.write_pulse >= need:
+                break
+        if cycles * self.write_pulse < need or (self.mem[addr] & val) != val: # EPROM bits can only go from 1 to 0
+            return 0
+        self.mem[addr] = val
+        self._advance(self.overprogram * cycles * self.write_pulse * 1e-6)
+        return cycles
+
+    def reset_cycle_stats(self): # resetCycleStats()
+        self.cycle_hist = [0] * (max_datapak_write_cycles + 1)
+        self.marginal_total = 0
+        self.marginal = [] # (address, cycles)
+
+    def count_cycles(self, addr, cycles): # countCycles()
+        self.cycle_hist[cycles] += 1
+        if cycles == 0 or cycles >= marginal_cycles:
+            self.marginal_total += 1
+            if len(self.marginal) < max_marginal:
+                self.marginal.append((addr, cycles))
+
+    def send_cycle_stats(self): # sendCycleStats()
+        self.println('XXCycles')
+        out = bytearray([self.write_pulse >> 8, self.write_pulse & 0xFF, self.overprogram, max_datapak_write_cycles])
+        for n in self.cycle_hist:
+            out += bytes([n >> 8, n & 0xFF])
+        out += bytes([self.marginal_total >> 8, self.marginal_total & 0xFF, len(self.marginal)])
+        for addr, cycles in self.marginal:
+            out += bytes([addr >> 8, addr & 0xFF, cycles])
+        self.write(out)
+        self.println()
+        self.println('(Ard) Cycles sent')
+
+    def seek_cost(self, addr): # seekAddress() planner, returns (no. of clocks, True to continue from current address)
+        page, addr_low = addr >> 8, addr & 0xFF
+        cur_page, cur_low = self.current_address >> 8, self.current_address & 0xFF
+        cont_cost = None
+        if not self.counters_valid: # 1st seek of a command resets the counters
+            return (page + addr_low if self.paged_addr else addr), False
+        if self.paged_addr:
+            reset_cost = page + addr_low
+            if addr >= self.current_address:
+                if addr_low >= cur_low:
+                    cont_cost = (page - cur_page) + (addr_low - cur_low)
+                else:
+                    cont_cost = (page - cur_page - 1) + (0x100 - cur_low) + addr_low
+        else:
+            reset_cost = addr
+            if addr >= self.current_address:
+                cont_cost = addr - self.current_address
+        if cont_cost is None or cont_cost > reset_cost:
+            return reset_cost, False
+        return cont_cost, True
+
+    def seek_address(self, addr): # seekAddress()
+        clocks, cont = self.seek_cost(addr)
+        self._advance(clocks * self.clock_time)
+        self.current_address = addr
+        self.counters_valid = True
+
+    def fingerprint(self, end): # packFingerprint() - ID bytes and the bytes at end-1 and end, the end of the record chain
+        self._advance(self.read_time * 12)
+        return bytes(self.mem[0:10]) + bytes(self.mem[end-1:end+1])
+
+    def read_dir(self): # read_dir(0) - walk records, returns address of end of pack byte and keeps it for size_pack()
+        try:
+            end = opk.pack_end(self.mem[0:max_eprom_size])
+        except ValueError:
+            end = max_eprom_size
+        end = min(end, max_eprom_size)
+        self._advance(self.read_time * end) # every byte is clocked past, even if not read
+        self.dir_fingerprint = self.fingerprint(end)
+        self.dir_end = end
+        self.dir_valid = True
+        return end
+
+    def size_pack(self): # sizePack() - cached end of pack, if pack not changed
+        if self.dir_valid and self.fingerprint(self.dir_end) == self.dir_fingerprint:
+            return self.dir_end
+        return self.read_dir()
+
+    def send_dir(self): # read_dir(2) - binary directory entries
+        out = bytearray()
+        end = None
+        try:
+            for rec in opk.walk_records(self.mem[0:max_eprom_size], limit=max_eprom_size):
+                out += bytes([rec['addr'] >> 8, rec['addr'] & 0xFF])
+                if rec['kind'] == 'end':
+                    out.append(0xFF)
+                    end = rec['addr']
+                    break
+                if rec['kind'] == 'long':
+                    out += bytes([0x02, 0x80, rec['len'] >> 8, rec['len'] & 0xFF]) + b' ' * 9
+                elif rec['kind'] == 'bad':
+                    out += bytes([rec['len_byte'], 0xFF, 0, rec['len_byte']]) + b' ' * 9
+                else:
+                    out += bytes([rec['len'], rec['type'], 0, rec['len']]) + rec['body'][0:9].ljust(9, b' ')
+        except ValueError: # record chain runs past max_eprom_size
+            pass
+        if end is None:
+            end = max_eprom_size
+            out += bytes([end >> 8, end & 0xFF, 0xFF])
+        self.write(out)
+        self.read_dir()
+        return end
+
+    def print_dir(self): # directory table, as read_dir()
+        self.println()
+        self.println('ADDR   TYPE         NAME      ID    Del? SIZE')
+        try:
+            for rec in opk.walk_records(self.mem[0:max_eprom_size]):
+                line = f'0x{rec["addr"]:04X} '
+                if rec['kind'] == 'end':
+                    self.println(line + 'End of pack')
+                    break
+                if rec['kind'] == 'long':
+                    self.println(line + f'Long record, length = 0x{rec["len"]:X}')
+                    continue
+                r_type = rec['type'] & 0x7F
+                name = rec['body'][0:9].decode('latin-1').ljust(9)
+                type_s = {1:'[Data]',2:'[Diary]',3:'[OPL]',4:'[Comms]',5:'[Sheet]',6:'[Pager]',7:'[Notes]'}.get(r_type,
+                         '[Rec]' if 0x10 <= r_type <= 0x7E else '[misc]')
+                id_s = f'  0x{rec["body"][8]:02X} ' if r_type <= 7 and rec['len'] >= 9 else '      '
+                self.println(line + f'0x{rec["type"]:02X} {type_s:<8}{name}{id_s}{" Yes  " if rec["deleted"] else " No   "}0x{rec["len"]:04X}')
+        except ValueError:
+            pass
+
+    # ---------------- commands ----------------
+
+    def print_commands(self):
+        self.println('(Ard) datapak_read_write_v1.3 (emulator)')
+        self.print_pack_mode()
+        self.print_addr_mode()
+        self.println('(Ard) Select a command:\ne - erase\nz - erase range (skips blank bytes)\nk - page checksums\nr - read pack\nw - write pack\np - patch write from address\na - read address ranges')
+        self.println('g - get page (binary)\nc - write cycle counts (binary)\nu - set datapak write pulse\nn - append records at end of pack')
+        self.println('t - write TEST record to main\nm - rampak (or datapak) mode\nl - linear (or paged) addressing')
+        self.println('i - print pack id byte flags\nd - directory and size pack\nf - directory (binary)\nb - check if pack is blank')
+        self.println('s - sync\n? - list commands\nx - exit')
+
+    def print_pack_mode(self):
+        if self.datapak_mode:
+            self.println('(Ard) Now in Datapak mode (Arduino input pullups)')
+        else:
+            self.println('(Ard) Now in Rampak mode (No Arduino input pullups)')
+
+    def print_addr_mode(self):
+        self.println('(Ard) Now in paged addressing mode' if self.paged_addr else '(Ard) Now in linear addressing mode')
+
+    def read_all(self): # readAll(2) - send pack to PC, each byte echoed back
+        end_addr = self.size_pack()
+        self.println(f'Size: 0x{end_addr:X}')
+        self.println('XXRead')
+        self.write(bytes([0, (end_addr & 0xFF00) >> 8, end_addr & 0xFF]))
+        for addr in range(end_addr + 1):
+            self._advance(self.read_time)
+            dat = self.read_pak(addr, seek=False)[0]
+            self.write(bytes([dat]))
+            datr = self.read_byte(serial_timeout)
+            if datr is None:
+                self.abort_transfer('(Ard) Timeout!')
+                return 0
+            if datr != dat:
+                self.abort_transfer('(Ard) Read data not verified by PC!')
+                return 0
+        self.current_address = end_addr
+        return end_addr
+
+    def read_range(self, start, num_bytes): # readRangeSerial() - send num_bytes+1 bytes from start, each byte echoed back
+        self.seek_address(start)
+        for i in range(num_bytes + 1):
+            self._advance(self.read_time)
+            dat = self.read_pak((start + i) & 0xFFFF)[0]
+            self.write(bytes([dat]))
+            datr = self.read_byte(serial_timeout)
+            if datr is None:
+                self.abort_transfer('(Ard) Timeout!')
+                return False
+            if datr != dat:
+                self.abort_transfer('(Ard) Read data not verified by PC!')
+                return False
+            self.current_address = (start + i) & 0xFFFF
+        return True
+
+    def write_serial(self, start, num_bytes): # writePakSerial() - write num_bytes+1 bytes from PC, each byte echoed
+        self.reset_cycle_stats()
+        if self.datapak_mode:
+            self.current_address = 0 # setAddress()
+        self.seek_address(start)
+        for i in range(num_bytes + 1):
+            datw = self.read_byte(serial_timeout)
+            if datw is None:
+                self.abort_transfer('(Ard) Timeout!')
+                return False
+            self.write(bytes([datw]))
+            cycles = self.write_pak_byte((start + i) & 0xFFFF, datw)
+            self.count_cycles((start + i) & 0xFFFF, cycles)
+            if cycles == 0:
+                self.abort_transfer('(Ard) Write byte failed!')
+                return False
+            self.current_address = (start + i) & 0xFFFF
+        self.println('(Ard) Write done ok')
+        return True
+
+    def erase_bytes(self, addr, num_bytes): # eraseBytes() - skips bytes already 0xFF, returns no. of bytes written
+        self.seek_address(addr)
+        self.write(b'(Ard) Erasing:')
+        written = 0
+        for i in range(num_bytes + 1):
+            a = (addr + i) & 0xFFFF
+            self._advance(self.read_time)
+            if self.mem[a] != 0xFF:
+                if self.write_pak_byte(a, 0xFF) == 0:
+                    self.println('(Ard) Erase failed!')
+                    return written
+                written += 1
+            if (a & 0xFF) == 0xFF:
+                self.write(b'.')
+            self.current_address = a
+        self.println('')
+        self.println('(Ard) Erased ok')
+        return written
+
+    def page_checksum(self, page): # pageChecksum() - CRC-16/CCITT of page
+        self.seek_address(page << 8)
+        self._advance(self.read_time * 0x100)
+        self.current_address = (page << 8) + 0xFF
+        return binascii.crc_hqx(self.read_pak(page << 8, 0x100), 0xFFFF)
+
+    def send_page(self, page): # sendPage() - 256 bytes of page as binary
+        self.seek_address(page << 8)
+        self._advance(self.read_time * 0x100)
+        self.write(self.read_pak(page << 8, 0x100))
+        self.current_address = (page << 8) + 0xFF
+
+    def command(self, key):
+        self.counters_valid = False # pack may have been swapped since the last command
+        if key == 'e':
+            if not self.datapak_mode:
+                self.println('(Ard) Erase 512 bytes:')
+                self.erase_bytes(0, 512)
+            else:
+                self.println("(Ard) Can't erase a Datapak! Use UV lamp, or a Rampak")
+        elif key == 'z':
+            self.println('(Ard) Erase range')
+            if self.find('XXErase'):
+                rng = self.read_bytes(4)
+                if len(rng) == 4:
+                    start = (rng[0] << 8) + rng[1]
+                    num_bytes = (rng[2] << 8) + rng[3]
+                    if not self.datapak_mode:
+                        written = self.erase_bytes(start, num_bytes)
+                        self.println(f'(Ard) Erase range: {start:04x} to {(start + num_bytes) & 0xFFFF:04x}, written: {written:04x}')
+                    else:
+                        self.println("(Ard) Can't erase a Datapak! Use UV lamp, or a Rampak")
+                else:
+                    self.abort_transfer('(Ard) Wrong no. of range bytes sent!')
+            else:
+                self.abort_transfer('(Ard) No XXErase to begin range')
+        elif key == 'k':
+            self.println('(Ard) Page checksums')
+            if self.find('XXSum'):
+                pages = self.read_bytes(2)
+                if len(pages) == 2:
+                    self.println('XXSum')
+                    for page in range(pages[0], pages[1] + 1):
+                        crc = self.page_checksum(page)
+                        self.write(bytes([crc >> 8, crc & 0xFF]))
+                    self.println('(Ard) Sums sent')
+                else:
+                    self.abort_transfer('(Ard) Wrong no. of page bytes sent!')
+            else:
+                self.abort_transfer('(Ard) No XXSum to begin pages')
+        elif key == 'w':
+            write_ok = False
+            self.println('(Ard) Write Serial data to pack')
+            if self.find('XXWrite'):
+                size = self.read_bytes(2)
+                if len(size) == 2:
+                    num_bytes = (size[0] << 8) + size[1]
+                    write_ok = self.write_serial(0, num_bytes)
+                    self.println(f'(Ard) Pack size to write was: {num_bytes:04x} bytes')
+                else:
+                    self.abort_transfer('(Ard) Wrong no. of size bytes sent!')
+            else:
+                self.abort_transfer('(Ard) No XXWrite to begin data')
+            if not write_ok:
+                self.println('(Ard) Write failed!')
+        elif key == 'p':
+            write_ok = False
+            self.println('(Ard) Patch write Serial data to pack')
+            if self.find('XXPatch'):
+                patch = self.read_bytes(4)
+                if len(patch) == 4:
+                    start = (patch[0] << 8) + patch[1]
+                    num_bytes = (patch[2] << 8) + patch[3]
+                    write_ok = self.write_serial(start, num_bytes)
+                    self.println(f'(Ard) Patch written: {start:04x} to {(start + num_bytes) & 0xFFFF:04x}')
+                else:
+                    self.abort_transfer('(Ard) Wrong no. of patch bytes sent!')
+            else:
+                self.abort_transfer('(Ard) No XXPatch to begin data')
+            if not write_ok:
+                self.println('(Ard) Patch write failed!')
+        elif key == 'n':
+            write_ok = False
+            self.println('(Ard) Append records')
+            if self.find('XXAppend'):
+                append = self.read_bytes(4)
+                if len(append) == 4:
+                    start = (append[0] << 8) + append[1]
+                    num_bytes = (append[2] << 8) + append[3]
+                    new_end = start + num_bytes + 1
+                    self._advance(self.read_time * 2)
+                    if self.size_pack() != start:
+                        self.abort_transfer('(Ard) End of pack is not at the append address!')
+                    elif new_end > 0xFFFF:
+                        self.abort_transfer('(Ard) Records go past the end of 64k!')
+                    elif self.mem[start] != 0xFF:
+                        self.abort_transfer('(Ard) No 0xFF byte to append records!')
+                    elif self.datapak_mode and self.mem[new_end] != 0xFF:
+                        self.abort_transfer('(Ard) No 0xFF byte after the records!')
+                    else:
+                        self.println('XXAppend')
+                        write_ok = self.write_serial(start, num_bytes)
+                        if write_ok and self.mem[new_end] != 0xFF: # rampak with old data after the records
+                            write_ok = self.write_pak_byte(new_end, 0xFF) > 0
+                            if not write_ok:
+                                self.abort_transfer('(Ard) End of pack byte write failed!')
+                        if write_ok:
+                            self.dir_end = new_end
+                            self.dir_fingerprint = self.fingerprint(new_end)
+                            self.dir_valid = True
+                            self.println(f'(Ard) Append written: {start:04x} to {start + num_bytes:04x}')
+                else:
+                    self.abort_transfer('(Ard) Wrong no. of append bytes sent!')
+            else:
+                self.abort_transfer('(Ard) No XXAppend to begin records')
+            if not write_ok:
+                self.println('(Ard) Append failed!')
+        elif key == 'a':
+            self.println('(Ard) Read range')
+            if self.find('XXRange'):
+                count = self.read_bytes(1)
+                count = count[0] if count else 0
+                rng = self.read_bytes(4 * count) if count <= max_ranges else b''
+                if count > 0 and len(rng) == 4 * count:
+                    ranges = [((rng[i] << 8) + rng[i+1], (rng[i+2] << 8) + rng[i+3]) for i in range(0, len(rng), 4)]
+                    self.println('XXRange')
+                    if all(self.read_range(start, num_bytes) for start, num_bytes in ranges): # stops at the 1st that fails
+                        start, num_bytes = ranges[-1]
+                        self.println(f'(Ard) Range read: {count:d} ranges, {ranges[0][0]:04x} to {(start + num_bytes) & 0xFFFF:04x}')
+                else:
+                    self.abort_transfer('(Ard) Wrong no. of range bytes sent!')
+            else:
+                self.abort_transfer('(Ard) No XXRange to begin range')
+        elif key == 'c':
+            self.send_cycle_stats()
+        elif key == 'u':
+            self.println('(Ard) Set write pulse')
+            if self.find('XXPulse'):
+                pulse = self.read_bytes(3)
+                if len(pulse) == 3:
+                    pulse_us = (pulse[0] << 8) + pulse[1]
+                    if 10 <= pulse_us <= 2000:
+                        self.write_pulse = pulse_us
+                        self.overprogram = pulse[2]
+                    else:
+                        self.println('(Ard) Write pulse out of range!')
+                else:
+                    self.abort_transfer('(Ard) Wrong no. of pulse bytes sent!')
+            else:
+                self.abort_transfer('(Ard) No XXPulse to begin pulse')
+            self.println(f'(Ard) Write pulse: {self.write_pulse:d} us, overprogram: {self.overprogram:d}')
+        elif key == 'r':
+            end_addr = self.read_all()
+            self.println(f'(Ard) Size of pack is: 0x{end_addr:04x} bytes')
+        elif key == 'g':
+            self.println('(Ard) Get page')
+            if self.find('XXPage'):
+                page = self.read_bytes(1)
+                if len(page) == 1:
+                    self.println('XXPage')
+                    self.send_page(page[0])
+                    self.println('(Ard) Page sent')
+                else:
+                    self.abort_transfer('(Ard) No page no. sent!')
+            else:
+                self.abort_transfer('(Ard) No XXPage to begin page')
+        elif key == 't':
+            self.println('(Ard) add record to Main')
+            end_addr = self.size_pack()
+            self.println(f'Pack size (from dir) is: {end_addr:X}')
+            rec = b'--The quick brown fox jumps over the lazy dog.'
+            rec = bytes([len(rec) - 2, 0x90]) + rec[2:]
+            if self.mem[end_addr] == 0xFF:
+                done_ok = all(self.write_pak_byte(end_addr + i, b) for i, b in enumerate(rec))
+                if done_ok:
+                    self.dir_end = end_addr + len(rec)
+                    self.dir_fingerprint = self.fingerprint(self.dir_end)
+                    self.dir_valid = True
+                self.println('(Ard) add record done successfully' if done_ok else '(Ard) add record failed!')
+            else:
+                self.println('(Ard) no 0xFF byte to add record!')
+        elif key == 'm':
+            self.datapak_mode = not self.datapak_mode
+            self.dir_valid = False
+            self.print_pack_mode()
+        elif key == 'l':
+            self.paged_addr = not self.paged_addr
+            self.current_address = 0
+            self.dir_valid = False
+            self.print_addr_mode()
+        elif key == 'i':
+            id_b = self.mem[0]
+            self.println()
+            self.println(f'Id Flags: 0x{id_b:X}')
+            flags = [('invalid','valid'),('datapak','rampak'),('paged','linear'),('not write protected','write protected'),
+                     ('non-bootable','bootable'),('copyable','copy protected'),('standard','flashpak or debug RAM pak'),('MK1','MK2')]
+            for bit, (set_s, clear_s) in enumerate(flags):
+                self.println(f'{bit:d}: {set_s if id_b & (1 << bit) else clear_s}')
+            self.println(f'Size: {(self.mem[1] * 8) & 0xFF:d} kB')
+        elif key == 'd':
+            self.print_dir()
+            self.println(f'pack size is: 0x{self.read_dir():X}')
+        elif key == 'f':
+            self.println('XXDir')
+            end = self.send_dir()
+            self.println()
+            self.println(f'(Ard) Dir sent, pack size is: 0x{end:X}')
+        elif key == 'b':
+            self.println("\nBlank Check in 1k chunks '.'-blank 'x'-not blank")
+            blank = True
+            for k in range(max_eprom_size // 1024):
+                blank_1k = self.mem[k*1024:(k+1)*1024].count(0xFF) == 1024
+                blank = blank and blank_1k
+                self.write(b'.' if blank_1k else b'x')
+            self.println('\nIs pack blank? : ' + ('Yes' if blank else 'No'))
+        elif key == '?':
+            self.print_commands()
+        elif key == 's':
+            self.println('XXSync')
+        elif key == 'x':
+            self.println('(Ard) Please Remove Rampak/Datapak')
+            self.println('XXExit')
+            self.exited = True
+        else:
+            self.println('(Ard) Command not recognised!')
+
+    def run(self):
+        self.print_pack_mode()
+        self.print_addr_mode()
+        if self.wait_enter:
+            self.println('(Ard) Please connect Rampak/Datapak, then press Enter...')
+            while self.running and self.read_byte(0.1) != 10: # wait for Enter
+                pass
+            self.print_commands()
+        while self.running:
+            key = self.read_byte(0.1)
+            if key is None or self.exited: # after exit, Arduino stays in an endless loop
+                continue
+            self.command(chr(key))
+
+    def stop(self):
+        self.running = False
+        self.join(1.0)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def open_emulator(image=b'', timeout=0.5, **kwargs): # start emulator and open its port, image is pack image bytes or OPK filename
+    if isinstance(image, str):
+        size, image = opk.read_opk(image)
+    emu = PakEmulator(image, wait_enter=False, **kwargs)
+    emu.start()
+    try:
+        import serial # uses pyserial, if installed
+        ser = serial.Serial(emu.port, timeout=timeout)
+    except ImportError:
+        ser = PtySerial(emu.port, timeout)
+    return emu, ser
+
+if __name__ == '__main__': # run an emulator for PC_Psion2_datapak_read_write, set SerialPort to the port printed
+    image_file = "testpak.opk"
+    size, image = opk.read_opk(image_file)
+    emu = PakEmulator(image, datapak_mode=False)
+    emu.start()
+    print(f'Emulator of {image_file:s} on port: {emu.port:s}')
+    print('Press Ctrl-C to stop')
+    try:
+        while emu.is_alive():
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        emu.stop()
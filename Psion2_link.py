@@ -0,0 +1,994 @@
+# -*- coding: utf-8 -*-
+"""
+PC side of the serial link to the Datapak/Rampak Reader/Writer
+
+Created: Oct 2026
+
+@author: martin
+
+The read, write and patch write transfers from PC_Psion2_datapak_read_write,
+in a Link class that takes the serial port, so they can also be used by other programs,
+e.g. the benchmarks with the device emulator in Psion2_emulator.py
+
+ser can be a pyserial Serial or anything with the same read, write, readline and inWaiting methods and timeout attribute
+
+Protocol states:
+    idle - Arduino is waiting for a command key
+    command - command key sent, waiting for the Arduino to start the transfer
+    transfer - pack data being sent or received, each byte echoed back
+    error - transfer failed, the link is resynchronised before it's used again
+
+During a transfer each byte must arrive within byte_timeout. If a transfer fails, the Arduino
+abandons it, discards bytes until the PC stops sending, then sends "XXError".
+resync() waits for the link to go quiet, sends the s command and waits for "XXSync",
+so the link is back in the idle state without resetting the Arduino.
+
+Pages (g command) are sent as binary, 256 bytes without echo, and formatted on the PC with opk.hex_dump().
+
+The directory (f command) is sent as binary entries and parsed here into a list of dicts, cached for the session,
+keyed by the 10 ID bytes (the pack fingerprint), and cleared after any write or erase.
+
+Page checksums (k command) are a CRC-16/CCITT of each page, same as binascii.crc_hqx(page, 0xFFFF).
+erase_used() erases (z command) only the pages up to the end of pack that aren't blank, the Arduino also skips
+bytes that are already 0xFF, then checks every page is blank with the checksums.
+
+append_records() adds records at the end of pack with the n command, only the new bytes are sent, after the end of pack
+from the (cached) directory. The Arduino checks the pack still ends there, and a rampak gets a new end of pack byte.
+
+write_sparse() writes only the data extents of an image with p commands, the 0xFF runs are skipped,
+so the pack must be blank (a new datapak or an erased rampak). The pages are then checked with the k command.
+
+During a read the bytes are parsed into records as they arrive (opk.RecordParser), so the directory is
+known before the read ends, and the read can stop at the end of pack byte (plus a margin), or when on_record says so.
+A read is stopped by sending a wrong echo, the Arduino aborts at once and the link is resynchronised.
+
+Datapak write cycle counts (c command): for the last write, the no. of bytes that took each no. of write cycles (pulses)
+to verify, and the addresses of the first marginal bytes (2 or more cycles, or failed). The u command sets the write pulse
+and overprogram factor. write_adaptive() writes a datapak in chunks, and after each chunk a PulseTuner shortens the
+pulse while nearly every byte takes 1 cycle (not below min_pulse), lengthens it if many need 2, and warns when a chip
+is marginal (bytes needing 3 or more cycles, or failing), before the write fails part way. The pulse and overprogram
+factor the write started with are set again at the end, so later writes don't use the tuned pulse. log_cycles() adds the counts to a histogram for each pack, keyed by its ID bytes.
+
+read_voted() is a recovery read for an old datapak with weak bits, that read differently each time. The pages are read with
+the g command up to the end of pack, and the Arduino sends the page checksums (k command) as a 2nd read, so only the pages
+that don't match are read again, passes times, and voted bit by bit. A good pack costs little more than one read.
+The bytes that weren't the same in every read are listed in outfile.vote, with the confidence of each vote.
+
+auto_addr_mode() reads the ID bytes, which read the same in either addressing mode, sets the Arduino to the addressing
+mode of bit 2 of the ID byte (paged or linear) with the l command, then gets pages 0 and 1 and checks the record chain
+across them, so a pack in the wrong mode is found in a few hundred bytes, before a full read. In the wrong mode page 1
+usually reads as page 0 again. If the pages look wrong the other mode is tried.
+
+Range reads (a command) send only the bytes from a start address, e.g. the ID bytes, a directory or one long record.
+read_ranges() sorts and merges the ranges to read them in address order, ranges closer than merge_gap are read as one,
+and sends up to max_ranges of them in one a command (read_plan()). Within the command the Arduino counters only count up,
+so each range continues from the end of the last one if that's quicker than a reset. Each command starts from a reset
+of the counters, as the pack may have been swapped since the last command.
+"""
+
+import binascii
+import json
+import os
+import time
+
+import OPK_lib as opk
+
+IDLE = 'idle'
+COMMAND = 'command'
+TRANSFER = 'transfer'
+ERROR = 'error'
+
+sync_marker = 'XXSync' # reply to s command
+error_marker = 'XXError' # sent by Arduino after a failed transfer
+
+class LinkError(Exception): # timeout, verify failure or error marker during a transfer
+    pass
+
+def print_byte(addr, n): # print address, hex value and character, as for the read & write transfers
+    if 31 < n < 127: # if printable character
+        n2 = n
+    else: # else replace non-printable character
+        n2 = 46 # character "."
+    print(f'{addr:04x} {n:02x} {chr(n2):s}  ', end='')
+
+def print_header_byte(addr, n, data): # print description of ID byte addr, value n, data is list of previous ID bytes
+    if addr == 0:
+        print(f'0: ID byte: {n:02x}')
+    elif addr == 1:
+        print(f'1: Pack size is: {n*8:d} kB')
+    elif (data[0] & 0x10) != 0x10: # bootable pack
+        bootable_header = {2:{'txt':'code type',0:'software',1:'hardware'},
+                           3:{'txt':'id',0xc0:'RS232',0xbf:'bar code reader',0xbe:'swipe card reader',0x0a:'concise oxford spelling checker'},
+                           4:{'txt':'version (binary coded decimal: 0xnm for version n.m'},
+                           5:{'txt':'priority (can be same as id)'},
+                           6:{'txt':'boot code pack address (high)'},
+                           7:{'txt':'boot code pack address (low)'}}
+        if addr >= 2 and addr <= 3:
+            try:
+                print(f'{addr:d}: {bootable_header[addr]["txt"]}: {bootable_header[addr][n]}')
+            except:
+                print(f'{addr:d}: {bootable_header[addr]["txt"]}: unknown')
+        if addr >= 4:
+            print(f'{addr:d}: {bootable_header[addr]["txt"]}: 0x{n:02x}')
+        if addr == 7:
+            print(f'boot code pack address: 0x{data[6]:02x}{n:02x}')
+    else: # standard pack
+        standard_header = {2:['Year at time of sizing was {:d}','n+1900'],
+                           3:['Month at time of sizing was {:d}','n+1'],
+                           4:['Day at time of sizing was {:d}','n+1'],
+                           5:['Hour at time of sizing was {:d}','n'],
+                           6:['Free Running Counter (High) at time of sizing was 0x{:02x}','n'],
+                           7:['Free Running Counter (Low) at time of sizing was 0x{:02x}','n']}
+        print(f'{addr:d}:',standard_header[addr][0].format(eval(standard_header[addr][1])))
+        if addr == 7:
+            FRCT = (data[6]<<8) + n
+            print(f"Free Running Counter (Total) at time of sizing was {FRCT:d} 0x{FRCT:04x}")
+
+def prepare_image(infile, set_Rampak_ID=False, set_paged=False, set_write_protect=False, update_checksum=False,
+                  set_pack_size=False, pack_size_out=4, verbose=True): # read OPK file & modify ID bytes for write, returns image or None
+    with open(infile,'rb') as f_in:
+        data = f_in.read(3) # Should be "OPK"
+        header = data.decode('utf-8','ignore')
+        if verbose:
+            print(f'(PC) OPK header: "{header:s}"')
+        if header != "OPK":
+            print("Error! Not an OPK file!")
+            return None
+        size_hh, size_h, size_l = f_in.read(3)
+        f_in_size = (size_hh << 16) + (size_h << 8) + size_l # shift size_h left 16 bits, size_h left 8 bits
+        if verbose:
+            print(f'(PC) Pack image size: size_hh: 0x{size_hh:02x}, size_h: 0x{size_h:02x}, size_l: 0x{size_l:02x}, size: 0x{f_in_size:06x}')
+        if f_in_size > 0xFFFF:
+            print("(PC) File too big to write!")
+            return None
+        image = bytearray(f_in.read(f_in_size + 1)) # up to and including end of pack byte
+    image += bytes([0xFF] * (f_in_size + 1 - len(image))) # file shorter than size in header
+
+    data = [] # first 10 bytes (0-9) for checksum
+    for addr in range(min(10, len(image))):
+        n = image[addr]
+        # bytes to be modified:
+        if addr == 0:
+            if set_Rampak_ID == True:
+                n = n & 0b11111101 # clear bit 1 - rampak
+            if set_paged == True:
+                n = n | 0b100 # set bit 2 - Paged
+            if set_write_protect == True:
+                n = n & 0b11110111 # clear bit 3 - write_protect
+        if addr == 1 and set_pack_size == True:
+            if verbose:
+                print(f'1: Pack size was: {n*8:d} kB, now is: {pack_size_out*8:d} kB')
+            n = pack_size_out
+        elif addr <= 7 and verbose:
+            print_header_byte(addr, n, data)
+        data.append(n) # store bytes for checksum, must include modified bytes
+        # checksum bytes:
+        if update_checksum == True and addr == 8: # update checksum if True
+            CHKSUM = (data[0]<<8) + data[1] + (data[2]<<8) + data[3] + (data[4]<<8) + data[5] + (data[6]<<8) + data[7]
+            CHKSUM = CHKSUM & 0xFFFF # mask for 16 bits
+            if verbose:
+                print(f'Checksum:')
+                print(f'8: chk_h = 0x{CHKSUM >> 8:02x}')
+                print(f'9: chk_l = 0x{CHKSUM & 0xFF:02x}')
+                print(f'Checksum (calculated) is: {CHKSUM:d} 0x{CHKSUM:04x}')
+            n = CHKSUM >> 8
+            image[9] = CHKSUM & 0xFF
+        image[addr] = n
+    return bytes(image)
+
+merge_gap = 16 # ranges closer than this are read as one, cheaper than another range
+max_ranges = 16 # ranges read by one a command, as the Arduino
+
+blank_page_sum = binascii.crc_hqx(bytes([0xFF] * 0x100), 0xFFFF) # checksum of an erased page
+
+def plan_ranges(ranges, gap=merge_gap): # sort & merge list of (addr, length), returns list of (addr, length) to read
+    plan = []
+    for addr, length in sorted(r for r in ranges if r[1] > 0):
+        if plan and addr <= plan[-1][0] + plan[-1][1] + gap:
+            start = plan[-1][0]
+            plan[-1] = (start, max(plan[-1][1], addr + length - start))
+        else:
+            plan.append((addr, length))
+    return plan
+
+min_pulse = 100 # us, shortest pulse PulseTuner sets, the firmware default - a shorter pulse can verify on the Arduino,
+# but not be read by the Psion, and the cycle counts come from the Arduino's verify, so they can't show it
+max_pulse = 1000 # us, longest pulse PulseTuner sets
+marginal_limit = 0.02 # share of bytes needing 3 or more cycles (or failing) that marks a datapak as marginal
+adaptive_chunk = 0x400 # bytes written by write_adaptive() between checks of the cycle counts
+
+class PulseTuner(): # datapak write pulse & overprogram factor, tuned from the write cycle counts of each chunk written
+    def __init__(self, pulse, overprogram):
+        self.pulse = pulse
+        self.overprogram = overprogram
+        self.floor = min_pulse # pulse isn't shortened below this again, once a shorter one needed 2 cycles
+
+    def update(self, stats): # tune from cycle counts (write_cycles()), returns a warning or None
+        hist = stats['hist'] # no. of bytes for each no. of cycles, [0] is failed bytes
+        total = sum(hist)
+        if total == 0:
+            return None
+        slow = hist[0] + sum(hist[3:]) # failed, or 3 or more cycles, far from a good byte
+        if slow > marginal_limit * total:
+            self.pulse = min(max_pulse, self.pulse * 3 // 2)
+            self.overprogram = max(self.overprogram, 3) # as EPROM datasheets
+            self.floor = self.pulse
+            first = ', '.join(f'0x{a:04x}' for a, c in stats['marginal'][0:4])
+            return f'Marginal datapak: {slow:d} of {total:d} bytes failed or needed 3 or more cycles, first at: {first:s}'
+        if hist[2] > total // 4: # pulse too short for most bytes of this chip
+            self.pulse = min(max_pulse, self.pulse * 5 // 4)
+            self.floor = self.pulse
+        elif total - hist[1] <= marginal_limit * total: # nearly all in 1 cycle, try a shorter pulse
+            self.pulse = max(self.floor, self.pulse * 4 // 5)
+        return None
+
+def log_cycles(logfile, pack_id, stats): # add write cycle counts to the histogram for pack_id (ID bytes) in JSON logfile
+    log = {}
+    if os.path.exists(logfile):
+        with open(logfile) as f:
+            log = json.load(f)
+    key = bytes(pack_id).hex()
+    entry = log.setdefault(key, {'hist':[0] * len(stats['hist']), 'writes':0, 'marginal':[]})
+    entry['hist'] = [a + b for a, b in zip(entry['hist'], stats['hist'])]
+    entry['writes'] += 1
+    entry['pulse'] = stats['pulse']
+    entry['overprogram'] = stats['overprogram']
+    entry['marginal'] = sorted(set(tuple(m) for m in entry['marginal']) | set(stats['marginal']))[0:256]
+    with open(logfile, 'w') as f:
+        json.dump(log, f, indent=1)
+    return entry
+
+dir_types = {1:'[Data]',2:'[Diary]',3:'[OPL]',4:'[Comms]',5:'[Sheet]',6:'[Pager]',7:'[Notes]'} # same as Arduino read_dir()
+
+def parse_dir_entry(entry): # 15 byte binary directory entry (3 bytes for end of pack), returns dict
+    addr = (entry[0] << 8) + entry[1]
+    if entry[2] == 0xFF:
+        return {'addr':addr, 'kind':'end'}
+    rec_type = entry[3]
+    kind = 'long' if rec_type == 0x80 else 'bad' if rec_type == 0xFF else 'short'
+    return {'addr':addr, 'kind':kind, 'len_byte':entry[2], 'type':rec_type, 'size':(entry[4] << 8) + entry[5],
+            'name':entry[6:15], 'deleted':kind == 'short' and rec_type < 0x80}
+
+def file_ids(entries): # datafile IDs used by the datafile headers in directory entries, deleted or not
+    return {e['name'][8] for e in entries if e['kind'] == 'short' and (e['type'] | 0x80) == 0x81}
+
+def voted_end(image): # address of the end of pack byte in the pages read so far, None if the records run on past them
+    try:
+        for rec in opk.walk_records(image, limit=len(image)):
+            pass
+    except ValueError:
+        return None
+    return rec['addr'] if rec['addr'] < len(image) else None
+
+def check_first_pages(dat): # first 2 pages dat of a pack, returns why they look read in the wrong addressing mode, or None
+    if dat[0:0x100] == dat[0x100:0x200] and dat[0:0x100].count(0xFF) < 0x100:
+        return 'page 1 is the same as page 0'
+    ids = {0x90} # MAIN
+    prev = None
+    try:
+        for rec in opk.walk_records(dat, limit=len(dat)):
+            if rec['kind'] == 'end':
+                return None
+            if rec['kind'] == 'short' and (rec['type'] | 0x80) == 0x81 and rec['len'] >= 9:
+                ids.add(rec['body'][8])
+            if rec['addr'] + rec['skip'] > 0x100 and opk.record_confidence(dat, rec, prev, ids) < opk.salvage_min:
+                return f'unlikely record at 0x{rec["addr"]:04x}'
+            prev = rec
+    except ValueError: # record runs on past page 1
+        pass
+    return None
+
+def format_dir(entries): # directory table lines, same layout as the d command
+    yield 'ADDR   TYPE         NAME      ID    Del? SIZE'
+    for e in entries:
+        line = f'0x{e["addr"]:04X} '
+        if e['kind'] == 'end':
+            yield line + 'End of pack'
+        elif e['kind'] == 'long':
+            yield line + f'Long record, length = 0x{e["size"]:X}'
+        else:
+            r_type = e['type'] & 0x7F
+            type_s = dir_types.get(r_type, '[Rec]' if 0x10 <= r_type <= 0x7E else '[misc]')
+            name = e['name'].decode('latin-1')
+            id_s = f'  0x{e["name"][8]:02X} ' if r_type <= 7 else '      '
+            yield line + f'0x{e["type"]:02X} {type_s:<8}{name}{id_s}{" Yes  " if e["deleted"] else " No   "}0x{e["size"]:04X}'
+
+class Link(): # protocol state machine for one serial port
+    def __init__(self, ser, byte_timeout=0.1, line_timeout=2.0, verbose=True):
+        self.ser = ser
+        self.byte_timeout = byte_timeout # max wait for next byte in a transfer, Arduino uses 100 ms
+        self.line_timeout = line_timeout # max wait for next line of a message
+        self.verbose = verbose
+        self.state = IDLE
+        self.dir_cache = {} # ID bytes + last record byte & end of pack byte: directory entries
+        self.paged_addr = None # Arduino addressing mode set by set_addr_mode(), None if not known
+
+    def set_timeout(self, timeout): # only change when needed, pyserial reconfigures the port
+        if self.ser.timeout != timeout:
+            self.ser.timeout = timeout
+
+    def read_exact(self, n, timeout): # blocking read of n bytes with a deadline, raises LinkError if they don't arrive in time
+        deadline = time.time() + timeout
+        data = b''
+        while len(data) < n:
+            wait = deadline - time.time()
+            if wait <= 0:
+                raise LinkError(f'Timeout! {len(data):d} of {n:d} bytes from Arduino')
+            self.set_timeout(wait)
+            data += self.ser.read(n - len(data))
+        return data
+
+    def read_line(self, timeout): # returns next line from Arduino without unwanted characters, or None if timeout
+        self.set_timeout(timeout)
+        msg = self.ser.readline()
+        if msg == bytes():
+            return None
+        return "".join(i for i in msg.decode('utf-8','ignore') if 32 <= ord(i) <= 126) # remove unwanted characters
+
+    def expect(self, until, timeout=None): # read & print lines until one starts with until, returns the line
+        # timeout is the max wait for each line, raises LinkError on timeout or error marker
+        timeout = self.line_timeout if timeout is None else timeout
+        while True:
+            msg_s = self.read_line(timeout)
+            if msg_s is None:
+                raise LinkError(f'Timeout! No {until:s} from Arduino')
+            if self.verbose:
+                print(msg_s)
+            if msg_s.startswith(until):
+                return msg_s
+            if msg_s.startswith(error_marker):
+                raise LinkError('Arduino reported an error')
+
+    def command(self, key, until=None): # send command key, if until is set wait for the line that starts the transfer
+        if self.state != IDLE:
+            self.resync()
+        self.ser.write(key.encode())
+        self.state = COMMAND
+        if until is not None:
+            return self.expect(until)
+        return None
+
+    def fail(self, err): # transfer failed, print error and get back to idle state
+        self.state = ERROR
+        print(f'\n(PC) {err}')
+        self.resync()
+
+    def resync(self, attempts=3): # wait for link to go quiet, then s command until Arduino replies XXSync
+        self.state = ERROR
+        for i in range(attempts):
+            self.set_timeout(self.byte_timeout * 2) # quiet for longer than Arduino timeout, so it has stopped discarding bytes
+            while self.ser.read(256): # discard anything left from the failed transfer
+                pass
+            self.ser.write(b's')
+            try:
+                self.expect(sync_marker, self.byte_timeout * 5)
+                self.state = IDLE
+                return True
+            except LinkError:
+                pass
+        print("(PC) Resync failed! Check the Arduino is connected")
+        return False
+
+    def done(self): # transfer finished, Arduino prints its result and is back in the idle state
+        self.state = IDLE
+
+    def send_echoed(self, start, data): # send data bytes, each echoed back by the Arduino for verify, raises LinkError
+        ser = self.ser
+        verbose = self.verbose
+        self.state = TRANSFER
+        self.set_timeout(self.byte_timeout)
+        for i, n in enumerate(data):
+            dat_out = bytes([n])
+            ser.write(dat_out)
+            dat_in = ser.read(1) # read check byte back from Arduino, waits up to byte_timeout
+            if dat_in == bytes(): # no byte from read!
+                raise LinkError('Timeout! No echo from Arduino')
+            if verbose:
+                print_byte(start + i, dat_in[0])
+                if (i + 1) % 0x08 == 0: # newline every 8 bytes
+                    print("")
+            if dat_in != dat_out:
+                raise LinkError('Write data not verified by Arduino!')
+        if verbose:
+            print("") # newline at end
+
+    def write_pak(self, infile, set_Rampak_ID=False, set_paged=False, set_write_protect=False, update_checksum=False,
+                  set_pack_size=False, pack_size_out=4): # send infile to Arduino after the w command, returns True if written
+        self.invalidate()
+        if self.verbose:
+            print("(PC) Write")
+        image = prepare_image(infile, set_Rampak_ID, set_paged, set_write_protect, update_checksum,
+                              set_pack_size, pack_size_out, self.verbose)
+        try:
+            self.expect('(Ard) Write Serial data') # Arduino is ready for XXWrite
+            if image is None:
+                self.ser.write("XXNone".encode()) # anything but XXWrite, Arduino will time out and fail the write
+                self.done()
+                return False
+            f_in_size = len(image) - 1
+            self.ser.write("XXWrite".encode()) # encode to bytes - tells Arduino that following bytes are for write to datapak
+            self.ser.write(bytes([(f_in_size & 0xFF00) >> 8, f_in_size & 0xFF])) # send high byte, low byte, so max size is 64k!!
+            if self.verbose:
+                print(f'(PC) size_h: 0x{(f_in_size & 0xFF00) >> 8:02x}, size_l: 0x{f_in_size & 0xFF:02x}')
+            self.send_echoed(0, image)
+        except LinkError as err:
+            self.fail(err)
+            return False
+        self.done()
+        return True
+
+    def write_patch(self, patch_base, patchfile, blank_tail=True): # send difference between 2 OPK files after the p command
+        self.invalidate()
+        if self.verbose:
+            print("(PC) Patch write")
+        try:
+            base_size, base = opk.read_opk(patch_base)
+            new_size, new = opk.read_opk(patchfile)
+            plan = opk.write_plan(base, new, blank_tail)
+        except (OSError, ValueError) as err:
+            print(f'(PC) Error! {err}')
+            plan = None
+        if plan is not None and plan[0] + len(plan[1]) - 1 > 0xFFFF:
+            print("(PC) Patch too big to write!")
+            plan = None
+        try:
+            self.expect('(Ard) Patch write') # Arduino is ready for XXPatch
+            if plan is None:
+                print("(PC) Nothing to patch")
+                self.ser.write("XXNone".encode()) # anything but XXPatch, Arduino will time out and fail the patch
+                self.done()
+                return False
+            start, data = plan
+            if self.verbose:
+                print(f'(PC) Patch: 0x{len(data):04x} bytes from 0x{start:04x} to 0x{start+len(data)-1:04x}')
+            self.ser.write("XXPatch".encode()) # encode to bytes - tells Arduino that following bytes are for patch write to pack
+            self.ser.write(bytes([(start & 0xFF00) >> 8, start & 0xFF])) # start address high, low bytes
+            self.ser.write(bytes([((len(data)-1) & 0xFF00) >> 8, (len(data)-1) & 0xFF])) # last offset high, low bytes
+            self.send_echoed(start, data)
+        except LinkError as err:
+            self.fail(err)
+            return False
+        self.done()
+        return True
+
+    def send_patch(self, start, data): # p command for data at start, waits for the result, returns True if written
+        try:
+            self.command('p', '(Ard) Patch write')
+            self.ser.write("XXPatch".encode())
+            self.ser.write(bytes([(start & 0xFF00) >> 8, start & 0xFF])) # start address high, low bytes
+            self.ser.write(bytes([((len(data)-1) & 0xFF00) >> 8, (len(data)-1) & 0xFF])) # last offset high, low bytes
+            self.send_echoed(start, data)
+            self.expect('(Ard) Patch written')
+        except LinkError as err:
+            self.fail(err)
+            return False
+        self.done()
+        return True
+
+    def append_records(self, records, verify=True): # n command, writes records (bytes, or a list of bytes) at the end of pack
+        # only the new bytes are sent, the end of pack comes from the directory and the Arduino checks it hasn't moved,
+        # verify reads the records and the new end of pack byte back. returns new end of pack address or None
+        data = b''.join(records) if isinstance(records, (list, tuple)) else bytes(records)
+        try: # must be whole records
+            ends = [rec['addr'] for rec in opk.walk_records(data + b'\xff', 0, len(data) + 1) if rec['kind'] == 'end']
+        except ValueError:
+            ends = []
+        if not data or ends != [len(data)]:
+            print('(PC) Error! Records to append are not a whole number of records')
+            return None
+        ids = self.read_range(0, 10)
+        entries = self.directory()
+        if ids is None or entries is None:
+            return None
+        start = entries[-1]['addr'] # end of pack byte, written over by the 1st record
+        pack_size = min(ids[1] * 0x2000, 0x10000) if ids[1] else 0x10000 # size byte is in 8k blocks
+        if start + len(data) >= pack_size:
+            print(f'(PC) Error! Records need 0x{len(data) + 1:04x} bytes, 0x{max(pack_size - start, 0):04x} free')
+            return None
+        last = len(data) - 1
+        self.invalidate()
+        try:
+            self.command('n', '(Ard) Append records')
+            self.ser.write("XXAppend".encode())
+            self.ser.write(bytes([(start & 0xFF00) >> 8, start & 0xFF])) # end of pack address high, low bytes
+            self.ser.write(bytes([(last & 0xFF00) >> 8, last & 0xFF])) # last offset high, low bytes
+            self.expect('XXAppend') # Arduino has checked the end of pack
+            self.send_echoed(start, data)
+            self.expect('(Ard) Append written')
+        except LinkError as err:
+            self.fail(err)
+            return None
+        self.done()
+        new_end = start + len(data)
+        if verify:
+            back = self.read_range(start, len(data) + 1)
+            if back != data + b'\xff':
+                print('(PC) Verify failed! Records read back are not the same')
+                return None
+        if self.verbose:
+            print(f'(PC) Appended 0x{len(data):04x} bytes at 0x{start:04x}, end of pack is 0x{new_end:04x}{", verified" if verify else "":s}')
+        return new_end
+
+    def write_sparse(self, infile, set_Rampak_ID=False, set_paged=False, set_write_protect=False, update_checksum=False,
+                     set_pack_size=False, pack_size_out=4, min_run=32, verify=True): # write data extents of infile to a blank pack
+        # returns True if written (and verified)
+        image = prepare_image(infile, set_Rampak_ID, set_paged, set_write_protect, update_checksum,
+                              set_pack_size, pack_size_out, self.verbose)
+        if image is None:
+            return False
+        sparse = opk.SparseImage.from_bytes(image, min_run)
+        self.invalidate()
+        t_start = time.time()
+        for addr, data in sparse.extents: # in address order, so the Arduino only seeks forward
+            if not self.send_patch(addr, data):
+                return False
+        if self.verbose:
+            print(f'(PC) Sparse write: 0x{sparse.populated():04x} of 0x{len(image):04x} bytes sent in {len(sparse.extents):d} extents, '
+                  f'{time.time() - t_start:.1f} s')
+        if not verify:
+            return True
+        last_page = (len(image) - 1) >> 8
+        sums = self.page_sums(0, last_page)
+        if sums is None:
+            return False
+        padded = image + bytes([0xFF] * ((last_page + 1) * 0x100 - len(image)))
+        bad = [p for p in range(last_page + 1) if binascii.crc_hqx(padded[p << 8:(p + 1) << 8], 0xFFFF) != sums[p]]
+        if bad:
+            print(f'(PC) Verify failed! Pages: {", ".join(f"{p:d}" for p in bad)}, was the pack blank?')
+            return False
+        if self.verbose:
+            print('(PC) Verified')
+        return True
+
+    def write_cycles(self): # write cycle counts of the last write with the c command, returns dict or None
+        # pulse (us), overprogram, hist (no. of bytes for 0 (failed) to max cycles), marginal_total, marginal [(addr, cycles)]
+        try:
+            self.command('c', 'XXCycles')
+            self.state = TRANSFER
+            head = self.read_exact(4, self.line_timeout)
+            n = head[3] + 1
+            data = self.read_exact(2 * n + 3, self.line_timeout)
+            marginal = self.read_exact(3 * data[-1], self.line_timeout)
+            self.expect('(Ard) Cycles sent')
+        except LinkError as err:
+            self.fail(err)
+            return None
+        self.done()
+        return {'pulse':(head[0] << 8) + head[1], 'overprogram':head[2],
+                'hist':[(data[i] << 8) + data[i+1] for i in range(0, 2 * n, 2)],
+                'marginal_total':(data[2*n] << 8) + data[2*n+1],
+                'marginal':[((marginal[i] << 8) + marginal[i+1], marginal[i+2]) for i in range(0, len(marginal), 3)]}
+
+    def set_pulse(self, pulse, overprogram): # set datapak write pulse (us) and overprogram factor with the u command
+        try:
+            self.command('u', '(Ard) Set write pulse')
+            self.ser.write("XXPulse".encode() + bytes([(pulse & 0xFF00) >> 8, pulse & 0xFF, overprogram & 0xFF]))
+            msg = self.expect('(Ard) Write pulse')
+        except LinkError as err:
+            self.fail(err)
+            return False
+        self.done()
+        return msg.startswith(f'(Ard) Write pulse: {pulse:d} us')
+
+    def write_adaptive(self, infile, set_Rampak_ID=False, set_paged=False, set_write_protect=False, update_checksum=False,
+                       set_pack_size=False, pack_size_out=4, chunk=adaptive_chunk, logfile='', stop_on_marginal=False):
+        # write infile to a blank datapak in chunks, tuning the write pulse from the cycle counts of each chunk
+        # blank chunks are skipped, returns True if written
+        image = prepare_image(infile, set_Rampak_ID, set_paged, set_write_protect, update_checksum,
+                              set_pack_size, pack_size_out, self.verbose)
+        if image is None:
+            return False
+        self.invalidate()
+        stats = self.write_cycles() # current pulse
+        if stats is None:
+            return False
+        start = (stats['pulse'], stats['overprogram']) # set again at the end
+        tuner = PulseTuner(*start)
+        try:
+            return self._write_chunks(image, chunk, tuner, stats, logfile, stop_on_marginal)
+        finally:
+            if (tuner.pulse, tuner.overprogram) != start and self.set_pulse(*start):
+                print(f'(PC) Write pulse set back to {start[0]:d} us, overprogram: {start[1]:d}')
+
+    def _write_chunks(self, image, chunk, tuner, stats, logfile, stop_on_marginal): # write_adaptive() chunk loop
+        total = {'pulse':tuner.pulse, 'overprogram':tuner.overprogram, 'hist':[0] * len(stats['hist']), 'marginal_total':0, 'marginal':[]}
+        t_start = time.time()
+        ok = True
+        for addr in range(0, len(image), chunk):
+            data = image[addr:addr+chunk]
+            if data.count(0xFF) == len(data): # blank, nothing to write
+                continue
+            written = self.send_patch(addr, data)
+            stats = self.write_cycles()
+            if stats is None:
+                return False
+            total['hist'] = [a + b for a, b in zip(total['hist'], stats['hist'])]
+            total['marginal_total'] += stats['marginal_total']
+            total['marginal'] += stats['marginal']
+            if not written:
+                ok = False
+                break
+            if self.verbose:
+                print(f'(PC) 0x{addr:04x}: pulse {tuner.pulse:d} us, cycles: {stats["hist"]}')
+            warning = tuner.update(stats)
+            if warning is not None:
+                print(f'(PC) {warning:s}')
+                if stop_on_marginal:
+                    ok = False
+                    break
+            if (tuner.pulse, tuner.overprogram) != (stats['pulse'], stats['overprogram']):
+                if not self.set_pulse(tuner.pulse, tuner.overprogram):
+                    return False
+        total['pulse'], total['overprogram'] = tuner.pulse, tuner.overprogram
+        written = sum(total['hist'][1:])
+        mean = sum(c * n for c, n in enumerate(total['hist'])) / max(written, 1)
+        print(f'(PC) Datapak write: 0x{written:04x} bytes in {time.time() - t_start:.1f} s, mean cycles: {mean:.2f}, '
+              f'marginal bytes: {total["marginal_total"]:d}, tuned pulse: {tuner.pulse:d} us, overprogram: {tuner.overprogram:d}')
+        if logfile:
+            log_cycles(logfile, image[0:10], total)
+        return ok
+
+    def stop_transfer(self): # stop a read the Arduino is still sending, a wrong echo makes it abort straight away
+        self.set_timeout(self.byte_timeout)
+        dat = self.ser.read(1)
+        if dat != bytes():
+            self.ser.write(bytes([dat[0] ^ 0xFF])) # not verified, Arduino sends XXError
+        self.resync()
+
+    def read_pak(self, outfile, read_fixed_size=False, read_pack_size=0xFFFF, fsync=False, crc_sidecar=False,
+                 stop_at_end=True, end_margin=1, on_record=None):
+        # receive pack data after XXRead, returns size or None. outfile is only written if the read completes
+        # bytes are parsed into records as they arrive, on_record(rec) is called for each one and can return False to stop the read,
+        # if that's before the end of pack byte the image so far is written to outfile + '.partial', outfile is left unchanged
+        # stop_at_end stops end_margin bytes after the end of pack byte, if that's before the size sent by the Arduino
+        ser = self.ser
+        verbose = self.verbose
+        self.state = TRANSFER
+        addr = 0
+        rd_size = 0
+        parser = opk.RecordParser()
+        stopped = False # stopped before the end
+        with opk.OpkWriter(outfile, fsync=fsync, crc_sidecar=crc_sidecar) as f_out: # written to outfile.part, renamed when complete
+            try:
+                read_size = self.read_exact(3, self.byte_timeout) # read 3 bytes for pack size
+                rd_size = (read_size[0]<<16) + (read_size[1]<<8) + (read_size[2])
+                if verbose:
+                    print(f'Read size: {rd_size:06x}')
+                end = rd_size
+                if read_fixed_size == True:
+                    end = min(rd_size, read_pack_size) # read_pack_size can't be bigger than pack
+                self.set_timeout(self.byte_timeout)
+                while True:
+                    dat = ser.read(1) # read 1 value, waits up to byte_timeout
+                    if dat == bytes(): # no byte from read!
+                        raise LinkError('Timeout! No byte from Arduino')
+                    ser.write(dat) # echo back to Arduino for verify
+                    if verbose:
+                        print_byte(addr, ord(dat))
+                    f_out.write(dat) # buffered, written to file a page at a time
+                    for rec in parser.feed(dat): # records completed by this byte
+                        if on_record is not None and on_record(rec) == False:
+                            stopped = True
+                    if stop_at_end and parser.end is not None and addr >= parser.end + end_margin:
+                        stopped = True
+                    if addr >= end or stopped:
+                        break
+                    addr += 1
+                    if verbose and addr % 8 == 0: # if remainder of addr div 8 is zero, newline
+                        print("") # newline
+            except LinkError as err:
+                self.fail(err)
+                return None # OpkWriter discards the partial image
+            if parser.end is not None and parser.end <= addr:
+                f_out.close(parser.end) # size is address of end of pack byte, margin bytes after it are kept
+            elif stopped: # by on_record, not a whole pack, so not named as one
+                f_out.close(addr, outfile + '.partial')
+                print(f'(PC) Read stopped before the end of pack, 0x{addr + 1:04x} bytes written to {outfile:s}.partial')
+            else:
+                f_out.close(addr) # size includes 0xFF bytes at end
+        if verbose:
+            print("\n(PC) Datapak read to file has ended")
+        if addr < rd_size: # fixed size read or stopped, Arduino is still sending
+            if verbose:
+                print(f'(PC) Read stopped at 0x{addr:04x}, Arduino size was 0x{rd_size:04x}')
+            self.stop_transfer()
+        else:
+            self.done()
+        return addr
+
+    def read_voted(self, outfile, passes=5, use_sums=True, end_margin=1, crc_sidecar=False):
+        # recovery read of a marginal pack with the g command, returns size or None. Pages are read up to the end of pack,
+        # then checked against a 2nd read: the page checksums (k command) if use_sums, else each page again.
+        # Only pages that don't match are read again, passes times in all, and voted bit by bit (opk.vote_reads()).
+        # The unstable bytes are written to outfile.vote, as well as outfile
+        reads = [] # reads of each page
+        image = bytearray() # voted pages
+        unstable = [] # (address, confidence, voted, values) of each unstable byte
+        n_reads = 0
+        while True:
+            first = len(reads)
+            end = voted_end(image)
+            while len(reads) < 0x100 and (end is None or end + end_margin >= len(reads) * 0x100): # 1st read, up to the end of pack
+                data = self.get_page(len(reads))
+                if data is None:
+                    return None
+                reads.append([data])
+                image += data
+                end = voted_end(image)
+            n_reads += len(reads) - first
+            if use_sums and len(reads) > first:
+                sums = self.page_sums(first, len(reads) - 1)
+                if sums is None:
+                    return None
+                n_reads += len(sums)
+            for page in range(first, len(reads)):
+                if use_sums:
+                    stable = binascii.crc_hqx(reads[page][0], 0xFFFF) == sums[page - first]
+                else:
+                    data = self.get_page(page)
+                    if data is None:
+                        return None
+                    reads[page].append(data)
+                    n_reads += 1
+                    stable = data == reads[page][0]
+                if stable:
+                    continue
+                while len(reads[page]) < passes: # marginal page, read passes times and vote
+                    data = self.get_page(page)
+                    if data is None:
+                        return None
+                    reads[page].append(data)
+                    n_reads += 1
+                voted, page_unstable = opk.vote_reads(reads[page])
+                image[page * 0x100:(page + 1) * 0x100] = voted
+                unstable += [(page * 0x100 + i, conf, v, values) for i, conf, v, values in page_unstable]
+                print(f'(PC) Page {page:d}: {len(page_unstable):d} unstable bytes in {len(reads[page]):d} reads')
+            end = voted_end(image)
+            if len(reads) == 0x100 or (end is not None and end + end_margin < len(reads) * 0x100):
+                break # else a voted record runs on past the pages read
+        with opk.OpkWriter(outfile, crc_sidecar=crc_sidecar) as f_out:
+            if end is not None:
+                f_out.write(image[0:end + end_margin + 1])
+                size = f_out.close(end)
+            else: # no end of pack found in 64k
+                f_out.write(image)
+                size = f_out.close()
+        opk.write_vote_file(outfile + '.vote', unstable)
+        marginal = sum(1 for r in reads if len(r) > (1 if use_sums else 2))
+        print(f'(PC) Read {len(reads):d} pages with {n_reads:d} page reads{" & checksums" if use_sums else "":s}, '
+              f'marginal pages: {marginal:d}, unstable bytes: {len(unstable):d}')
+        if unstable:
+            print(f'(PC) Lowest confidence: {min(u[1] for u in unstable):.2f}, unstable bytes listed in {outfile:s}.vote')
+        return size
+
+    def read_range(self, addr, length): # read length bytes from addr with the a command, returns bytes or None
+        got = self.read_plan([(addr, length)])
+        return None if got is None else got[0]
+
+    def read_plan(self, plan): # read list of up to max_ranges (addr, length) with one a command, returns list of bytes or None
+        # the Arduino continues from the end of one range to the next, without resetting the counters, if that needs fewer clocks
+        for addr, length in plan:
+            if length <= 0 or addr + length - 1 > 0xFFFF:
+                print(f'(PC) Error! Range 0x{addr:04x} length 0x{length:04x} is outside the pack')
+                return None
+        ser = self.ser
+        out = []
+        try:
+            self.command('a', '(Ard) Read range')
+            msg = bytearray("XXRange".encode()) # tells Arduino that following bytes are the ranges
+            msg.append(len(plan))
+            for addr, length in plan: # start address high, low bytes, last offset high, low bytes
+                msg += bytes([(addr & 0xFF00) >> 8, addr & 0xFF, ((length-1) & 0xFF00) >> 8, (length-1) & 0xFF])
+            ser.write(msg)
+            self.expect('XXRange')
+            self.state = TRANSFER
+            self.set_timeout(self.byte_timeout)
+            for addr, length in plan:
+                data = bytearray()
+                for i in range(length):
+                    dat = ser.read(1) # read 1 value, waits up to byte_timeout
+                    if dat == bytes(): # no byte from read!
+                        raise LinkError('Timeout! No byte from Arduino')
+                    ser.write(dat) # echo back to Arduino for verify
+                    data += dat
+                out.append(bytes(data))
+            self.expect('(Ard) Range read')
+        except LinkError as err:
+            self.fail(err)
+            return None
+        self.done()
+        return out
+
+    def get_page(self, page): # get 256 bytes of page with the g command, sent as binary without echo, returns bytes or None
+        try:
+            self.command('g', '(Ard) Get page')
+            self.ser.write("XXPage".encode() + bytes([page & 0xFF])) # page no. follows XXPage
+            self.expect('XXPage')
+            self.state = TRANSFER
+            data = self.read_exact(0x100, self.line_timeout)
+            self.expect('(Ard) Page sent')
+        except LinkError as err:
+            self.fail(err)
+            return None
+        self.done()
+        return data
+
+    def set_addr_mode(self, paged): # l command until the Arduino is in paged (True) or linear addressing mode, returns True if set
+        if self.paged_addr == paged:
+            return True
+        self.invalidate() # a directory read in the other mode may be wrong
+        for i in range(2): # l toggles the mode
+            try:
+                msg = self.command('l', '(Ard) Now in')
+                while 'addressing' not in msg: # e.g. the rampak or datapak mode line
+                    msg = self.expect('(Ard) Now in')
+            except LinkError as err:
+                self.fail(err)
+                return False
+            self.done()
+            self.paged_addr = msg.startswith('(Ard) Now in paged')
+            if self.paged_addr == paged:
+                print(f'(PC) Arduino set to {"paged" if paged else "linear"} addressing') # a mode change the operator didn't key in
+                return True
+        return False
+
+    def auto_addr_mode(self): # set the addressing mode from the ID byte, then check the first 2 pages, returns True if ok
+        # if the pages look wrong, the other mode is tried, in case the ID byte is wrong
+        ids = self.read_range(0, 10) # page 0 reads the same in either mode
+        if ids is None:
+            return False
+        if ids[0] & 0x01: # also a blank pack, ID 0xFF
+            print(f'(PC) ID byte 0x{ids[0]:02x} is not a valid MK II pack, addressing mode not set')
+            return False
+        paged = (ids[0] & 0x04) != 0
+        for mode in (paged, not paged): # the other mode if the ID byte is wrong
+            if not self.set_addr_mode(mode):
+                return False
+            pages = [self.get_page(0), self.get_page(1)]
+            if None in pages:
+                return False
+            reason = check_first_pages(pages[0] + pages[1])
+            if reason is None:
+                break
+            print(f'(PC) {"Paged" if mode else "Linear"} addressing: {reason:s}')
+        else:
+            print('(PC) First 2 pages are wrong in either addressing mode, check the pack connection')
+            return False
+        if mode == paged:
+            print(f'(PC) ID byte 0x{ids[0]:02x}: {"paged" if mode else "linear"} addressing, first 2 pages ok')
+        else:
+            print(f'(PC) ID byte 0x{ids[0]:02x} says {"paged" if paged else "linear"} addressing, but the pack reads in {"paged" if mode else "linear"} mode')
+        return True
+
+    def read_dir(self): # binary directory with the f command, returns list of entries (last is end of pack) or None
+        entries = []
+        try:
+            self.command('f', 'XXDir')
+            self.state = TRANSFER
+            while True:
+                entry = self.read_exact(3, self.line_timeout) # address & length byte
+                if entry[2] != 0xFF:
+                    entry += self.read_exact(12, self.line_timeout) # type, size, first 9 bytes
+                entries.append(parse_dir_entry(entry))
+                if entry[2] == 0xFF:
+                    break
+            self.expect('(Ard) Dir sent')
+        except LinkError as err:
+            self.fail(err)
+            return None
+        self.done()
+        return entries
+
+    def directory(self, refresh=False): # directory entries, from the cache if the ID bytes and the end of the records are the same
+        # a copy of a pack has the same ID bytes, so the last record byte and the end of pack byte are checked as well
+        ids = self.read_range(0, 10)
+        if ids is None:
+            return None
+        for key, entries in self.dir_cache.items():
+            if not refresh and key[0:10] == ids:
+                tail = self.read_range(entries[-1]['addr'] - 1, 2)
+                if tail is None:
+                    return None
+                if ids + tail == key:
+                    return entries
+        entries = self.read_dir()
+        if entries is None:
+            return None
+        tail = self.read_range(entries[-1]['addr'] - 1, 2)
+        if tail is None:
+            return None
+        self.dir_cache = {ids + tail:entries} # one pack at a time
+        return entries
+
+    def invalidate(self): # pack written or erased, directory must be read again
+        self.dir_cache = {}
+
+    def read_ranges(self, ranges, gap=merge_gap): # read list of (addr, length), returns list of bytes in the same order, or None
+        plan = plan_ranges(ranges, gap)
+        got = []
+        for n in range(0, len(plan), max_ranges): # in address order, max_ranges to each a command
+            data = self.read_plan(plan[n:n+max_ranges])
+            if data is None:
+                return None
+            got += [(addr, d) for (addr, length), d in zip(plan[n:n+max_ranges], data)]
+        out = []
+        for addr, length in ranges:
+            for start, data in got:
+                if start <= addr and addr + length <= start + len(data):
+                    out.append(data[addr-start:addr-start+length])
+                    break
+            else: # zero length
+                out.append(b'')
+        return out
+
+    def page_sums(self, first, last): # CRC-16 of pages first to last with the k command, returns list or None
+        try:
+            self.command('k', '(Ard) Page checksums')
+            self.ser.write("XXSum".encode() + bytes([first & 0xFF, last & 0xFF]))
+            self.expect('XXSum')
+            self.state = TRANSFER
+            data = self.read_exact(2 * (last - first + 1), self.line_timeout * (1 + (last - first) // 16))
+            self.expect('(Ard) Sums sent')
+        except LinkError as err:
+            self.fail(err)
+            return None
+        self.done()
+        return [(data[i] << 8) + data[i+1] for i in range(0, len(data), 2)]
+
+    def erase_range(self, addr, length): # erase length bytes from addr with the z command, returns no. of bytes written or None
+        self.invalidate()
+        try:
+            self.command('z', '(Ard) Erase range')
+            self.ser.write("XXErase".encode())
+            self.ser.write(bytes([(addr & 0xFF00) >> 8, addr & 0xFF])) # start address high, low bytes
+            self.ser.write(bytes([((length-1) & 0xFF00) >> 8, (length-1) & 0xFF])) # last offset high, low bytes
+            while True: # page dots and Erased ok, until result line
+                msg = self.expect('(Ard) ', self.line_timeout * (1 + length // 0x100))
+                if msg.startswith('(Ard) Erase range:'):
+                    break
+                if msg.startswith("(Ard) Can't erase"):
+                    self.done()
+                    return None
+        except LinkError as err:
+            self.fail(err)
+            return None
+        self.done()
+        return int(msg.split('written:')[1], 16)
+
+    def erase_used(self): # erase pages that aren't blank, up to the end of pack, then verify. returns True if pack is blank
+        t_start = time.time()
+        entries = self.directory()
+        if entries is None:
+            return False
+        ids = next(iter(self.dir_cache)) # ID bytes read by directory(), start of its cache key
+        end = entries[-1]['addr'] # end of pack byte
+        last_page = end >> 8
+        sums = self.page_sums(0, last_page)
+        if sums is None:
+            return False
+        pages = [p for p, crc in enumerate(sums) if crc != blank_page_sum]
+        written = 0
+        t_erase = time.time()
+        for addr, length in plan_ranges([(p << 8, 0x100) for p in pages], 0): # whole pages, so old data after end of pack goes too
+            n = self.erase_range(addr, length)
+            if n is None:
+                return False
+            written += n
+        t_erase = time.time() - t_erase
+        sums = self.page_sums(0, last_page) # verify
+        if sums is None:
+            return False
+        not_blank = [p for p, crc in enumerate(sums) if crc != blank_page_sum]
+        elapsed = time.time() - t_start
+        pack_bytes = max(ids[1], 1) * 0x2000 # size byte is in 8k units
+        print(f'(PC) Used: 0x{end+1:04x} bytes, pages erased: {len(pages):d} of {last_page+1:d}, bytes written: 0x{written:04x}')
+        if pages: # time saved compared with erasing every page of the pack, at the time per page of the used pages
+            t_full = (pack_bytes >> 8) * t_erase / len(pages)
+            print(f'(PC) Time: {elapsed:.1f} s, full erase of {pack_bytes // 1024:d} kB estimated {t_full:.1f} s, saved {t_full - elapsed:.1f} s')
+        else:
+            print(f'(PC) Nothing to erase, time: {elapsed:.1f} s')
+        if not_blank:
+            print(f'(PC) Verify failed! Pages not blank: {", ".join(f"{p:d}" for p in not_blank)}')
+            return False
+        print('(PC) Verified blank')
+        return True
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Network daemon for Datapak/Rampak Reader/Writers - read, write, erase, directory and page checksums over TCP
+
+Created: Oct 2026
+
+@author: martin
+
+The server owns one or more readers (serial ports, or emulators for testing) and runs jobs for them from clients
+on other hosts. Each device has a queue and a worker thread, so many clients can share a device, one job at a time.
+Connections are kept open for any number of jobs, and each device keeps its link to the Arduino in step between jobs.
+
+Frames, both ways: type byte + payload length (4 bytes, big endian) + payload
+    Q - request, JSON: {"op": ..., "device": ..., args}
+    D - data, part of an image body. A body is sent as D frames, ending with an empty D frame
+    R - result, JSON: {"ok": true or false, "queued": s waiting for the device, "time": s for the job, ...}
+    E - error, text, e.g. unknown device or op. The connection stays open
+
+ops:
+    devices - list of devices & jobs waiting: {"devices": {name: waiting}}
+    read - read the pack, image body (OPK file) sent back before the result: {"size": pack size}
+    write - write the pack, image body (OPK file) sent by the client after the request
+            args: set_Rampak_ID, set_paged, set_write_protect, update_checksum, set_pack_size, pack_size_out
+    erase - erase the used part of a rampak and verify blank
+    dir - directory: {"entries": [{addr, kind, type, size, name, deleted}, ...]}, name is text
+    sums - page checksums, args: first, last: {"sums": [CRC-16 of each page]}
+
+Psion2Client is the client, e.g.:
+    with Psion2Client('readerhost') as c:
+        c.read('pak0', 'out.opk')
+"""
+
+import json
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+import Psion2_link
+import Psion2_transport
+
+frame_header = '>cI' # type, payload length
+frame_header_len = struct.calcsize(frame_header)
+body_chunk = 0x1000 # bytes in each D frame
+max_frame = 0x100000 # bigger frames are a protocol error
+default_port = 7802
+
+class ServerError(Exception): # E frame from the server, or a broken connection
+    pass
+
+def recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return bytes(data)
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(struct.pack(frame_header, kind, len(payload)) + payload)
+
+def recv_frame(sock): # returns type & payload
+    kind, length = struct.unpack(frame_header, recv_exact(sock, frame_header_len))
+    if length > max_frame:
+        raise ConnectionError(f'Frame too long: {length:d} bytes')
+    return kind, recv_exact(sock, length)
+
+def send_body(sock, filename): # file as D frames, then an empty D frame
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(body_chunk)
+            send_frame(sock, b'D', chunk)
+            if not chunk:
+                return
+
+def recv_body(sock, filename): # D frames to file, until an empty D frame
+    with open(filename, 'wb') as f:
+        while True:
+            kind, chunk = recv_frame(sock)
+            if kind != b'D':
+                raise ConnectionError(f'Expected image data, got frame type {kind}')
+            if not chunk:
+                return
+            f.write(chunk)
+
+class Device(): # one reader, with a queue of jobs run in turn by a worker thread
+    def __init__(self, name, ser):
+        self.name = name
+        self.ser = ser
+        self.link = Psion2_link.Link(ser, verbose=False)
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            job, reply = self.jobs.get()
+            if job is None: # stop
+                return
+            try:
+                reply.put(job(self.link))
+            except Exception as err: # report to the client, the worker carries on with the next job
+                reply.put(err)
+
+    def submit(self, job): # run job(link) on the worker, returns its result & time waiting in the queue
+        reply = queue.Queue(1)
+        t_queued = time.time()
+        self.jobs.put((lambda link: (time.time() - t_queued, job(link)), reply))
+        result = reply.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def waiting(self):
+        return self.jobs.qsize()
+
+    def stop(self):
+        self.jobs.put((None, None))
+        self.worker.join()
+        self.ser.close()
+
+def job_read(link, outfile, args):
+    link.command('r', 'XXRead')
+    size = link.read_pak(outfile)
+    if size is None:
+        return {'ok':False}
+    link.expect('(Ard) Size of pack')
+    return {'ok':True, 'size':size}
+
+def job_write(link, infile, args):
+    flags = {k:args[k] for k in ('set_Rampak_ID','set_paged','set_write_protect','update_checksum',
+                                 'set_pack_size','pack_size_out') if k in args}
+    link.command('w')
+    if not link.write_pak(infile, **flags):
+        return {'ok':False}
+    link.expect('(Ard) Pack size to write')
+    return {'ok':True}
+
+def job_erase(link, args):
+    return {'ok':link.erase_used()}
+
+def job_dir(link, args):
+    entries = link.directory()
+    if entries is None:
+        return {'ok':False}
+    out = []
+    for e in entries:
+        e = dict(e)
+        if 'name' in e:
+            e['name'] = e['name'].decode('latin-1')
+        out.append(e)
+    return {'ok':True, 'entries':out}
+
+def job_sums(link, args):
+    sums = link.page_sums(int(args.get('first', 0)), int(args.get('last', 0)))
+    if sums is None:
+        return {'ok':False}
+    return {'ok':True, 'sums':sums}
+
+class Handler(socketserver.BaseRequestHandler): # one client connection, any number of requests
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                kind, payload = recv_frame(sock)
+            except (ConnectionError, OSError):
+                return # client has gone
+            if kind != b'Q':
+                send_frame(sock, b'E', f'Expected a request, got frame type {kind}'.encode())
+                continue
+            try:
+                self.request_job(sock, json.loads(payload))
+            except (ConnectionError, OSError):
+                return
+            except Exception as err:
+                send_frame(sock, b'E', f'{type(err).__name__}: {err}'.encode())
+
+    def request_job(self, sock, req):
+        devices = self.server.devices
+        op = req.get('op')
+        if op == 'devices':
+            send_frame(sock, b'R', json.dumps({'ok':True, 'devices':{n:d.waiting() for n, d in devices.items()}}).encode())
+            return
+        device = devices.get(req.get('device'))
+        if device is None:
+            raise ValueError(f'Unknown device: {req.get("device")}')
+        tmp = tempfile.mkdtemp(prefix='psion2_')
+        try:
+            image = os.path.join(tmp, 'image.opk')
+            t_start = time.time()
+            if op == 'read':
+                queued, result = device.submit(lambda link: job_read(link, image, req))
+            elif op == 'write':
+                recv_body(sock, image) # whole body before the job is queued, so a slow client doesn't hold the device
+                queued, result = device.submit(lambda link: job_write(link, image, req))
+            elif op == 'erase':
+                queued, result = device.submit(lambda link: job_erase(link, req))
+            elif op == 'dir':
+                queued, result = device.submit(lambda link: job_dir(link, req))
+            elif op == 'sums':
+                queued, result = device.submit(lambda link: job_sums(link, req))
+            else:
+                raise ValueError(f'Unknown op: {op}')
+            result['queued'] = queued
+            result['time'] = time.time() - t_start - queued
+            if op == 'read' and result['ok']:
+                send_body(sock, image)
+            send_frame(sock, b'R', json.dumps(result).encode())
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+class Psion2Server(socketserver.ThreadingTCPServer): # serves devices, a dict of name: Device
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, devices, host='127.0.0.1', port=default_port):
+        self.devices = devices
+        super().__init__((host, port), Handler)
+
+    def server_close(self):
+        super().server_close()
+        for device in self.devices.values():
+            device.stop()
+
+class Psion2Client(): # persistent connection to a Psion2Server
+    def __init__(self, host='127.0.0.1', port=default_port, timeout=300):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, op, device=None, infile=None, outfile=None, **args): # returns result dict, raises ServerError
+        req = dict(args, op=op, device=device)
+        send_frame(self.sock, b'Q', json.dumps(req).encode())
+        if infile is not None:
+            send_body(self.sock, infile)
+        f_out = None
+        try:
+            while True:
+                kind, payload = recv_frame(self.sock)
+                if kind == b'D': # image body, before the result
+                    if f_out is None:
+                        f_out = open(outfile + '.part', 'wb')
+                    f_out.write(payload)
+                elif kind == b'R':
+                    result = json.loads(payload)
+                    break
+                elif kind == b'E':
+                    raise ServerError(payload.decode())
+                else:
+                    raise ServerError(f'Unexpected frame type {kind}')
+        except BaseException:
+            if f_out is not None:
+                f_out.close()
+                os.remove(outfile + '.part')
+            raise
+        if f_out is not None:
+            f_out.close()
+            os.replace(outfile + '.part', outfile)
+        return result
+
+    def devices(self):
+        return self.request('devices')['devices']
+
+    def read(self, device, outfile):
+        return self.request('read', device, outfile=outfile)
+
+    def write(self, device, infile, **flags):
+        return self.request('write', device, infile=infile, **flags)
+
+    def erase(self, device):
+        return self.request('erase', device)
+
+    def directory(self, device):
+        return self.request('dir', device)
+
+    def page_sums(self, device, first, last):
+        return self.request('sums', device, first=first, last=last)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+if __name__ == '__main__':
+    host = '127.0.0.1' # '0.0.0.0' to serve other hosts
+    port = default_port
+    BaudRate = 115200 # must match Arduino value
+    serial_ports = {'pak0':'COM3'} # device name: port, e.g. {'pak0':'/dev/ttyUSB0', 'pak1':'/dev/ttyUSB1'}
+    emulate = True # True to serve emulated devices with the example packs instead of serial_ports
+    emulated_packs = {'pak0':'testpak.opk', 'pak1':'comms42.opk'}
+
+    devices = {}
+    if emulate:
+        import Psion2_emulator
+        for name, packfile in emulated_packs.items():
+            emu, ser = Psion2_emulator.open_emulator(packfile, datapak_mode=False)
+            devices[name] = Device(name, ser)
+    else:
+        for name, port in serial_ports.items():
+            devices[name] = Device(name, Psion2_transport.open_port(port, BaudRate))
+    with Psion2Server(devices, host, port) as server:
+        print(f'Serving {", ".join(devices):s} on {host:s}:{port:d}, press Ctrl-C to stop')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
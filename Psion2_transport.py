@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Transports for the link to the Datapak/Rampak Reader/Writer - serial port, pty, capture and replay
+
+Created: Oct 2026
+
+@author: martin
+
+All transports have the pyserial methods used by Psion2_link.py and the PC program:
+read, readline, write, inWaiting, reset_input_buffer, close and the timeout & name attributes.
+
+open_port() opens a port with pyserial, or PtySerial for a pty (emulator) if pyserial isn't installed.
+CaptureSerial wraps any transport and logs every byte sent and received, with its time, to a capture file.
+ReplaySerial plays a capture file back to the PC code as if it were the Arduino, at the original speed or faster,
+so a failed transfer can be run again without the hardware, and protocol changes can be checked against real sessions.
+
+Capture file format:
+    "P2CAP" + version byte + start time (8 byte float, little endian)
+    events - kind byte, data length (varint), time since previous event in us (varint), [wait in us (varint)], data
+        kind 0 - bytes written by the PC
+        kind 1 - bytes read by the PC, wait is how long the read waited for them after the read started or previous event
+        kind 2 - read timeout, fewer bytes than asked for arrived (no data)
+varint is 7 bits per byte, low bits first, bit 7 set if more bytes follow.
+
+During replay the Arduino bytes are only released after the PC has written as many bytes as it had when they
+arrived in the capture, and not before their wait / speed (speed = 0 for no waits) after the read starts, or after the
+previous event if later. Time the PC spent not reading isn't counted, so bytes already waiting are replayed as waiting.
+A read that reaches a timeout in the capture waits for the real timeout, so the PC code times out as it did.
+Bytes written by the PC are compared with the capture, the first difference is kept in mismatch.
+"""
+
+import fcntl
+import os
+import select
+import struct
+import termios
+import time
+import tty
+
+capture_magic = b'P2CAP\x01'
+WRITE = 0
+READ = 1
+TIMEOUT = 2
+kind_names = {WRITE:'PC ', READ:'Ard', TIMEOUT:'---'}
+
+def put_varint(out, n): # append varint n to bytearray out
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def get_varint(dat, i): # returns value & index after varint at dat[i]
+    n = 0
+    shift = 0
+    while True:
+        b = dat[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+class PtySerial(): # minimal pyserial style port on a pty, used when pyserial isn't installed
+    def __init__(self, port, timeout=0.5):
+        self.name = port
+        self.timeout = timeout
+        self.fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+
+    def inWaiting(self): # no. of bytes waiting to be read
+        buf = fcntl.ioctl(self.fd, termios.FIONREAD, struct.pack('i', 0))
+        return struct.unpack('i', buf)[0]
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1): # read size bytes, or less if timeout
+        data = b''
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while len(data) < size:
+            wait = None if deadline is None else max(0, deadline - time.time())
+            r, w, x = select.select([self.fd], [], [], wait)
+            if not r:
+                break
+            data += os.read(self.fd, size - len(data))
+        return data
+
+    def readline(self): # read up to and including newline, or less if timeout
+        line = b''
+        while not line.endswith(b'\n'):
+            c = self.read(1)
+            if c == b'':
+                break
+            line += c
+        return line
+
+    def write(self, data):
+        view = memoryview(bytes(data))
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+        return len(data)
+
+    def reset_input_buffer(self):
+        termios.tcflush(self.fd, termios.TCIFLUSH)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class CaptureSerial(): # wraps transport ser, logging all bytes to a capture file
+    def __init__(self, ser, filename):
+        self.ser = ser
+        self.name = ser.name
+        self.fid = open(filename, 'wb')
+        self.start = time.time()
+        self.last = self.start
+        self.fid.write(capture_magic + struct.pack('<d', self.start))
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout = value
+
+    def log(self, kind, data=b'', start=None): # start is the time the read started
+        now = time.time()
+        event = bytearray([kind])
+        put_varint(event, len(data))
+        put_varint(event, max(0, int((now - self.last) * 1e6)))
+        if kind == READ:
+            put_varint(event, max(0, int((now - max(self.last, start)) * 1e6)))
+        self.last = now
+        self.fid.write(event + data)
+        if kind == TIMEOUT:
+            self.fid.flush() # a timeout is often the last thing before a failure, make sure it's in the file
+
+    def read(self, size=1):
+        start = time.time()
+        data = self.ser.read(size)
+        if len(data) < size: # timed out, when the bytes arrived isn't known, so no wait
+            start = time.time()
+        if data:
+            self.log(READ, data, start)
+        if len(data) < size:
+            self.log(TIMEOUT)
+        return data
+
+    def readline(self):
+        start = time.time()
+        data = self.ser.readline()
+        if not data.endswith(b'\n'):
+            start = time.time()
+        if data:
+            self.log(READ, data, start)
+        if not data.endswith(b'\n'):
+            self.log(TIMEOUT)
+        return data
+
+    def write(self, data):
+        self.log(WRITE, bytes(data))
+        return self.ser.write(data)
+
+    def inWaiting(self):
+        return self.ser.inWaiting()
+
+    def reset_input_buffer(self):
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        if not self.fid.closed:
+            self.fid.close()
+        self.ser.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_capture(filename): # returns start time & list of events (kind, time from start in s, wait in s, data)
+    with open(filename, 'rb') as f:
+        dat = f.read()
+    if dat[0:len(capture_magic)] != capture_magic:
+        raise ValueError(f'{filename:s} is not a capture file!')
+    i = len(capture_magic)
+    start = struct.unpack('<d', dat[i:i+8])[0]
+    i += 8
+    events = []
+    t = 0
+    while i < len(dat):
+        try:
+            kind = dat[i]
+            length, i = get_varint(dat, i+1)
+            delta, i = get_varint(dat, i)
+            wait = 0
+            if kind == READ:
+                wait, i = get_varint(dat, i)
+        except IndexError: # capture stopped part way through an event
+            break
+        if i + length > len(dat):
+            break
+        t += delta / 1e6
+        events.append((kind, t, wait / 1e6, dat[i:i+length]))
+        i += length
+    return start, events
+
+class ReplaySerial(): # plays back the Arduino side of a capture file, speed 1 is real time, 0 no waits
+    def __init__(self, filename, timeout=0.5, speed=1.0):
+        self.name = filename
+        self.timeout = timeout
+        self.speed = speed
+        start, events = read_capture(filename)
+        self.chunks = [] # Arduino bytes: [data, PC bytes written before them, wait], or None for a timeout
+        self.expected = bytearray() # all bytes written by the PC in the capture
+        for kind, t, wait, data in events:
+            if kind == WRITE:
+                self.expected += data
+            elif kind == READ:
+                self.chunks.append([data, len(self.expected), wait])
+            elif kind == TIMEOUT:
+                self.chunks.append(None)
+        self.chunk = 0 # next chunk
+        self.offset = 0 # in next chunk
+        self.written = 0 # bytes written by the PC in the replay
+        self.mismatch = None # address in PC bytes of the first difference from the capture
+        self.last = time.time() # time of last PC write or Arduino bytes in the replay
+        self.read_start = self.last # time the current read started
+
+    def due(self): # time next chunk arrives
+        return max(self.last, self.read_start) + self.chunks[self.chunk][2] / self.speed if self.speed > 0 else 0
+
+    def ready(self): # True if the next chunk is due, i.e. it would have arrived by now
+        if self.chunk >= len(self.chunks):
+            return False
+        c = self.chunks[self.chunk]
+        if c is None:
+            return False
+        if self.written < c[1]: # Arduino is still waiting for PC bytes
+            return False
+        return time.time() >= self.due()
+
+    def wait_ready(self, deadline): # wait until next chunk is due, or deadline, returns ready()
+        if self.chunk < len(self.chunks) and self.chunks[self.chunk] is not None and self.written >= self.chunks[self.chunk][1]:
+            due = self.due()
+            if due > time.time():
+                time.sleep(max(0, min(due, deadline) - time.time()))
+        elif deadline > time.time(): # not due until the PC writes, or a timeout, or end of capture
+            time.sleep(deadline - time.time())
+        return self.ready()
+
+    def take(self, size, stop=None): # up to size bytes from the ready chunks, stopping after stop byte
+        out = bytearray()
+        while len(out) < size and self.ready():
+            data = self.chunks[self.chunk][0]
+            n = min(size - len(out), len(data) - self.offset)
+            if stop is not None:
+                i = data.find(stop, self.offset, self.offset + n)
+                if i >= 0:
+                    n = i + 1 - self.offset
+            out += data[self.offset:self.offset + n]
+            self.offset += n
+            if self.offset >= len(data):
+                self.chunk += 1
+                self.offset = 0
+                self.last = max(self.last, time.time())
+            if stop is not None and out.endswith(stop):
+                break
+        return bytes(out)
+
+    def read_until(self, size, stop=None): # read size bytes, or up to stop byte, or less if timeout
+        self.read_start = time.time()
+        deadline = self.read_start + (self.timeout if self.timeout is not None else 0)
+        out = self.take(size, stop)
+        while len(out) < size and not (stop is not None and out.endswith(stop)):
+            if not self.wait_ready(deadline): # timeout
+                if self.chunk < len(self.chunks) and self.chunks[self.chunk] is None:
+                    self.chunk += 1 # timeout in the capture, used up
+                break
+            out += self.take(size - len(out), stop)
+        return out
+
+    def read(self, size=1):
+        return self.read_until(size)
+
+    def readline(self):
+        return self.read_until(0x10000, b'\n')
+
+    def write(self, data):
+        data = bytes(data)
+        if self.mismatch is None:
+            expected = self.expected[self.written:self.written + len(data)]
+            if data != expected:
+                i = 0
+                while i < len(expected) and data[i] == expected[i]:
+                    i += 1
+                self.mismatch = self.written + i
+        self.written += len(data)
+        self.last = time.time()
+        return len(data)
+
+    def inWaiting(self):
+        n = 0
+        chunk, offset = self.chunk, self.offset
+        while self.ready():
+            n += len(self.chunks[self.chunk][0]) - self.offset
+            self.chunk += 1
+            self.offset = 0
+        self.chunk, self.offset = chunk, offset
+        return n
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def reset_input_buffer(self):
+        while self.ready():
+            self.chunk += 1
+            self.offset = 0
+
+    def done(self): # True if all the capture has been played and the PC wrote the same bytes
+        return self.chunk >= len(self.chunks) and self.mismatch is None and self.written == len(self.expected)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_port(port, baud=115200, timeout=0.5, capture='', replay='', speed=1.0):
+    # port with pyserial (PtySerial for a pty if pyserial isn't installed), or replay file, captured if capture is a filename
+    if replay:
+        ser = ReplaySerial(replay, timeout, speed)
+    else:
+        try:
+            import serial # uses pyserial
+            ser = serial.Serial(port, baud, timeout=timeout)
+        except ImportError:
+            ser = PtySerial(port, timeout)
+    if capture:
+        ser = CaptureSerial(ser, capture)
+    return ser
+
+if __name__ == '__main__': # list a capture file
+    capture_file = "session.p2cap"
+    max_bytes = 16 # bytes shown for each event
+
+    start, events = read_capture(capture_file)
+    print(f'Capture: {capture_file:s}, started: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))}')
+    for kind, t, wait, data in events:
+        text = data[0:max_bytes].hex(' ') + (' ...' if len(data) > max_bytes else '')
+        print(f'{t:10.6f} {kind_names.get(kind, "???"):s} {len(data):5d} {text:s}')
+    sent = sum(len(e[3]) for e in events if e[0] == WRITE)
+    received = sum(len(e[3]) for e in events if e[0] == READ)
+    timeouts = sum(1 for e in events if e[0] == TIMEOUT)
+    duration = events[-1][1] if events else 0
+    print(f'{len(events):d} events, PC sent: {sent:d} bytes, Arduino sent: {received:d} bytes, timeouts: {timeouts:d}, {duration:.3f} s')
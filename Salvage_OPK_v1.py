@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Salvage OPK files - triage damaged or truncated pack images in bulk, and save the records that can be recovered
+
+Created: Oct 2026
+
+@author: martin
+
+Each image is walked with the fault tolerant record scan (OPK_lib.salvage_records): where the record chain breaks
+(a record past the end of the data, an unlikely record, or an end of pack byte with data after it) the scan looks for the
+next likely record header - a named file header, a long record, or a text record of a known file ID - with more likely
+records after it. Each record found has a confidence from 0 to 1. The time is linear in the file size, so a folder of
+failing reads, or multi MB dumps that aren't OPK files at all, can be checked in one go.
+
+One line per file: records found, chain breaks, lowest & mean confidence, end of pack found, time.
+Files that aren't OPK files (no "OPK" header) are scanned as raw pack images.
+With save_salvaged, the records at or above min_confidence are written to a new OPK file (name + out_suffix)
+with the ID bytes of the image and a new end of pack byte.
+"""
+
+import glob
+import time
+
+import OPK_lib as opk
+
+infiles = sorted(glob.glob("*.opk"))
+show_records = False # list each record found and each break, not just the summary line
+min_confidence = 0.5 # records below this are listed as doubtful and not saved
+save_salvaged = False # write the records found to name + out_suffix
+out_suffix = "_salvaged.opk"
+
+def read_image(filename): # returns pack image, OPK size or None for a raw image
+    with open(filename,'rb') as fid:
+        dat = fid.read()
+    if dat[0:3] == b'OPK' and len(dat) >= opk.OPK_header_len:
+        return dat[opk.OPK_header_len:], (dat[3] << 16) + (dat[4] << 8) + dat[5]
+    return dat, None
+
+def salvage(dat): # returns records found, breaks and end of pack dict
+    recs, breaks, end = [], [], None
+    for rec in opk.salvage_records(dat):
+        if rec['kind'] == 'break':
+            breaks.append(rec)
+        elif rec['kind'] == 'end':
+            end = rec
+        else:
+            recs.append(rec)
+    return recs, breaks, end
+
+def record_line(rec):
+    text = ''.join(chr(c) if 31 < c < 127 else '.' for c in rec['body'][0:16])
+    doubt = ' doubtful' if rec['confidence'] < min_confidence else ''
+    resync = ' resync' if rec['resync'] else ''
+    return f'  0x{rec["addr"]:04x} {rec["kind"]:5s} type: 0x{rec["type"]:02x} len: 0x{rec["len"]:04x} confidence: {rec["confidence"]:.2f}{resync:s}{doubt:s} : {text:s}'
+
+def save(filename, dat, recs): # records at or above min_confidence to a new OPK file, returns no. saved
+    out = bytearray(dat[0:opk.rec_start])
+    saved = 0
+    for rec in recs:
+        if rec['confidence'] >= min_confidence:
+            out += dat[rec['addr']:rec['addr']+rec['skip']]
+            saved += 1
+    out.append(0xFF) # end of pack
+    opk.write_opk(filename, out, len(out) - 1)
+    return saved
+
+if __name__ == '__main__':
+    totals = {'files':0, 'clean':0, 'records':0, 'doubtful':0, 'breaks':0}
+    t_all = time.time()
+    for infile in infiles:
+        t_start = time.time()
+        dat, size = read_image(infile)
+        recs, breaks, end = salvage(dat)
+        t_file = time.time() - t_start
+        conf = [rec['confidence'] for rec in recs]
+        doubtful = sum(1 for c in conf if c < min_confidence)
+        kind = 'raw' if size is None else 'OPK'
+        end_s = f'end: 0x{end["addr"]:04x}' if end['found'] else 'no end'
+        conf_s = f'confidence min: {min(conf):.2f} mean: {sum(conf) / len(conf):.2f}' if conf else 'no records'
+        print(f'{infile:s} ({kind:s} {len(dat):d} bytes): records: {len(recs):d}, doubtful: {doubtful:d}, breaks: {len(breaks):d}, '
+              f'{conf_s:s}, {end_s:s}, {t_file:.3f} s')
+        if size is not None and end['found'] and not breaks and end['addr'] != size:
+            print(f'  OPK size 0x{size:06x} does not match end of pack')
+        if show_records:
+            items = sorted(recs + breaks, key=lambda r: (r['addr'], r['kind'] == 'break'))
+            for rec in items:
+                if rec['kind'] == 'break':
+                    resync = f'0x{rec["resync"]:04x}' if rec['resync'] is not None else 'none'
+                    print(f'  0x{rec["addr"]:04x} chain break: {rec["reason"]:s}, next record found: {resync:s}')
+                else:
+                    print(record_line(rec))
+        if save_salvaged and (breaks or doubtful or not end['found']):
+            outfile = infile.rsplit('.', 1)[0] + out_suffix
+            print(f'  {save(outfile, dat, recs):d} records saved to {outfile:s}')
+        totals['files'] += 1
+        totals['clean'] += not breaks and not doubtful and end['found']
+        totals['records'] += len(recs)
+        totals['doubtful'] += doubtful
+        totals['breaks'] += len(breaks)
+    print(f'\n{totals["files"]:d} files, {totals["clean"]:d} clean, {totals["files"] - totals["clean"]:d} to check, '
+          f'records: {totals["records"]:d}, doubtful: {totals["doubtful"]:d}, breaks: {totals["breaks"]:d}, '
+          f'{time.time() - t_all:.2f} s')
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the transfer paths and the OPK parsers
+
+Created: Oct 2026
+
+@author: martin
+
+Times the serial read, write and sparse write transfers (Psion2_link.py) against the device emulator (Psion2_emulator.py)
+with a modelled serial link, and the record walk, streaming record read, compaction and hex dump (OPK_lib.py)
+on synthetic pack images from 8k to several MB, with sparse (few long records) and dense (many short records) layouts.
+
+A read is also captured (Psion2_transport.py) and replayed with no waits, which times the PC side of the read on its own.
+
+The salvage scan (OPK_lib.salvage_records) is timed on junk made of a chain of likely records that each hold another likely
+record 2 bytes in, with a broken record at the end, from salvage_sizes[0] to 16 times that. Its time must grow linearly
+with the size, it's flagged as NOT LINEAR if the time per byte of the largest is more than linear_limit times the smallest.
+
+Reports bytes/sec, records/sec and peak memory (tracemalloc) for each benchmark.
+Results are compared with the baseline file, a benchmark is flagged as a regression if it is slower, or uses more memory,
+by more than tolerance. Set save_baseline = True to store the results as the new baseline, e.g. for a new version.
+"""
+
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import OPK_lib as opk
+import Psion2_emulator
+import Psion2_link
+import Psion2_transport
+
+baseline_file = "bench_baseline.json"
+save_baseline = False # True to save results as new baseline
+tolerance = 0.2 # 20% slower or bigger is a regression
+repeats = 3 # best of repeats for timing
+
+parse_sizes = [0x2000, 0x8000, 0x10000, 0x100000, 0x400000] # 8k to 4M
+transfer_sizes = [0x2000, 0x8000] # emulator transfers are in real time, 8k takes about 2 s each way at 115200 baud
+link_baud = 115200
+link_turnaround = 0.0 # extra delay for each reply from emulator, e.g. 0.001 for USB latency
+salvage_sizes = [0x2000, 0x8000, 0x20000] # 8k to 128k of junk for the salvage scan
+linear_limit = 2.0 # time per byte of the largest salvage size at most 2 times the smallest
+
+def make_synthetic(size, layout='dense', seed=1): # synthetic pack image of about size bytes, ending with end of pack byte
+    # dense - MAIN datafile with many short records, sparse - a few OPL procedures with long records
+    rnd = random.Random(seed)
+    dat = bytearray([0x7A, max(1, min(size // 0x2000, 0x80)), 0x7A, 0x08, 0x1D, 0x11, 0xCC, 0xE1, 0xDD, 0xFB]) # standard rampak ID bytes
+    dat += bytes([9, 0x81]) + b'MAIN    ' + bytes([0x90])
+    words = [b'Psion', b'Organiser', b'London', b'0171', b'Smith', b'Jones', b'diary', b'Comms', b'Datapak']
+    n = 0
+    while len(dat) < size - 0x200:
+        if layout == 'dense':
+            body = b'\t'.join(rnd.choice(words) for i in range(rnd.randint(1, 4)))
+            rec_type = 0x90 if rnd.random() > 0.1 else 0x10 # some deleted records
+            dat += bytes([len(body), rec_type]) + body
+        else:
+            name = f'PROC{n:04d}'.encode()
+            dat += bytes([9, 0x83]) + name + bytes([0])
+            body = bytes(rnd.randrange(256) for i in range(rnd.randint(0x100, 0x400)))
+            dat += bytes([2, 0x80, (len(body) & 0xFF00) >> 8, len(body) & 0xFF]) + body
+        n += 1
+    dat.append(0xFF)
+    return dat
+
+def measure(func, nbytes): # returns dict of bytes/sec, records/sec, peak memory for func(), which returns no. of records
+    best = None
+    for i in range(repeats):
+        t = time.perf_counter()
+        nrec = func()
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'bytes_per_s':nbytes / best, 'records_per_s':nrec / best, 'peak_kb':peak / 1024, 'seconds':best}
+
+def count_walk(dat):
+    return sum(1 for rec in opk.walk_records(dat, limit=len(dat)))
+
+def count_stream(opk_bytes):
+    return sum(1 for rec in opk.read_records(io.BytesIO(opk_bytes)))
+
+def count_dump(dat):
+    for line in opk.hex_dump(dat):
+        pass
+    return 0
+
+def count_salvage(dat):
+    return sum(1 for rec in opk.salvage_records(dat) if rec['kind'] not in ('break','end'))
+
+def salvage_benchmarks(results): # returns list of salvage benchmarks that aren't linear in time
+    names = []
+    for size in salvage_sizes:
+        dat = bytearray(b'\x03\x90\x01\x90\x41' * (size // 5)) # 03 90 01 90 41: a record with a likely record 2 bytes in
+        dat += b'\x30\x90' # then a record that runs past the end, so the chain breaks
+        name = f'salvage_junk_{size // 1024}k'
+        results[name] = measure(lambda: count_salvage(dat), len(dat))
+        names.append(name)
+    scale = results[names[0]]['bytes_per_s'] / results[names[-1]]['bytes_per_s']
+    print(f'Salvage scan time per byte, {names[-1]:s} / {names[0]:s}: {scale:.2f}')
+    return [names[-1]] if scale > linear_limit else []
+
+def parser_benchmarks(results):
+    for size in parse_sizes:
+        for layout in ('dense','sparse'):
+            dat = make_synthetic(size, layout)
+            end = len(dat) - 1
+            opk_bytes = opk.opk_header(end) + dat
+            nrec = count_walk(dat)
+            name = f'{layout}_{size // 1024}k'
+            results['walk_' + name] = measure(lambda: count_walk(dat), len(dat))
+            if end < opk.max_pack_size: # streaming read and compaction stop at 64k, the largest pack
+                results['stream_' + name] = measure(lambda: count_stream(opk_bytes), len(dat))
+                results['compact_' + name] = measure(lambda: (opk.compact_records(dat), nrec)[1], len(dat))
+            results['hexdump_' + name] = measure(lambda: count_dump(dat), len(dat))
+
+def transfer_benchmarks(results):
+    for size in transfer_sizes:
+        dat = make_synthetic(size, 'dense')
+        nrec = count_walk(dat)
+        with tempfile.TemporaryDirectory() as tmp:
+            infile = os.path.join(tmp, 'in.opk')
+            outfile = os.path.join(tmp, 'out.opk')
+            opk.write_opk(infile, dat, len(dat) - 1)
+            emu, ser = Psion2_emulator.open_emulator(b'', datapak_mode=False, baud=link_baud, turnaround=link_turnaround)
+            link = Psion2_link.Link(ser, verbose=False)
+            try:
+                def write():
+                    link.command('w')
+                    if not link.write_pak(infile):
+                        raise RuntimeError('emulator write failed')
+                    link.expect('(Ard) Pack size to write')
+                    return nrec
+                def read():
+                    link.command('r', 'XXRead') # after the directory listing
+                    if link.read_pak(outfile) is None:
+                        raise RuntimeError('emulator read failed')
+                    link.expect('(Ard) Size of pack')
+                    return nrec
+                results[f'write_{size // 1024}k'] = measure(write, len(dat))
+                results[f'read_{size // 1024}k'] = measure(read, len(dat))
+                sparse = make_synthetic(size // 4, 'dense') # short data region, long 0xFF tail
+                sparse += bytes([0xFF] * (size - len(sparse)))
+                nrec_sparse = count_walk(sparse)
+                opk.write_opk(infile, sparse, len(sparse) - 1)
+                def write_sparse():
+                    emu.insert_pack(b'') # blank pack for each write, the full write above left this one written
+                    link.invalidate()
+                    if not link.write_sparse(infile):
+                        raise RuntimeError('emulator sparse write failed')
+                    return nrec_sparse
+                results[f'write_sparse_{size // 1024}k'] = measure(write_sparse, len(sparse))
+            finally:
+                ser.close()
+                emu.stop()
+
+def replay_benchmarks(results): # PC side of a read, from a captured session replayed with no waits
+    for size in transfer_sizes:
+        dat = make_synthetic(size, 'dense')
+        nrec = count_walk(dat)
+        with tempfile.TemporaryDirectory() as tmp:
+            capture = os.path.join(tmp, 'read.p2cap')
+            outfile = os.path.join(tmp, 'out.opk')
+            emu, ser = Psion2_emulator.open_emulator(dat, datapak_mode=False, baud=link_baud, turnaround=link_turnaround)
+            with Psion2_transport.CaptureSerial(ser, capture) as cap:
+                link = Psion2_link.Link(cap, verbose=False)
+                link.command('r', 'XXRead')
+                if link.read_pak(outfile) is None:
+                    raise RuntimeError('emulator read failed')
+                link.expect('(Ard) Size of pack')
+            emu.stop()
+            def replay():
+                rep = Psion2_transport.ReplaySerial(capture, speed=0)
+                link = Psion2_link.Link(rep, verbose=False)
+                link.command('r', 'XXRead')
+                link.read_pak(outfile)
+                link.expect('(Ard) Size of pack')
+                if not rep.done():
+                    raise RuntimeError(f'replay differs from capture at PC byte {rep.mismatch}')
+                return nrec
+            results[f'replay_read_{size // 1024}k'] = measure(replay, len(dat))
+
+def compare(results, baseline): # print results, returns list of regressions
+    regressions = []
+    print(f'{"benchmark":<22} {"bytes/s":>12} {"records/s":>12} {"peak kB":>9}  change')
+    for name, r in results.items():
+        change = ''
+        b = baseline.get(name)
+        if b is not None:
+            speed = r['bytes_per_s'] / b['bytes_per_s'] - 1
+            mem = r['peak_kb'] / b['peak_kb'] - 1 if b['peak_kb'] > 0 else 0
+            change = f'{speed*100:+.0f}% speed, {mem*100:+.0f}% memory'
+            if speed < -tolerance or mem > tolerance:
+                change += ' REGRESSION'
+                regressions.append(name)
+        print(f'{name:<22} {r["bytes_per_s"]:>12.0f} {r["records_per_s"]:>12.0f} {r["peak_kb"]:>9.1f}  {change:s}')
+    return regressions
+
+if __name__ == '__main__':
+    results = {}
+    parser_benchmarks(results)
+    transfer_benchmarks(results)
+    replay_benchmarks(results)
+    not_linear = salvage_benchmarks(results)
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline)
+    for name in not_linear:
+        print(f'{name:s} NOT LINEAR')
+    regressions += not_linear
+    if regressions:
+        print(f'{len(regressions):d} regression(s): {", ".join(regressions)}')
+    elif baseline:
+        print('No regressions')
+    if save_baseline:
+        with open(baseline_file,'w') as f:
+            json.dump(results, f, indent=1)
+        print(f'Baseline saved to: {baseline_file:s}')
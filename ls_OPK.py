@@ -8,12 +8,17 @@ Created: Sept 2022
 """
 
 # import os
+import sys
+
+import OPK_lib as opk
 
 # file1 = "comms42.opk"
 # file1 = "rampak_colours.opk"
 file1 = "testpak.opk"
 # file1 = "test.opk"
 
+salvage = False # True to also list the records found by the fault tolerant scan, always listed if the record chain breaks
+
 dat = [] #  file data 
 
 # read file data
@@ -22,22 +27,13 @@ print(f'File {file1:s}:')
 # fs = os.path.getsize(f)
 # print(f'File size is: {fs:d} bytes')
 with open(file1,'rb') as fid:
-    fid.seek(0,2)      # go to the file end, 2-rel. to end
-    fs = fid.tell()   # get the end of file location
-    fid.seek(0,0)      # go back to file beginning, 0-abs
-    print(f'File size: {fs:d}')        
-    eof = False
-    addr = 0
-    # fs = 5
-    while not eof:
-        b = ord(fid.read(1))
-        # print(addr, b)
-        dat.append(b)
-        addr += 1
-        if addr == fs:
-            eof = True
+    dat = list(fid.read()) # byte values, one read
+    print(f'File size: {len(dat):d}')
 ds = len(dat)
 print(f'bytes read: {ds:d} 0x{ds:06x}')
+if ds < 6:
+    print('File is too short for an OPK header!')
+    sys.exit()
 
 # print OPK header and remove it
 
@@ -68,6 +64,7 @@ bsr = 0 # bad short record count
 sr = 0 # short record count
 lr = 0 # long record count
 end_of_pack = False
+chain_break = '' # why the record walk stopped before an end of pack byte, e.g. truncated image
 r_types = {0x80:'long',0x81:'data',0x82:'diary',0x83:'OPL',0x84:'comms',0x85:'sheet',0x86:'pager',0x87:'notes'}
 df_id = [] # list to store data file IDs
 df_name = [] # list to store data file names
@@ -75,12 +72,18 @@ df_name = [] # list to store data file names
 while not end_of_pack:
     if i >= 0x10000: # limit read size here, if needed
         end_of_pack = True
+    if i >= len(dat):
+        chain_break = 'no end of pack byte, image is truncated'
+        break
     rec_len = dat[i] # 1st byte is record length
     if rec_len == 0xFF: # end of pack
         skp = 0
         end_of_pack = True
         print(f'0x{i:04x} end of pack')
         break
+    if i+1 >= len(dat):
+        chain_break = 'record type byte is past end of data'
+        break
     rec_type = dat[i+1] # 2nd byte is record type (only 2 main types: short or long)
     r_type = rec_type | 0x80 # OR with 0x80, as could be deleted
     if rec_type == 0xFF: # bad short record
@@ -88,11 +91,20 @@ while not end_of_pack:
         bsr += 1
         print(f'0x{i:04x} bad short record')
     elif rec_type == 0x80: # long record - preceding short record has: deleted?, type, filename
+        if i+3 >= len(dat):
+            chain_break = 'long record length is past end of data'
+            break
         skp = (dat[i+2] << 8) + dat[i+3] + 4 # high byte, low byte of long rec length
+        if i+skp > len(dat):
+            chain_break = f'long record of length 0x{skp-4:04x} runs past end of data'
+            break
         lr += 1
         print(f'0x{i:04x} Long  Length: 0x{skp-4:04x} skip :0x{skp:04x}')
     else: # short record
         skp = rec_len + 2
+        if i+skp > len(dat):
+            chain_break = f'short record of length 0x{rec_len:02x} runs past end of data'
+            break
         sr += 1
         r_string = ''
         for sl in range(rec_len): # build record string
@@ -124,6 +136,8 @@ while not end_of_pack:
         print(f'0x{i:04x} Short Length: 0x{skp-2:04x} skip: 0x{skp:04x} deleted?: {r_del:s} Type: 0x{dat[i+1]:02x} {r_type_s:s} : {r_string:s}')
     i = i + skp
 
+if chain_break:
+    print(f'0x{i:04x} record chain broken: {chain_break:s}')
 print(f'bad short records: {bsr:d}')
 print(f'short records: {sr:d}')
 print(f'long records: {lr:d}')
@@ -133,6 +147,22 @@ if i == size:
     print('Sizing matches OPK size!')
 else:
     print('Sizing does not match OPK size!!')
+
+if salvage or chain_break: # fault tolerant scan: resyncs on likely record headers after a break, see OPK_lib.salvage_records
+    print('\nSalvage record list:')
+    found = 0
+    for rec in opk.salvage_records(bytes(dat)):
+        if rec['kind'] == 'break':
+            resync = f'0x{rec["resync"]:04x}' if rec['resync'] is not None else 'none found'
+            print(f'0x{rec["addr"]:04x} chain break: {rec["reason"]:s}, next record: {resync:s}')
+        elif rec['kind'] == 'end':
+            print(f'0x{rec["addr"]:04x} end of pack' if rec['found'] else f'0x{rec["addr"]:04x} no end of pack byte')
+        else:
+            found += 1
+            r_string = ''.join(chr(c) if 31 < c < 127 else '.' for c in rec['body'][0:16])
+            print(f'0x{rec["addr"]:04x} {rec["kind"]:5s} Length: 0x{rec["len"]:04x} Type: 0x{rec["type"]:02x} '
+                  f'confidence: {rec["confidence"]:.2f}{" (resync)" if rec["resync"] else "":s} : {r_string:s}')
+    print(f'records found: {found:d}')
     
 # display pack data
     
@@ -143,6 +173,9 @@ print("\naddr   00 01 02 03 04 05 06 07   08 09 0A 0B 0C 0D 0E 0F   TEXT")
 print("---------------------------------------------------------------")
 
 # size = 0x200
+if size > len(data): # truncated image, dump what there is
+    print(f'OPK size is past end of data, dump up to 0x{len(data):04x}')
+    size = len(data)
 
 l = (size-1) // 16 # div (no. of complete 16's in size)
 n = 15 - (size % 16) # fill in rest of 16 with zero's - just for printing